@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import config
+from fake_gitlab import FakeGitLab, GROUP_ID
+from fake_telegram import FakeTelegramRequest, inject
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def configure(fake: FakeGitLab, args) -> None:
+    # the bot modules read config at import time, so this runs before importing them
+    config.GITLAB_URL = fake.base_url
+    config.CACHE_TTL = args.cache_ttl
+    config.USER_CONFIG.clear()
+    for n in range(args.chats):
+        chat_id = 100000 + n
+        user_config = {'gitlab_token': f"token-{n % args.tokens}"}
+        if args.group:
+            user_config['group_id'] = GROUP_ID
+        else:
+            user_config['project_id'] = fake.project_ids[n % len(fake.project_ids)]
+        config.USER_CONFIG[chat_id] = user_config
+
+
+async def run(fake: FakeGitLab, args) -> Dict[str, Any]:
+    from telegram.ext import Application
+
+    import gitlab_async
+    import main
+    import parser
+    from review_notes import NoteIndex
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    telegram = FakeTelegramRequest(latency=args.telegram_latency)
+    application = (
+        Application.builder()
+        .token('1:bench')
+        .request(telegram)
+        .get_updates_request(FakeTelegramRequest())
+        .updater(None)
+        .concurrent_updates(True)
+        .build()
+    )
+    main.register_handlers(application)
+    chat_ids = list(config.USER_CONFIG)
+
+    results = {}
+    async with application:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await main.init_all_gitlab_clients()
+
+        for command in args.commands:
+            fake.reset_calls()
+            throttled_before = fake.throttled
+            first_reply = len(telegram.sent)
+            latencies = []
+            started_at = time.perf_counter()
+            for _ in range(args.rounds):
+                if args.cold:
+                    gitlab_async.snapshot_cache.clear()
+                    parser.note_index = NoteIndex(limit=parser.MR_NOTES_LIMIT)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    latencies += await asyncio.gather(*(inject(application, chat_id, f"/{command}")
+                                                        for chat_id in chat_ids))
+            elapsed = time.perf_counter() - started_at
+
+            handled = len(latencies)
+            results[command] = {
+                'commands': handled,
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'throughput': handled / elapsed if elapsed else 0.0,
+                'api_calls_per_command': fake.total_calls() / handled if handled else 0.0,
+                # a fast "❌ Error" is not a speedup
+                'throttled_429': fake.throttled - throttled_before,
+                'error_replies': sum(message.text.startswith('❌') for message in telegram.sent[first_reply:]),
+                'endpoints': dict(fake.calls.most_common()),
+            }
+
+    gitlab_async.shutdown()
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for command, current in results.items():
+        previous = baseline.get(command)
+        if not previous:
+            continue
+        if current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"/{command}: p99 {previous['p99_ms']:.1f} -> {current['p99_ms']:.1f} ms")
+        if current['error_replies'] > previous.get('error_replies', 0):
+            regressions.append(f"/{command}: {current['error_replies']} error replies")
+        if current['api_calls_per_command'] > previous['api_calls_per_command'] + 1e-9:
+            regressions.append(f"/{command}: API calls {previous['api_calls_per_command']:.2f} -> "
+                               f"{current['api_calls_per_command']:.2f} per command")
+    return regressions
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='load test the command handlers against a fake GitLab')
+    arg_parser.add_argument('--chats', type=int, default=50, help='concurrent chats per round')
+    arg_parser.add_argument('--rounds', type=int, default=5)
+    arg_parser.add_argument('--commands', nargs='+', default=['pipeline', 'mr'])
+    arg_parser.add_argument('--tokens', type=int, default=5, help='distinct GitLab tokens among the chats')
+    arg_parser.add_argument('--projects', type=int, default=10)
+    arg_parser.add_argument('--group', action='store_true', help='subscribe every chat to the whole group')
+    arg_parser.add_argument('--jobs', type=int, default=50, help='jobs per pipeline')
+    arg_parser.add_argument('--notes', type=int, default=60, help='notes per MR')
+    arg_parser.add_argument('--max-per-page', type=int, default=100, help='page size cap, lower means deeper pagination')
+    arg_parser.add_argument('--latency', type=float, default=0.02, help='GitLab latency per request, seconds')
+    arg_parser.add_argument('--jitter', type=float, default=0.01)
+    arg_parser.add_argument('--telegram-latency', type=float, default=0.0)
+    arg_parser.add_argument('--cache-ttl', type=float, default=30)
+    arg_parser.add_argument('--rate-limit', type=int, default=0,
+                            help='GitLab requests per token per --rate-window, then 429; 0 is unlimited')
+    arg_parser.add_argument('--rate-window', type=float, default=60)
+    arg_parser.add_argument('--cold', action='store_true', help='drop caches before every round')
+    arg_parser.add_argument('--save', help='write the results as JSON')
+    arg_parser.add_argument('--compare', help='fail on regressions against a saved JSON')
+    arg_parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p99 slowdown for --compare')
+    args = arg_parser.parse_args()
+
+    fake = FakeGitLab(projects=args.projects, jobs=args.jobs, notes=args.notes, latency=args.latency,
+                      jitter=args.jitter, max_per_page=args.max_per_page, rate_limit=args.rate_limit,
+                      rate_window=args.rate_window)
+    fake.start()
+    configure(fake, args)
+
+    results = asyncio.run(run(fake, args))
+    fake.stop()
+
+    print(f"{args.chats} chats x {args.rounds} rounds, GitLab latency {args.latency * 1000:.0f} ms")
+    for command, result in results.items():
+        print(f"/{command:<10} p50 {result['p50_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+              f"{result['throughput']:7.1f} cmd/s  {result['api_calls_per_command']:.2f} API calls/cmd  "
+              f"{result['error_replies']} errors  {result['throttled_429']} x 429")
+        for endpoint, calls in result['endpoints'].items():
+            print(f"    {calls:6d}  {endpoint}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,109 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import render
+from review_notes import ReviewDigest, parse_note
+
+
+def legacy_safe_format(text: str) -> str:
+    # the escaping parser.safe_format did before render.py: one replace pass per character
+    if not text:
+        return ""
+
+    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '=', '-', '|', '{', '}', '!']
+
+    for char in special_chars:
+        text = text.replace(char, f'\\{char}')
+
+    return text
+
+
+# a single-pass alternative kept for comparison, see the note in render.py
+_TRANSLATE_TABLE = str.maketrans({char: f'\\{char}' for char in '\\_*[]()~`>#+-=|{}.!'})
+
+
+def make_thread(notes: int, seed: int = 1):
+    rng = random.Random(seed)
+    words = ['fix', 'the', 'test_case', 'x[i]', '(O(n))', 'a-b', 'self.value', 'TODO!', '#42', '{k: v}', 'a|b']
+    thread = []
+    for note_id in range(notes, 0, -1):
+        reviewer = f"Reviewer {note_id % 5} - reviewer_{note_id % 5}"
+        if note_id % 7 == 0:
+            body = ' '.join(rng.choice(words) for _ in range(150))
+            body += f" Score for all previous groups together: {note_id % 20}/20 Preliminary correctness: 9{note_id % 10}%"
+        elif note_id % 11 == 0:
+            body = f"Score for the group is: {note_id % 10}/10"
+        else:
+            body = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 40)))
+        thread.append((note_id, reviewer, body))
+    return thread
+
+
+def legacy_render(thread) -> str:
+    # the comment loop of the old get_second_last_mr_details, without the GitLab calls
+    result = "\n💬 *Comments:*"
+    comments_by_reviewer = {}
+    for _, reviewer, body in thread:
+        comments_by_reviewer.setdefault(legacy_safe_format(reviewer), []).append(body)
+
+    for reviewer, bodies in comments_by_reviewer.items():
+        result += f"\n👤 *{reviewer}*:\n"
+        for body in bodies:
+            clean_body = legacy_safe_format(' '.join(body.strip().split()))
+            if "Score for the group is:" in clean_body:
+                score_text = clean_body[clean_body.find("Score for the group is:"):]
+                score_text = score_text[-50:] if len(score_text) > 50 else score_text
+                result += f"  {score_text}\n"
+            elif len(clean_body) > 200:
+                score_all_index = clean_body.find('Score for all previous groups together:')
+                score_per_index = clean_body.find('Preliminary correctness:')
+                if clean_body[score_all_index:score_all_index + 46] not in result:
+                    result += f"{clean_body[score_all_index:score_all_index + 46]}\n"
+                if clean_body[score_per_index:score_per_index + 31] not in result:
+                    result += f"{clean_body[score_per_index:score_per_index + 31]}\n"
+            else:
+                result += f"  {clean_body}\n"
+    return result
+
+
+def new_render(thread, mode: str) -> str:
+    digest = ReviewDigest()
+    digest.has_notes = True
+    for note_id, reviewer, body in thread:
+        digest.entries.extend(parse_note(note_id, reviewer, body))
+    return render.render_review_comments(digest, mode)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='safe_format vs render.py on large MR threads')
+    arg_parser.add_argument('--notes', type=int, nargs='+', default=[50, 500, 2000])
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print(f"{'notes':>6} {'case':<28} {'best ms':>10}")
+    for notes in args.notes:
+        thread = make_thread(notes)
+        bodies = [body for _, _, body in thread]
+
+        cases = [
+            ('escape: legacy safe_format', lambda: [legacy_safe_format(body) for body in bodies]),
+            ('escape: str.translate', lambda: [body.translate(_TRANSLATE_TABLE) for body in bodies]),
+            ('escape: MarkdownV2', lambda: [render.escape(body, 'MarkdownV2') for body in bodies]),
+            ('escape: HTML', lambda: [render.escape(body, 'HTML') for body in bodies]),
+            ('thread: legacy +=', lambda: legacy_render(thread)),
+            ('thread: render MarkdownV2', lambda: new_render(thread, 'MarkdownV2')),
+            ('thread: render HTML', lambda: new_render(thread, 'HTML')),
+            ('thread: render + split', lambda: render.split_message(new_render(thread, 'HTML'))),
+        ]
+        for name, case in cases:
+            best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+            print(f"{notes:>6} {name:<28} {best * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
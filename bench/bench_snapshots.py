@@ -0,0 +1,172 @@
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot
+
+STAGES = ('build', 'test', 'lint', 'deploy')
+STATUSES = ('success', 'success', 'success', 'failed', 'running', 'pending', 'skipped')
+REFS = ('main', 'develop', 'hw-1', 'hw-2', 'hw-3')
+
+
+def make_payloads(count: int, jobs: int, seed: int = 1) -> List[str]:
+    # what GitLab sends for a pipeline and its jobs, as JSON text: decoding it gives every
+    # pipeline its own string objects, like responses from the API do
+    rng = random.Random(seed)
+    payloads = []
+    for n in range(count):
+        pipeline_id = 100000 + n
+        payloads.append(json.dumps({
+            'pipeline': {
+                'id': pipeline_id,
+                'status': rng.choice(('running', 'success', 'failed')),
+                'ref': rng.choice(REFS),
+                'created_at': f"2024-03-{1 + n % 28:02d}T12:{n % 60:02d}:00.000Z",
+                'web_url': f"https://gitlab.example/group/project{n % 50}/-/pipelines/{pipeline_id}",
+                'sha': f"{rng.getrandbits(160):040x}",
+            },
+            'jobs': [
+                {'id': pipeline_id * 100 + j, 'name': f"job-{j}", 'stage': STAGES[j * len(STAGES) // jobs],
+                 'status': rng.choice(STATUSES)}
+                for j in range(jobs)
+            ],
+        }))
+    return payloads
+
+
+def legacy_summarize_stages(jobs: List[Tuple[str, str]]) -> Dict[str, Any]:
+    # parser.summarize_stages before snapshot.py
+    stages = {}
+    for stage, status in jobs:
+        if stage not in stages:
+            stages[stage] = []
+        stages[stage].append(status)
+
+    return {
+        stage_name: {
+            'summary': {
+                'total': len(statuses),
+                'success': statuses.count('success'),
+                'failed': statuses.count('failed'),
+                'running': statuses.count('running'),
+                'pending': statuses.count('pending'),
+            }
+        }
+        for stage_name, statuses in stages.items()
+    }
+
+
+def legacy_pipeline_info(payload: str) -> Dict[str, Any]:
+    # the nested dict parser._pipeline_info used to return
+    data = json.loads(payload)
+    pipeline, jobs = data['pipeline'], data['jobs']
+    return {
+        'id': pipeline['id'],
+        'status': pipeline['status'],
+        'ref': pipeline['ref'],
+        'created_at': pipeline['created_at'],
+        'duration': 0,
+        'web_url': pipeline['web_url'],
+        'sha': pipeline['sha'][:8],
+        'stages': legacy_summarize_stages([(job['stage'], job['status']) for job in jobs[::-1]]),
+        'failed_jobs': [
+            {'id': job['id'], 'name': job['name'], 'stage': job['stage']}
+            for job in jobs[::-1] if job['status'] == 'failed'
+        ],
+    }
+
+
+def legacy_signature(pipeline_info: Dict[str, Any]) -> Tuple:
+    # follow.stage_signature before snapshot.py
+    return pipeline_info['status'], tuple(
+        (name, tuple(stage['summary'].values())) for name, stage in pipeline_info['stages'].items()
+    )
+
+
+def snapshot_pipeline(payload: str) -> snapshot.PipelineSnapshot:
+    data = json.loads(payload)
+    pipeline, jobs = data['pipeline'], data['jobs']
+    jobs.reverse()
+    stage_names, counts = snapshot.count_stages((job['stage'], job['status']) for job in jobs)
+    return snapshot.PipelineSnapshot(
+        id=pipeline['id'],
+        status=pipeline['status'],
+        ref=pipeline['ref'],
+        created_at=pipeline['created_at'],
+        duration=0,
+        web_url=pipeline['web_url'],
+        sha=pipeline['sha'][:8],
+        stage_names=stage_names,
+        counts=counts,
+        failed_jobs=tuple(snapshot.FailedJob(job['id'], job['name'], job['stage'])
+                          for job in jobs if job['status'] == 'failed'),
+    )
+
+
+def retained(build, payloads: List[str]) -> Tuple[List[Any], int]:
+    # bytes still allocated once every pipeline is built and the decoded JSON is gone
+    gc.collect()
+    tracemalloc.start()
+    tracked = [build(payload) for payload in payloads]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return tracked, size
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='memory and change detection: pipeline dicts vs snapshots')
+    arg_parser.add_argument('--pipelines', type=int, default=10000)
+    arg_parser.add_argument('--jobs', type=int, default=20, help='jobs per pipeline')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    payloads = make_payloads(args.pipelines, args.jobs)
+    legacy, legacy_size = retained(legacy_pipeline_info, payloads)
+    snapshots, snapshot_size = retained(snapshot_pipeline, payloads)
+
+    print(f"{args.pipelines} tracked pipelines, {args.jobs} jobs each")
+    print(f"  dict pipeline_info   {legacy_size / 1024 / 1024:8.2f} MiB  {legacy_size / args.pipelines:6.0f} B/pipeline")
+    print(f"  PipelineSnapshot     {snapshot_size / 1024 / 1024:8.2f} MiB  {snapshot_size / args.pipelines:6.0f} B/pipeline")
+
+    # the next poll: same content, new objects, one in ten pipelines moved on
+    changed_legacy, changed_snapshots = [], []
+    for n, (info, pipeline) in enumerate(zip(legacy, snapshots)):
+        fresh_info = json.loads(json.dumps(info))
+        fresh_pipeline = snapshot.PipelineSnapshot.from_state(json.loads(json.dumps(pipeline.to_state())))
+        if n % 10 == 0:
+            first_stage = next(iter(fresh_info['stages']))
+            fresh_info['stages'][first_stage]['summary']['success'] += 1
+            counts = list(fresh_pipeline.counts)
+            counts[1] += 1
+            fresh_pipeline = fresh_pipeline.replace(counts=tuple(counts))
+        changed_legacy.append(fresh_info)
+        changed_snapshots.append(fresh_pipeline)
+
+    cases = [
+        ('watcher: dict ==', lambda: sum(a == b for a, b in zip(legacy, changed_legacy))),
+        ('watcher: snapshot.diff', lambda: sum(not snapshot.diff(a, b) for a, b in zip(snapshots, changed_snapshots))),
+        ('follow: stage_signature', lambda: sum(legacy_signature(a) == legacy_signature(b)
+                                                for a, b in zip(legacy, changed_legacy))),
+        ('follow: diff().progress', lambda: sum(not snapshot.diff(a, b).progress
+                                                for a, b in zip(snapshots, changed_snapshots))),
+    ]
+    print(f"\n{'change detection':<28} {'best ms':>10}")
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print(f"  {name:<26} {best * 1000:>10.2f}")
+
+    assert [a == b for a, b in zip(legacy, changed_legacy)] == \
+           [not snapshot.diff(a, b) for a, b in zip(snapshots, changed_snapshots)]
+
+
+if __name__ == '__main__':
+    main()
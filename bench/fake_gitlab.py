@@ -0,0 +1,446 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import endpoint_name
+
+STAGES = ('build', 'test', 'lint', 'deploy')
+REVIEWERS = ('alice', 'bob', 'carol')
+NOTE_BODIES = (
+    'Please rename the variable on line {k}',
+    'Score for the group is: {k}/10',
+    'Preliminary correctness: ok. ' + 'Long grader report line. ' * 10 + 'Score for all previous groups together: {k}',
+)
+FIRST_PROJECT_ID = 1000
+GROUP_ID = 77
+
+_ROUTES = [
+    (re.compile(r'^/api/v4/user$'), 'user'),
+    (re.compile(r'^/api/v4/projects/(\d+)/pipelines$'), 'pipelines'),
+    (re.compile(r'^/api/v4/projects/(\d+)/pipelines/(\d+)$'), 'pipeline'),
+    (re.compile(r'^/api/v4/projects/(\d+)/pipelines/(\d+)/jobs$'), 'jobs'),
+    (re.compile(r'^/api/v4/projects/(\d+)/jobs/(\d+)$'), 'job'),
+    (re.compile(r'^/api/v4/projects/(\d+)/merge_requests$'), 'merge_requests'),
+    (re.compile(r'^/api/v4/projects/(\d+)/merge_requests/(\d+)/notes$'), 'notes'),
+    (re.compile(r'^/api/v4/groups/(\d+)/projects$'), 'group_projects'),
+]
+
+
+_TRACE_RE = re.compile(r'^/api/v4/projects/(\d+)/jobs/(\d+)/trace$')
+
+
+def make_trace(size: int) -> bytes:
+    # a test-suite log of about size bytes the way runners write it: colors, collapsible
+    # sections, the failure, then the after_script housekeeping
+    head = (b"\x1b[0KRunning with gitlab-runner 16.0\n"
+            b"section_start:1700000000:step_script\r\x1b[0K\x1b[0K\x1b[36;1mExecuting step_script\x1b[0;m\n")
+    tail = (b"\x1b[31mFAILED tests/test_parser.py::test_duration - assert 61 == 60\x1b[0m\n"
+            b"\x1b[31m==== 1 failed, 9999 passed in 312.04s ====\x1b[0m\n"
+            b"section_end:1700000300:step_script\r\x1b[0K\n"
+            b"section_start:1700000300:after_script\r\x1b[0K\x1b[0K\x1b[36;1mRunning after_script\x1b[0;m\n"
+            b"Cleaning up temporary files\n"
+            b"section_end:1700000301:after_script\r\x1b[0K\n"
+            b"section_start:1700000301:cleanup_file_variables\r\x1b[0K\x1b[0K\x1b[36;1mCleaning up project "
+            b"directory and file based variables\x1b[0;m\n"
+            b"section_end:1700000302:cleanup_file_variables\r\x1b[0K\n"
+            b"\x1b[31;1mERROR: Job failed: exit code 1\n\x1b[0;m\n")
+    lines = []
+    length = len(head) + len(tail)
+    n = 0
+    while length < size:
+        line = f"tests/test_module_{n // 100}.py::test_case_{n} \x1b[32mPASSED\x1b[0m [{n % 100:3d}%]\n".encode()
+        lines.append(line)
+        length += len(line)
+        n += 1
+    return head + b''.join(lines) + tail
+
+
+def _timestamp(base: datetime, seconds: int) -> str:
+    return (base + timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class FakeGitLab:
+    # a GitLab REST/GraphQL stand-in with generated projects; every request sleeps
+    # latency (+ jitter) seconds and is counted per endpoint
+    def __init__(self, projects: int = 10, pipelines: int = 20, jobs: int = 20, mrs: int = 5, notes: int = 30,
+                 latency: float = 0.02, jitter: float = 0.0, max_per_page: int = 100, seed: int = 1,
+                 trace_kb: int = 1024, honor_range: bool = True, rate_limit: int = 0, rate_window: float = 60):
+        self.latency = latency
+        # like GitLab's per-user limit: rate_limit requests per token per window, then 429 until it resets
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self._windows: Dict[str, Tuple[float, int]] = {}
+        self.throttled = 0
+        self.honor_range = honor_range
+        self.trace = make_trace(trace_kb * 1024)
+        self.trace_bytes_sent = 0
+        self.jitter = jitter
+        self.max_per_page = max_per_page
+        self.random = random.Random(seed)
+        self.base_url = ''
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+        base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.project_ids = [FIRST_PROJECT_ID + i for i in range(projects)]
+        self.pipelines: Dict[int, List[Dict[str, Any]]] = {}
+        self.jobs: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+        self.mrs: Dict[int, List[Dict[str, Any]]] = {}
+        self.notes: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+
+        for project_id in self.project_ids:
+            project_pipelines = []
+            for n in range(pipelines):
+                pipeline_id = project_id * 1000 + n
+                status = 'running' if n == pipelines - 1 else self.random.choice(('success', 'success', 'failed'))
+                project_pipelines.append({
+                    'id': pipeline_id,
+                    'iid': n + 1,
+                    'project_id': project_id,
+                    'status': status,
+                    'ref': 'main',
+                    'sha': hashlib.sha1(str(pipeline_id).encode()).hexdigest(),
+                    'created_at': _timestamp(base, n * 600),
+                    'web_url': f"https://gitlab.example/project{project_id}/-/pipelines/{pipeline_id}",
+                })
+                self.jobs[(project_id, pipeline_id)] = [
+                    {
+                        'id': pipeline_id * 100 + j,
+                        'name': f"job-{j}",
+                        'stage': STAGES[j * len(STAGES) // max(jobs, 1)],
+                        'status': status if j == jobs - 1 else 'success',
+                        'started_at': _timestamp(base, n * 600 + j * 10),
+                        'finished_at': _timestamp(base, n * 600 + j * 10 + 30),
+                    }
+                    for j in range(jobs - 1, -1, -1)
+                ]
+            self.pipelines[project_id] = project_pipelines[::-1]
+
+            project_mrs = []
+            for iid in range(mrs, 0, -1):
+                project_mrs.append({
+                    'id': project_id * 100 + iid,
+                    'iid': iid,
+                    'project_id': project_id,
+                    'title': f"Homework {iid}: fix the parser",
+                    'state': 'opened' if iid == mrs else 'merged',
+                    'author': {'id': 1, 'username': 'student', 'name': 'Student'},
+                    'reviewers': [{'id': 10 + i, 'username': name} for i, name in enumerate(REVIEWERS)],
+                    'labels': ['homework'],
+                    'source_branch': f"hw-{iid}",
+                    'target_branch': 'main',
+                    'created_at': _timestamp(base, iid * 3600),
+                    'updated_at': _timestamp(base, iid * 3600 + 60),
+                    'web_url': f"https://gitlab.example/project{project_id}/-/merge_requests/{iid}",
+                })
+                self.notes[(project_id, iid)] = [
+                    {
+                        'id': project_id * 100000 + iid * 1000 + k,
+                        'body': NOTE_BODIES[k % len(NOTE_BODIES)].format(k=k),
+                        'author': {'id': 10 + k % len(REVIEWERS), 'username': REVIEWERS[k % len(REVIEWERS)],
+                                   'name': REVIEWERS[k % len(REVIEWERS)].title()},
+                        'system': False,
+                        'created_at': _timestamp(base, iid * 3600 + k * 60),
+                    }
+                    for k in range(notes - 1, -1, -1)
+                ]
+            self.mrs[project_id] = project_mrs
+
+    # --- server
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        fake = self
+
+        class Handler(_Handler):
+            gitlab = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-gitlab', daemon=True).start()
+        self.base_url = f"http://{host}:{self._server.server_port}"
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def reset_calls(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _count(self, method: str, path: str) -> None:
+        with self._lock:
+            self.calls[endpoint_name(method, path)] += 1
+
+    def rate_limit_headers(self, token: str) -> Tuple[bool, Dict[str, str]]:
+        if not self.rate_limit:
+            return False, {}
+        now = time.time()
+        with self._lock:
+            started_at, used = self._windows.get(token, (now, 0))
+            if now - started_at >= self.rate_window:
+                started_at, used = now, 0
+            used += 1
+            self._windows[token] = (started_at, used)
+            limited = used > self.rate_limit
+            if limited:
+                self.throttled += 1
+        reset_at = started_at + self.rate_window
+        headers = {
+            'RateLimit-Limit': str(self.rate_limit),
+            'RateLimit-Remaining': str(max(0, self.rate_limit - used)),
+            'RateLimit-Reset': str(int(reset_at) + 1),
+        }
+        if limited:
+            headers['Retry-After'] = str(max(1, int(reset_at - now) + 1))
+        return limited, headers
+
+    def _sleep(self) -> None:
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    # --- REST
+
+    def get(self, path: str, query: Dict[str, str]) -> Tuple[int, Any]:
+        for pattern, name in _ROUTES:
+            match = pattern.match(path)
+            if match:
+                return getattr(self, f"_get_{name}")(*(int(group) for group in match.groups()), query=query)
+        return 404, {'message': '404 Not Found'}
+
+    def _get_user(self, query):
+        return 200, {'id': 1, 'username': 'bench', 'name': 'Bench User'}
+
+    def _get_pipelines(self, project_id, query):
+        if project_id not in self.pipelines:
+            return 404, {'message': '404 Project Not Found'}
+        items = [
+            pipeline for pipeline in self.pipelines[project_id]
+            if query.get('ref', pipeline['ref']) == pipeline['ref']
+            and query.get('status', pipeline['status']) == pipeline['status']
+        ]
+        return 200, items
+
+    def _get_pipeline(self, project_id, pipeline_id, query):
+        for pipeline in self.pipelines.get(project_id, []):
+            if pipeline['id'] == pipeline_id:
+                return 200, pipeline
+        return 404, {'message': '404 Not found'}
+
+    def _get_job(self, project_id, job_id, query):
+        for (job_project_id, _), jobs in self.jobs.items():
+            if job_project_id != project_id:
+                continue
+            for job in jobs:
+                if job['id'] == job_id:
+                    return 200, dict(job, web_url=f"https://gitlab.example/project{project_id}/-/jobs/{job_id}",
+                                     failure_reason='script_failure' if job['status'] == 'failed' else None)
+        return 404, {'message': '404 Job Not Found'}
+
+    def _get_jobs(self, project_id, pipeline_id, query):
+        jobs = self.jobs.get((project_id, pipeline_id))
+        if jobs is None:
+            return 404, {'message': '404 Not found'}
+        return 200, jobs
+
+    def _get_merge_requests(self, project_id, query):
+        if project_id not in self.mrs:
+            return 404, {'message': '404 Project Not Found'}
+        items = [
+            mr for mr in self.mrs[project_id]
+            if query.get('state', 'all') in ('all', mr['state'])
+            and query.get('author_username', mr['author']['username']) == mr['author']['username']
+            and query.get('target_branch', mr['target_branch']) == mr['target_branch']
+        ]
+        return 200, items
+
+    def _get_notes(self, project_id, iid, query):
+        notes = self.notes.get((project_id, iid))
+        if notes is None:
+            return 404, {'message': '404 Not found'}
+        return 200, notes
+
+    def _get_group_projects(self, group_id, query):
+        if group_id != GROUP_ID:
+            return 404, {'message': '404 Group Not Found'}
+        return 200, [{'id': project_id, 'path_with_namespace': f"bench/project{project_id}"}
+                     for project_id in self.project_ids]
+
+    # --- GraphQL
+
+    def graphql(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        ids = [int(gid.rsplit('/', 1)[1]) for gid in (body.get('variables') or {}).get('ids') or []]
+        nodes = []
+        for project_id in ids:
+            if project_id not in self.pipelines:
+                continue
+            latest = self.pipelines[project_id][:1]
+            nodes.append({
+                'id': f"gid://gitlab/Project/{project_id}",
+                'fullPath': f"bench/project{project_id}",
+                'webUrl': f"https://gitlab.example/project{project_id}",
+                'pipelines': {'nodes': [{
+                    'id': f"gid://gitlab/Ci::Pipeline/{pipeline['id']}",
+                    'status': pipeline['status'].upper(),
+                    'ref': pipeline['ref'],
+                    'sha': pipeline['sha'],
+                    'createdAt': pipeline['created_at'],
+                    'duration': 120,
+                    'path': f"/project{project_id}/-/pipelines/{pipeline['id']}",
+                } for pipeline in latest]},
+            })
+        return {'data': {'projects': {'nodes': nodes}}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like GitLab behind nginx, so the client pool is exercised as in production
+    protocol_version = 'HTTP/1.1'
+    gitlab: FakeGitLab = None
+
+    rate_headers: Dict[str, str] = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in {**self.rate_headers, **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _throttled(self) -> bool:
+        limited, self.rate_headers = self.gitlab.rate_limit_headers(self.headers.get('PRIVATE-TOKEN', ''))
+        if limited:
+            self._reply(429, {'message': 'Retry later'})
+        return limited
+
+    def _reply_trace(self) -> None:
+        trace = self.gitlab.trace
+        status, body, headers = 200, trace, {}
+        match = re.match(r'bytes=-(\d+)$', self.headers.get('Range', ''))
+        if match and self.gitlab.honor_range:
+            start = max(0, len(trace) - int(match.group(1)))
+            status, body = 206, trace[start:]
+            headers['Content-Range'] = f"bytes {start}-{len(trace) - 1}/{len(trace)}"
+
+        with self.gitlab._lock:
+            self.gitlab.trace_bytes_sent += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in {**self.rate_headers, **headers}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self.gitlab._count('GET', url.path)
+        self.gitlab._sleep()
+
+        if not self.headers.get('PRIVATE-TOKEN'):
+            self._reply(401, {'message': '401 Unauthorized'})
+            return
+        if self._throttled():
+            return
+
+        if _TRACE_RE.match(url.path):
+            self._reply_trace()
+            return
+
+        status, payload = self.gitlab.get(url.path, query)
+        if status != 200 or not isinstance(payload, list):
+            self._reply(status, payload)
+            return
+
+        per_page = min(int(query.get('per_page', 20)), self.gitlab.max_per_page)
+        page = int(query.get('page', 1))
+        total_pages = max(1, -(-len(payload) // per_page))
+        items = payload[(page - 1) * per_page:page * per_page]
+
+        headers = {
+            'X-Page': str(page),
+            'X-Per-Page': str(per_page),
+            'X-Total': str(len(payload)),
+            'X-Total-Pages': str(total_pages),
+            'ETag': f'W/"{hashlib.md5(json.dumps(items).encode()).hexdigest()}"',
+        }
+        if page < total_pages:
+            next_query = dict(query, page=str(page + 1), per_page=str(per_page))
+            next_url = f"{self.gitlab.base_url}{url.path}?" + '&'.join(f"{k}={v}" for k, v in next_query.items())
+            headers['X-Next-Page'] = str(page + 1)
+            headers['Link'] = f'<{next_url}>; rel="next"'
+
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            self._reply(304, None, {'ETag': headers['ETag']})
+            return
+        self._reply(200, items, headers)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        self.gitlab._count('POST', url.path)
+        self.gitlab._sleep()
+        if self._throttled():
+            return
+
+        if url.path != '/api/graphql':
+            self._reply(404, {'message': '404 Not Found'})
+            return
+        self._reply(200, self.gitlab.graphql(body))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    arg_parser = argparse.ArgumentParser(description='run a fake GitLab API for local experiments')
+    arg_parser.add_argument('--port', type=int, default=8929)
+    arg_parser.add_argument('--projects', type=int, default=10)
+    arg_parser.add_argument('--jobs', type=int, default=20)
+    arg_parser.add_argument('--notes', type=int, default=30)
+    arg_parser.add_argument('--latency', type=float, default=0.05)
+    arg_parser.add_argument('--jitter', type=float, default=0.0)
+    arg_parser.add_argument('--max-per-page', type=int, default=100)
+    arg_parser.add_argument('--trace-kb', type=int, default=1024)
+    arg_parser.add_argument('--ignore-range', action='store_true', help='answer Range requests with the whole log')
+    arg_parser.add_argument('--rate-limit', type=int, default=0, help='requests per token per minute, 0 is unlimited')
+    args = arg_parser.parse_args(argv)
+
+    fake = FakeGitLab(projects=args.projects, jobs=args.jobs, notes=args.notes, latency=args.latency,
+                      jitter=args.jitter, max_per_page=args.max_per_page, trace_kb=args.trace_kb,
+                      honor_range=not args.ignore_range, rate_limit=args.rate_limit)
+    url = fake.start(port=args.port)
+    print(f"fake GitLab on {url}, projects {fake.project_ids[0]}..{fake.project_ids[-1]}, group {GROUP_ID}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
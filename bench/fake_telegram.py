@@ -0,0 +1,90 @@
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+BOT_ID = 1
+BOT_USERNAME = 'bench_bot'
+
+
+class SentMessage:
+    __slots__ = ('method', 'chat_id', 'text', 'sent_at')
+
+    def __init__(self, method: str, chat_id: int, text: str, sent_at: float):
+        self.method = method
+        self.chat_id = chat_id
+        self.text = text
+        self.sent_at = sent_at
+
+
+class FakeTelegramRequest(BaseRequest):
+    # answers Bot API calls locally and records what the bot sent
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent: List[SentMessage] = []
+        self.calls: Dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        parameters = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result: Any = True
+        if api_method == 'getMe':
+            result = {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': BOT_USERNAME}
+        elif api_method in ('sendMessage', 'editMessageText'):
+            chat_id = int(parameters['chat_id'])
+            self.sent.append(SentMessage(api_method, chat_id, parameters.get('text', ''), time.perf_counter()))
+            result = {
+                'message_id': int(parameters.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': parameters.get('text', ''),
+            }
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def replies_to(self, chat_id: int) -> List[SentMessage]:
+        return [message for message in self.sent if message.chat_id == chat_id]
+
+
+_update_ids = itertools.count(1)
+
+
+def command_update(bot, chat_id: int, text: str) -> Update:
+    # what Telegram delivers for "/pipeline" typed in a private chat
+    command = text.split()[0]
+    return Update.de_json({
+        'update_id': next(_update_ids),
+        'message': {
+            'message_id': next(_update_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench', 'username': f"user{chat_id}"},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }, bot)
+
+
+async def inject(application, chat_id: int, text: str) -> float:
+    # runs the update through the handlers like the updater would and returns the handling time
+    update = command_update(application.bot, chat_id, text)
+    started_at = time.perf_counter()
+    await application.process_update(update)
+    return time.perf_counter() - started_at
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# pipelines used to be stored as plain dicts; entries of the old namespace are dropped on start
+STATE_NAMESPACE = 'snapshots:2'
+LEGACY_NAMESPACES = ('snapshots',)
+
+
+class _Entry:
+    __slots__ = ('value', 'etag', 'expires_at')
+
+    def __init__(self, value: Any, etag: Optional[str], expires_at: float):
+        self.value = value
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+# TTL + LRU cache shared by all chats, keyed like (project_id, 'pipeline', ...).
+# Expired entries are revalidated by a cheap conditional request first,
+# concurrent lookups of one key wait for a single in-flight load.
+# revalidate(etag, value) returns the current ETag of what value was built from,
+# or None when it can't vouch for that value and a refetch is needed
+class SnapshotCache:
+
+    def __init__(self, ttl: float = 30, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._state = None
+        self._entries: 'OrderedDict[Hashable, _Entry]' = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        # ETag probes for entries that were fetched cold
+        self._probes: Set[asyncio.Task] = set()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'revalidated': 0}
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                  revalidate: Optional[Callable[[Optional[str], Any], Awaitable[Optional[str]]]] = None,
+                  should_cache: Callable[[Any], bool] = lambda value: value is not None,
+                  max_age: Optional[float] = None) -> Any:
+        entry = self._entries.get(key)
+        expires_at = entry.expires_at if entry else 0
+        if entry and max_age is not None:
+            # a caller that must not miss a change wants an entry checked at most max_age ago
+            expires_at = min(expires_at, entry.expires_at - self.ttl + max_age)
+        if expires_at > time.monotonic():
+            self.stats['hits'] += 1
+            self._entries.move_to_end(key)
+            return entry.value
+
+        task = self._inflight.get(key)
+        if task:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._load(key, entry, fetch, revalidate, should_cache))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def get_many(self, keys: List[Hashable],
+                       fetch_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+                       should_cache: Callable[[Any], bool] = lambda value: value is not None) -> Dict[Hashable, Any]:
+        # like get(), but every missing key is loaded by one shared batch request
+        results = {}
+        waiting = {}
+        missing = []
+        now = time.monotonic()
+
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at > now:
+                self.stats['hits'] += 1
+                self._entries.move_to_end(key)
+                results[key] = entry.value
+            elif key in self._inflight:
+                self.stats['coalesced'] += 1
+                waiting[key] = self._inflight[key]
+            else:
+                missing.append(key)
+
+        if missing:
+            self.stats['misses'] += len(missing)
+            batch = asyncio.ensure_future(fetch_many(missing))
+            for key in missing:
+                task = asyncio.ensure_future(self._load_from_batch(key, batch, should_cache))
+                self._inflight[key] = task
+                task.add_done_callback(lambda _, key=key: self._inflight.pop(key, None))
+                waiting[key] = task
+
+        values = await asyncio.gather(*(asyncio.shield(task) for task in waiting.values()), return_exceptions=True)
+        for key, value in zip(waiting, values):
+            if isinstance(value, BaseException):
+                logger.error(f"Ошибка пакетной загрузки {key}: {value}")
+                value = None
+            results[key] = value
+        return results
+
+    async def _load_from_batch(self, key, batch, should_cache) -> Any:
+        value = (await batch).get(key)
+        if should_cache(value):
+            self._store(key, _Entry(value, None, time.monotonic() + self.ttl))
+        return value
+
+    async def _load(self, key, entry, fetch, revalidate, should_cache) -> Any:
+        etag = None
+        # nothing cached means nothing to compare: a probe before the fetch would only cost a request
+        if revalidate and entry:
+            try:
+                etag = await revalidate(entry.etag, entry.value)
+            except Exception as e:
+                logger.warning(f"Не удалось проверить ETag для {key}: {e}")
+
+        if entry and etag and etag == entry.etag:
+            self.stats['revalidated'] += 1
+            entry.expires_at = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            return entry.value
+
+        self.stats['misses'] += 1
+        value = await fetch()
+        if should_cache(value):
+            fetched = _Entry(value, etag, time.monotonic() + self.ttl)
+            self._store(key, fetched)
+            if revalidate and not etag:
+                # a cold entry learns its ETag right after the fetch, off the caller's path, so its
+                # first expiry can be answered by a 304. A change landing between the fetch and the
+                # probe is only seen with the next one: the window is a single request long
+                probe = asyncio.ensure_future(self._learn_etag(key, fetched, revalidate))
+                self._probes.add(probe)
+                probe.add_done_callback(self._probes.discard)
+        else:
+            self._entries.pop(key, None)
+        return value
+
+    async def _learn_etag(self, key, entry, revalidate) -> None:
+        try:
+            etag = await revalidate(None, entry.value)
+        except Exception as e:
+            logger.warning(f"Не удалось получить ETag для {key}: {e}")
+            return
+        # the entry may have been replaced or evicted while the probe ran
+        if etag and self._entries.get(key) is entry:
+            entry.etag = etag
+            self._persist(key, entry)
+
+    def _store(self, key: Hashable, entry: _Entry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            if self._state:
+                self._state.delete(STATE_NAMESPACE, evicted)
+        self._persist(key, entry)
+
+    def _persist(self, key: Hashable, entry: _Entry) -> None:
+        # only entries with an ETag are worth keeping: after a restart they cost one conditional request
+        if self._state and entry.etag:
+            self._state.set(STATE_NAMESPACE, key, {'value': entry.value, 'etag': entry.etag})
+
+    def attach_store(self, state) -> int:
+        # warm start: restored entries are already expired, so their first use revalidates the ETag
+        self._state = state
+        for namespace in LEGACY_NAMESPACES:
+            for key, _ in list(state.items(namespace)):
+                state.delete(namespace, key)
+        loaded = 0
+        for key, saved in state.items(STATE_NAMESPACE):
+            if len(self._entries) >= self.max_entries:
+                break
+            self._entries[key] = _Entry(saved['value'], saved['etag'], 0)
+            loaded += 1
+        return loaded
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        if self._state:
+            self._state.delete(STATE_NAMESPACE, key)
+
+    def invalidate_project(self, project_id: Any) -> None:
+        for key in [key for key in self._entries if key[0] == project_id]:
+            self.invalidate(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
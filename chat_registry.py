@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from parser import MR_POLICIES, configured_project_ids
+
+logger = logging.getLogger(__name__)
+
+# a JSON file with {chat_id: {...}} or a directory of such files; empty means USER_CONFIG from config.py
+USER_CONFIG_PATH = getattr(config, 'USER_CONFIG_PATH', '')
+CONFIG_RELOAD_INTERVAL = getattr(config, 'CONFIG_RELOAD_INTERVAL', 5)
+
+# key -> accepted types, anything else in an entry is reported and ignored
+FIELDS = {
+    'gitlab_token': (str,),
+    'project_id': (int,),
+    'project_ids': (list,),
+    'group_id': (int,),
+    'ref': (str,),
+    'pipeline_status': (str,),
+    'mr_policy': (str,),
+    'mr_author': (str,),
+    'mr_target_branch': (str,),
+    'watch': (bool,),
+}
+
+
+MISSING = (0, -1)
+
+
+def _stat_key(path: str) -> Tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return MISSING
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def validate_entry(chat_id: Any, entry: Any) -> Tuple[int, Dict[str, Any]]:
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        raise ConfigError(f"chat id {chat_id!r} is not a number")
+    if not isinstance(entry, dict):
+        raise ConfigError(f"chat {chat_id}: entry must be an object")
+
+    clean = {}
+    for key, value in entry.items():
+        types = FIELDS.get(key)
+        if types is None:
+            logger.warning(f"chat {chat_id}: неизвестный ключ {key!r} пропущен")
+            continue
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ConfigError(f"chat {chat_id}: {key} must be {types[0].__name__}")
+        clean[key] = value
+
+    if not clean.get('gitlab_token'):
+        # kept: its commands answer that GitLab is not configured instead of the chat going quiet
+        logger.warning(f"chat {chat_id}: не задан gitlab_token, команды GitLab работать не будут")
+    if not all(isinstance(project_id, int) for project_id in clean.get('project_ids', [])):
+        raise ConfigError(f"chat {chat_id}: project_ids must be numbers")
+    if not (clean.get('project_id') or clean.get('project_ids') or clean.get('group_id')):
+        raise ConfigError(f"chat {chat_id}: project_id, project_ids or group_id is required")
+    if clean.get('mr_policy', 'latest') not in MR_POLICIES:
+        raise ConfigError(f"chat {chat_id}: mr_policy must be one of {', '.join(MR_POLICIES)}")
+    return chat_id, clean
+
+
+def validate(raw: Dict[Any, Any], source: str) -> Dict[int, Dict[str, Any]]:
+    # a broken entry is skipped, the rest of the chats keep working
+    entries = {}
+    for chat_id, entry in raw.items():
+        try:
+            chat_id, entry = validate_entry(chat_id, entry)
+        except ConfigError as e:
+            logger.error(f"{source}: {e}")
+            continue
+        entries[chat_id] = entry
+    return entries
+
+
+def shard_key(chat_id: int, entry: Optional[Dict[str, Any]]) -> int:
+    # chats of one project land on one shard, so they share its cache, follow pollers and webhook renders
+    if entry:
+        project_ids = configured_project_ids(entry)
+        if project_ids:
+            return project_ids[0]
+        if entry.get('group_id'):
+            return entry['group_id']
+    return chat_id
+
+
+class ConfigSnapshot:
+    # immutable once built: readers never see a half-applied reload
+    __slots__ = ('by_chat', 'by_project', 'by_group', 'by_token')
+
+    def __init__(self, entries: Dict[int, Dict[str, Any]]):
+        self.by_chat = entries
+        self.by_project: Dict[int, List[int]] = {}
+        self.by_group: Dict[int, List[int]] = {}
+        self.by_token: Dict[str, List[int]] = {}
+        for chat_id, entry in entries.items():
+            for project_id in configured_project_ids(entry):
+                self.by_project.setdefault(project_id, []).append(chat_id)
+            if entry.get('group_id'):
+                self.by_group.setdefault(entry['group_id'], []).append(chat_id)
+            if entry.get('gitlab_token'):
+                self.by_token.setdefault(entry['gitlab_token'], []).append(chat_id)
+
+
+class ConfigDiff:
+    __slots__ = ('added', 'removed', 'changed', 'unwatched')
+
+    def __init__(self, added: List[int], removed: List[int], changed: List[int], unwatched: List[int] = ()):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        # changed chats whose entry had 'watch' and doesn't anymore
+        self.unwatched = list(unwatched)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self) -> str:
+        return f"+{len(self.added)} -{len(self.removed)} ~{len(self.changed)}"
+
+
+class ChatRegistry:
+    def __init__(self, path: str = USER_CONFIG_PATH):
+        self.path = path
+        self._snapshot: Optional[ConfigSnapshot] = None
+        # file -> ((mtime_ns, size), entries): only files that changed are parsed again
+        self._files: Dict[str, Tuple[Tuple[int, int], Dict[int, Dict[str, Any]]]] = {}
+        self._lock = threading.Lock()
+        # (index, count) in a shard worker: only the chats of that shard are visible
+        self.shard: Optional[Tuple[int, int]] = None
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        if self._snapshot is None:
+            self.reload()
+        return self._snapshot
+
+    def _config_files(self) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(
+                os.path.join(self.path, name) for name in os.listdir(self.path)
+                if name.endswith('.json') and not name.startswith('.')
+            )
+        return [self.path]
+
+    def _read_file(self, path: str) -> Dict[int, Dict[str, Any]]:
+        with open(path, encoding='utf-8') as f:
+            raw = json.load(f)
+        if not isinstance(raw, dict):
+            raise ConfigError(f"{path}: expected an object of chat_id -> settings")
+        return validate(raw, path)
+
+    def _load_entries(self) -> Dict[int, Dict[str, Any]]:
+        if not self.path:
+            return validate(getattr(config, 'USER_CONFIG', {}), 'config.py')
+
+        files = {}
+        for path in self._config_files():
+            stat_key = _stat_key(path)
+            cached = self._files.get(path)
+            if cached and cached[0] == stat_key:
+                files[path] = cached
+                continue
+            try:
+                if stat_key == MISSING:
+                    raise OSError('file not found')
+                files[path] = (stat_key, self._read_file(path))
+            except (OSError, ValueError) as e:
+                # a half-written file keeps its previous contents instead of dropping its chats,
+                # and is not parsed again until it changes
+                logger.error(f"Ошибка в конфигурации {path}: {e}")
+                files[path] = (stat_key, cached[1] if cached else {})
+        self._files = files
+
+        entries = {}
+        for path, (_, file_entries) in files.items():
+            for chat_id in file_entries.keys() & entries.keys():
+                logger.warning(f"chat {chat_id} задан в нескольких файлах, используется {path}")
+            entries.update(file_entries)
+        return entries
+
+    def set_shard(self, index: int, count: int) -> None:
+        self.shard = (index, count)
+        self._snapshot = None
+
+    def shard_of(self, chat_id: int, count: int) -> int:
+        return shard_key(chat_id, self.get(chat_id)) % count
+
+    def changed_on_disk(self) -> bool:
+        # one stat per file, cheap enough for every few seconds
+        if not self.path:
+            return False
+        paths = self._config_files()
+        if set(paths) != set(self._files):
+            return True
+        return any(_stat_key(path) != self._files[path][0] for path in paths)
+
+    def reload(self) -> ConfigDiff:
+        with self._lock:
+            entries = self._load_entries()
+            if self.shard:
+                index, count = self.shard
+                entries = {chat_id: entry for chat_id, entry in entries.items()
+                           if shard_key(chat_id, entry) % count == index}
+            old = self._snapshot.by_chat if self._snapshot else {}
+            self._snapshot = ConfigSnapshot(entries)
+
+        diff = ConfigDiff(
+            added=[chat_id for chat_id in entries if chat_id not in old],
+            removed=[chat_id for chat_id in old if chat_id not in entries],
+            changed=[chat_id for chat_id, entry in entries.items() if chat_id in old and old[chat_id] != entry],
+            unwatched=[chat_id for chat_id, entry in entries.items()
+                       if old.get(chat_id, {}).get('watch') and not entry.get('watch')],
+        )
+        logger.info(f"Конфигурация загружена: {len(entries)} чатов ({diff})")
+        return diff
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        return self.snapshot.by_chat.get(chat_id)
+
+    def chat_ids(self) -> List[int]:
+        return list(self.snapshot.by_chat)
+
+    def chats_for_project(self, project_id: int) -> List[int]:
+        return list(self.snapshot.by_project.get(project_id, ()))
+
+    def chats_for_group(self, group_id: int) -> List[int]:
+        return list(self.snapshot.by_group.get(group_id, ()))
+
+    def chats_by_token(self) -> Dict[str, List[int]]:
+        return {token: list(chat_ids) for token, chat_ids in self.snapshot.by_token.items()}
+
+
+registry = ChatRegistry()
+
+
+def get_user_config(chat_id: int) -> Optional[Dict[str, Any]]:
+    return registry.get(chat_id)
+
+
+def get_all_chat_ids() -> List[int]:
+    return registry.chat_ids()
@@ -8,6 +8,123 @@ USER_CONFIG = {
 
     1234567890: { # example
         'gitlab_token': 'glpio-9OpjUO_MH76dW_LKj-QW34rTY6uI8oA4.29.0987GFd43',
-        'project_id': 422
+        'project_id': 422,
+        # more projects for /pipeline and /mr: explicit ids and/or every project of a group
+        # 'project_ids': [423, 424],
+        # 'group_id': 57,
+        # optional /pipeline filters
+        # 'ref': 'main',
+        # 'pipeline_status': 'success',
+        # optional /mr selection: 'latest' or 'latest_opened', plus filters
+        # 'mr_policy': 'latest_opened',
+        # 'mr_author': 'username',
+        # 'mr_target_branch': 'main',
+        # start live monitoring at bot startup (/watch does it on demand)
+        # 'watch': True,
     },
 }
+
+# Chats can live outside this file instead: a JSON file {"<chat_id>": {...same keys...}} or a
+# directory of such files. It is checked every CONFIG_RELOAD_INTERVAL seconds and changes apply
+# without a restart; then USER_CONFIG above is not used
+USER_CONFIG_PATH = ''
+CONFIG_RELOAD_INTERVAL = 5
+
+# GitLab requests run in a thread pool so a slow project doesn't block the bot
+GITLAB_MAX_CONCURRENCY = 8
+GITLAB_MAX_CONCURRENCY_PER_PROJECT = 2
+# shared keep-alive connection pool; 429/5xx GET responses are retried with backoff
+GITLAB_POOL_SIZE = 8
+GITLAB_RETRIES = 3
+GITLAB_RETRY_BACKOFF = 0.5
+# per-token rate limiting: requests per second (lowered to what GitLab's RateLimit-* headers allow)
+# and per project; calls in flight per token adapt between 1 and GITLAB_TOKEN_CONCURRENCY.
+# Commands go before background refreshes and fail instead of waiting over GITLAB_RATE_LIMIT_MAX_WAIT seconds
+# Sharded workers split the token's rate, burst and concurrency evenly between them
+GITLAB_TOKEN_RATE = 30
+GITLAB_TOKEN_BURST = 60
+GITLAB_PROJECT_RATE = 10
+GITLAB_PROJECT_BURST = 20
+GITLAB_TOKEN_CONCURRENCY = 4
+GITLAB_RATE_LIMIT_MAX_WAIT = 10
+# seconds for a single GitLab request and for the startup auth of one token
+GITLAB_TIMEOUT = 10
+GITLAB_INIT_TIMEOUT = 15
+# skip the startup auth, clients authenticate on their first request
+GITLAB_VALIDATE_ON_FIRST_USE = False
+
+# newest MR notes fetched per /mr
+MR_NOTES_LIMIT = 100
+
+# pipeline/MR snapshots are shared between chats watching the same project
+CACHE_TTL = 30
+CACHE_MAX_ENTRIES = 256
+# /job reads only the last JOB_TRACE_TAIL_BYTES of a job log (HTTP Range) and shows
+# its last JOB_TRACE_TAIL_LINES lines; tails of finished jobs are cached
+JOB_TRACE_TAIL_BYTES = 32768
+JOB_TRACE_TAIL_LINES = 30
+JOB_TRACE_CACHE_TTL = 3600
+JOB_TRACE_CACHE_ENTRIES = 128
+JOB_MAX_SHOWN = 3
+
+# live monitoring polls fast while a pipeline runs and backs off up to the max when idle (seconds)
+WATCH_INTERVAL_ACTIVE = 15
+WATCH_INTERVAL_IDLE = 60
+WATCH_INTERVAL_MAX = 600
+# /follow keeps one message per chat edited while the pipeline runs; one poller per pipeline
+FOLLOW_INTERVAL = 15
+
+# 'HTML' or 'MarkdownV2'
+PARSE_MODE = 'HTML'
+
+# pushed notifications go through a rate-limited queue (messages per second)
+SEND_GLOBAL_RATE = 25
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_WORKERS = 4
+
+# last seen pipelines/notes, cached snapshots and sent message ids survive restarts;
+# 'sqlite' or 'memory', writes are batched and flushed every STATE_FLUSH_INTERVAL seconds
+STATE_BACKEND = 'sqlite'
+STATE_PATH = 'bot_state.sqlite3'
+STATE_BATCH_SIZE = 100
+STATE_FLUSH_INTERVAL = 5
+
+# Sharded mode: `main.py --role ingest --shards N` receives updates and webhooks and queues them here,
+# `main.py --role worker --shard i/N` handles the chats of shard i (chats of one project share a shard);
+# every worker keeps its own STATE_PATH.shard<i> file. Without --role one process does everything
+WORK_QUEUE_PATH = 'bot_queue.sqlite3'
+WORK_QUEUE_POLL_INTERVAL = 0.05
+
+# GitLab webhooks (Pipeline, Job, Merge Request, Note) as an alternative to polling;
+# the secret is required and must match "Secret token" in the GitLab webhook settings
+WEBHOOK_ENABLED = False
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = '/gitlab'
+WEBHOOK_SECRET = ''
+# seconds a client gets to send the request head, and then the body
+WEBHOOK_READ_TIMEOUT = 10
+
+# Prometheus metrics on the same HTTP server (WEBHOOK_HOST:WEBHOOK_PORT), works without webhooks too;
+# /metrics in Telegram is answered only in ADMIN_CHAT_IDS
+METRICS_ENABLED = False
+METRICS_PATH = '/metrics'
+ADMIN_CHAT_IDS = []
+
+# Logging goes through a queue and is written by a background thread; 'json' or 'text'.
+# LOG_LEVELS sets levels per logger ('chat' is the per-message log), plain messages
+# outside commands are logged with LOG_MESSAGE_SAMPLE_RATE
+LOG_FORMAT = 'json'
+LOG_LEVEL = 'INFO'
+LOG_LEVELS = {'httpx': 'WARNING', 'apscheduler': 'WARNING'}
+LOG_QUEUE_SIZE = 10000
+LOG_MESSAGE_SAMPLE_RATE = 0.1
+
+
+def get_user_config(chat_id: int):
+    return USER_CONFIG.get(chat_id)
+
+
+def get_all_chat_ids():
+    return list(USER_CONFIG.keys())
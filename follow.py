@@ -0,0 +1,186 @@
+import logging
+from typing import Dict, Optional, Set, Tuple
+
+import gitlab
+from telegram.ext import Application, ContextTypes
+
+import config
+import gitlab_async
+import snapshot
+from chat_registry import get_user_config
+from parser import get_gitlab_client, format_pipeline_message
+from sender import get_dispatcher
+from state_store import get_store
+from watcher import ACTIVE_STATUSES, WATCH_INTERVAL_ACTIVE
+
+logger = logging.getLogger(__name__)
+
+FOLLOW_INTERVAL = getattr(config, 'FOLLOW_INTERVAL', WATCH_INTERVAL_ACTIVE)
+
+STATE_NAMESPACE = 'follow'
+
+PipelineKey = Tuple[int, int]
+
+
+class PipelineFollow:
+    # one poller per pipeline, however many chats follow it
+    def __init__(self, project_id: int, pipeline_id: int):
+        self.project_id = project_id
+        self.pipeline_id = pipeline_id
+        self.chat_ids: Set[int] = set()
+        self.pipeline_info: Optional[snapshot.PipelineSnapshot] = None
+        self.text: Optional[str] = None
+        self.etag: Optional[str] = None
+
+    @property
+    def key(self) -> PipelineKey:
+        return self.project_id, self.pipeline_id
+
+
+follows: Dict[PipelineKey, PipelineFollow] = {}
+# every chat follows at most one pipeline, its live message is the dispatcher message with this key
+following: Dict[int, PipelineKey] = {}
+
+
+def _job_name(key: PipelineKey) -> str:
+    return f"follow:{key[0]}:{key[1]}"
+
+
+def _message_key(key: PipelineKey) -> Tuple:
+    return ('follow',) + key
+
+
+def _publish(follow: PipelineFollow, chat_ids) -> None:
+    dispatcher = get_dispatcher()
+    for chat_id in chat_ids:
+        dispatcher.send(chat_id, follow.text, key=_message_key(follow.key))
+
+
+def _update(follow: PipelineFollow, pipeline_info: snapshot.PipelineSnapshot) -> bool:
+    # durations tick every second, only status and stage counters are worth an edit
+    changes = snapshot.diff(follow.pipeline_info, pipeline_info)
+    follow.pipeline_info = pipeline_info
+    if not changes.progress:
+        return False
+    follow.text = format_pipeline_message(pipeline_info)
+    return True
+
+
+def _save_chat(chat_id: int) -> None:
+    key = following.get(chat_id)
+    if key is None:
+        get_store().delete(STATE_NAMESPACE, chat_id)
+    else:
+        get_store().set(STATE_NAMESPACE, chat_id, list(key))
+
+
+def _detach(application: Application, chat_id: int) -> Optional[PipelineKey]:
+    key = following.pop(chat_id, None)
+    follow = follows.get(key)
+    if follow is not None:
+        follow.chat_ids.discard(chat_id)
+        if not follow.chat_ids:
+            _drop(application, follow)
+    return key
+
+
+def _drop(application: Application, follow: PipelineFollow) -> None:
+    follows.pop(follow.key, None)
+    for job in application.job_queue.get_jobs_by_name(_job_name(follow.key)):
+        job.schedule_removal()
+
+
+def _attach(application: Application, chat_id: int, key: PipelineKey, first: float) -> PipelineFollow:
+    follow = follows.get(key)
+    if follow is None:
+        follow = follows[key] = PipelineFollow(*key)
+        application.job_queue.run_repeating(follow_tick, FOLLOW_INTERVAL, first=first, data=key,
+                                            name=_job_name(key))
+    follow.chat_ids.add(chat_id)
+    following[chat_id] = key
+    _save_chat(chat_id)
+    return follow
+
+
+def start_follow(application: Application, chat_id: int, project_id: int,
+                 pipeline_info: snapshot.PipelineSnapshot) -> bool:
+    key = (project_id, pipeline_info.id)
+    if following.get(chat_id) == key:
+        return False
+    _detach(application, chat_id)
+
+    follow = _attach(application, chat_id, key, FOLLOW_INTERVAL)
+    # a running poller knows the pipeline at least as well as the command's snapshot,
+    # which may come from the cache: only a poller without a state yet is seeded with it
+    if follow.pipeline_info is None and _update(follow, pipeline_info):
+        _publish(follow, follow.chat_ids)
+    else:
+        # a late follower gets the last render, no extra GitLab request
+        _publish(follow, [chat_id])
+
+    if follow.pipeline_info.status not in ACTIVE_STATUSES:
+        _finish(application, follow)
+    return True
+
+
+def stop_follow(application: Application, chat_id: int) -> bool:
+    key = _detach(application, chat_id)
+    _save_chat(chat_id)
+    return key is not None
+
+
+def _finish(application: Application, follow: PipelineFollow) -> None:
+    # the final state stays in the chat, nothing is left to poll
+    _drop(application, follow)
+    for chat_id in follow.chat_ids:
+        if following.get(chat_id) == follow.key:
+            following.pop(chat_id)
+            _save_chat(chat_id)
+
+
+async def follow_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
+    follow = follows.get(context.job.data)
+    if follow is None or not follow.chat_ids:
+        context.job.schedule_removal()
+        return
+
+    # any follower's client will do, they all see the same pipeline
+    chat_id = next(iter(follow.chat_ids))
+    try:
+        if not get_gitlab_client(chat_id):
+            user_config = get_user_config(chat_id) or {}
+            await gitlab_async.init_gitlab_client(chat_id, user_config.get('gitlab_token'))
+
+        etag = await gitlab_async.probe_jobs_etag(chat_id, follow.project_id, follow.pipeline_id, follow.etag)
+        if etag and etag == follow.etag:
+            return
+
+        pipeline_info = await gitlab_async.get_pipeline(chat_id, follow.project_id, follow.pipeline_id)
+        follow.etag = etag
+    except gitlab.exceptions.GitlabGetError as e:
+        logger.error(f"Pipeline {follow.pipeline_id} проекта {follow.project_id} недоступен: {e}")
+        if e.response_code == 404:
+            _finish(context.application, follow)
+        return
+    except Exception as e:
+        logger.error(f"Ошибка обновления pipeline {follow.pipeline_id} проекта {follow.project_id}: {e}")
+        return
+
+    if pipeline_info and _update(follow, pipeline_info):
+        _publish(follow, follow.chat_ids)
+
+    if follow.pipeline_info and follow.pipeline_info.status not in ACTIVE_STATUSES:
+        _finish(context.application, follow)
+
+
+def restore_follows(application: Application) -> int:
+    # live messages keep being edited after a restart: the dispatcher has their message ids,
+    # and the first tick fetches the pipeline once the clients are up
+    restored = 0
+    for chat_id, key in list(get_store().items(STATE_NAMESPACE)):
+        if get_user_config(chat_id):
+            _attach(application, chat_id, tuple(key), 0)
+            restored += 1
+        else:
+            get_store().delete(STATE_NAMESPACE, chat_id)
+    return restored
@@ -0,0 +1,236 @@
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+import gitlab
+
+import config
+import governor
+import metrics
+import parser
+import snapshot
+import transport
+from cache import SnapshotCache
+
+logger = logging.getLogger(__name__)
+
+GITLAB_MAX_CONCURRENCY = getattr(config, 'GITLAB_MAX_CONCURRENCY', 8)
+GITLAB_MAX_CONCURRENCY_PER_PROJECT = getattr(config, 'GITLAB_MAX_CONCURRENCY_PER_PROJECT', 2)
+CACHE_TTL = getattr(config, 'CACHE_TTL', 30)
+CACHE_MAX_ENTRIES = getattr(config, 'CACHE_MAX_ENTRIES', 256)
+JOB_TRACE_CACHE_TTL = getattr(config, 'JOB_TRACE_CACHE_TTL', 3600)
+JOB_TRACE_CACHE_ENTRIES = getattr(config, 'JOB_TRACE_CACHE_ENTRIES', 128)
+
+FINISHED_JOB_STATUSES = ('success', 'failed', 'canceled', 'skipped')
+
+snapshot_cache = SnapshotCache(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES)
+# the log of a finished job never changes, so its tail is kept much longer than snapshots
+trace_cache = SnapshotCache(ttl=JOB_TRACE_CACHE_TTL, max_entries=JOB_TRACE_CACHE_ENTRIES)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_project_semaphores: Dict[Any, asyncio.Semaphore] = {}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=GITLAB_MAX_CONCURRENCY,
+            thread_name_prefix='gitlab'
+        )
+    return _executor
+
+
+def _get_project_semaphore(project_id: Any) -> asyncio.Semaphore:
+    semaphore = _project_semaphores.get(project_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(GITLAB_MAX_CONCURRENCY_PER_PROJECT)
+        _project_semaphores[project_id] = semaphore
+    return semaphore
+
+
+async def run_gitlab(func: Callable, chat_id: int, *args, project_id: Any = None, **kwargs) -> Any:
+    # python-gitlab is synchronous: every call goes to the bounded pool so the event loop
+    # keeps serving other chats, and one slow project can't take all the workers
+    loop = asyncio.get_running_loop()
+    # run_in_executor doesn't carry contextvars over: the metrics need to know which command made the call
+    context = contextvars.copy_context()
+    call = partial(context.run, func, chat_id, *args, **kwargs)
+
+    gl = parser.get_gitlab_client(chat_id)
+    token = gl.private_token if gl else None
+    if project_id is None:
+        return await _run_governed(loop, call, context, token, project_id)
+    # a call queued behind a busy project must not hold the token's turn and slot meanwhile:
+    # the token's other projects could use them
+    async with _get_project_semaphore(project_id):
+        return await _run_governed(loop, call, context, token, project_id)
+
+
+async def _run_governed(loop: asyncio.AbstractEventLoop, call: Callable, context: contextvars.Context,
+                        token: Optional[str], project_id: Any) -> Any:
+    if token:
+        # rate limits are waited out here, executor threads only run requests that may go
+        await governor.wait_turn(token, project_id)
+        context.run(governor.prepay)
+
+    # the token's adaptive limit queues background refreshes behind commands
+    limit = governor.limit_for(token)
+    if limit is not None:
+        await limit.acquire(metrics.in_command())
+    try:
+        return await loop.run_in_executor(_get_executor(), call)
+    finally:
+        if limit is not None:
+            limit.release()
+
+
+async def init_gitlab_client(chat_id: int, gitlab_token: str, validate: bool = True) -> Optional[gitlab.Gitlab]:
+    return await run_gitlab(parser.init_gitlab_client, chat_id, gitlab_token, validate=validate)
+
+
+async def get_last_pipeline(chat_id: int, project_id: int, ref: Optional[str] = None,
+                            status: Optional[str] = None,
+                            max_age: Optional[float] = None) -> Optional[snapshot.PipelineSnapshot]:
+    async def fetch():
+        return await run_gitlab(parser.get_last_pipeline, chat_id, project_id, ref=ref, status=status,
+                                project_id=project_id)
+
+    async def probe_list(etag):
+        return await run_gitlab(parser.probe_pipelines_etag, chat_id, project_id, ref, status, etag,
+                                project_id=project_id)
+
+    async def revalidate(etag, pipeline_info):
+        # the ETag is "list jobs": the list covers a new pipeline or a status change, jobs move
+        # inside a running pipeline without either, so its jobs page is probed as well
+        list_etag, _, jobs_etag = (etag or '').partition(' ')
+        if pipeline_info.status not in snapshot.ACTIVE_STATUSES:
+            return await probe_list(list_etag or None)
+        # a running pipeline is rechecked every watch tick (max_age), a newer pipeline
+        # is still looked for once per TTL, like for a finished one
+        etags = await asyncio.gather(
+            snapshot_cache.get((project_id, 'pipelines_etag', ref, status), partial(probe_list, list_etag or None)),
+            probe_jobs_etag(chat_id, project_id, pipeline_info.id, jobs_etag or None)
+        )
+        return ' '.join(etags) if all(etags) else None
+
+    return await snapshot_cache.get(
+        (project_id, 'pipeline', ref, status),
+        fetch,
+        revalidate=revalidate,
+        max_age=max_age
+    )
+
+
+async def get_pipeline(chat_id: int, project_id: int, pipeline_id: int) -> Optional[snapshot.PipelineSnapshot]:
+    return await run_gitlab(parser.get_pipeline, chat_id, project_id, pipeline_id, project_id=project_id)
+
+
+async def probe_jobs_etag(chat_id: int, project_id: int, pipeline_id: int, etag: Optional[str] = None) -> Optional[str]:
+    return await run_gitlab(parser.probe_jobs_etag, chat_id, project_id, pipeline_id, etag, project_id=project_id)
+
+
+async def get_job_trace_tail(chat_id: int, project_id: int, job_id: int) -> Dict[str, Any]:
+    async def fetch():
+        return await run_gitlab(parser.get_job_trace_tail, chat_id, project_id, job_id, project_id=project_id)
+
+    return await trace_cache.get(
+        (project_id, 'job_trace', job_id),
+        fetch,
+        should_cache=lambda job: job['status'] in FINISHED_JOB_STATUSES
+    )
+
+
+async def get_second_last_mr_details(chat_id: int, project_id: int, policy: str = 'latest',
+                                     author: Optional[str] = None, target_branch: Optional[str] = None) -> str:
+    async def fetch():
+        return await run_gitlab(parser.get_second_last_mr_details, chat_id, project_id, policy=policy,
+                                author=author, target_branch=target_branch, project_id=project_id)
+
+    async def revalidate(etag, mr_text):
+        return await run_gitlab(parser.probe_mrs_etag, chat_id, project_id, etag, project_id=project_id)
+
+    return await snapshot_cache.get(
+        (project_id, 'mr', policy, author, target_branch),
+        fetch,
+        revalidate=revalidate,
+        should_cache=lambda text: bool(text) and not text.startswith('❌')
+    )
+
+
+async def test_gitlab_connection(chat_id: int, gitlab_token: str) -> tuple[bool, str]:
+    return await run_gitlab(parser.test_gitlab_connection, chat_id, gitlab_token)
+
+
+async def get_chat_project_ids(chat_id: int, user_config: Dict[str, Any]) -> List[int]:
+    project_ids = parser.configured_project_ids(user_config)
+
+    group_id = user_config.get('group_id')
+    if group_id:
+        async def fetch():
+            return await run_gitlab(parser.list_group_project_ids, chat_id, group_id)
+
+        group_project_ids = await snapshot_cache.get(('group', group_id, 'projects'), fetch, should_cache=bool)
+        project_ids += [project_id for project_id in group_project_ids or [] if project_id not in project_ids]
+
+    return project_ids
+
+
+async def get_latest_pipelines(chat_id: int, project_ids: List[int]) -> List[Optional[Dict[str, Any]]]:
+    # chats sharing projects share the cached per-project summaries and in-flight batches
+    async def fetch_many(keys):
+        batch_ids = [key[0] for key in keys]
+        try:
+            summaries = await run_gitlab(parser.get_latest_pipelines, chat_id, batch_ids)
+        except governor.RateLimitedError:
+            # a request per project would only dig the hole deeper
+            raise
+        except Exception as e:
+            logger.warning(f"GraphQL недоступен, запрашиваем проекты по отдельности: {e}")
+            values = await asyncio.gather(
+                *(run_gitlab(parser.get_latest_pipeline_summary, chat_id, project_id, project_id=project_id)
+                  for project_id in batch_ids),
+                return_exceptions=True
+            )
+            summaries = {
+                project_id: None if isinstance(value, BaseException) else value
+                for project_id, value in zip(batch_ids, values)
+            }
+        return {(project_id, 'latest_pipeline'): summaries.get(project_id) for project_id in batch_ids}
+
+    keys = [(project_id, 'latest_pipeline') for project_id in project_ids]
+    results = await snapshot_cache.get_many(keys, fetch_many)
+    return [results[key] for key in keys]
+
+
+def cache_stats() -> Dict[str, int]:
+    return dict(snapshot_cache.stats, size=len(snapshot_cache))
+
+
+def cache_hit_ratio() -> float:
+    stats = snapshot_cache.stats
+    # coalesced and revalidated lookups didn't cost a full fetch either
+    served = stats['hits'] + stats['coalesced'] + stats['revalidated']
+    total = served + stats['misses']
+    return served / total if total else 0.0
+
+
+metrics.registry.gauge(
+    'snapshot_cache_hit_ratio', lambda: {(): cache_hit_ratio()},
+    help_text='Share of snapshot lookups served without a full GitLab fetch'
+)
+metrics.registry.gauge(
+    'snapshot_cache_events', lambda: {(('event', name),): value for name, value in cache_stats().items()},
+    help_text='Snapshot cache counters and size'
+)
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    transport.close_session()
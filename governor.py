@@ -0,0 +1,316 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# requests per second per token until GitLab's RateLimit-* headers say otherwise, never above it;
+# gitlab.com allows 2000 per minute per user
+GITLAB_TOKEN_RATE = getattr(config, 'GITLAB_TOKEN_RATE', 30)
+GITLAB_TOKEN_BURST = getattr(config, 'GITLAB_TOKEN_BURST', 60)
+GITLAB_PROJECT_RATE = getattr(config, 'GITLAB_PROJECT_RATE', 10)
+GITLAB_PROJECT_BURST = getattr(config, 'GITLAB_PROJECT_BURST', 20)
+# calls in flight per token; halved on 429/5xx, grows back by one per round of good responses
+GITLAB_TOKEN_CONCURRENCY = getattr(config, 'GITLAB_TOKEN_CONCURRENCY', 4)
+# a command that would wait longer than this gets an error instead of hanging (seconds)
+GITLAB_RATE_LIMIT_MAX_WAIT = getattr(config, 'GITLAB_RATE_LIMIT_MAX_WAIT', 10)
+# share of the bucket background refreshes leave to commands
+BACKGROUND_RESERVE = 0.25
+
+MIN_RATE = 0.1
+DECREASE_COOLDOWN = 1.0
+
+_PROJECT_RE = re.compile(r'/projects/([^/?]+)')
+
+# worker processes sharing every token's budget, see set_workers
+_workers = 1
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"GitLab rate limit reached, try again in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RateBucket:
+    # thread-safe; callers reserve a slot and sleep until it comes, so bursts queue up in order
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, floor: float = 0.0, max_wait: Optional[float] = None) -> float:
+        # returns the wait before the request may go; past max_wait nothing is taken
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(self.paused_until - now, (floor + 1 - self.tokens) / self.rate, 0.0)
+            if max_wait is None or wait <= max_wait:
+                self.tokens -= 1
+            return wait
+
+    def charge(self) -> None:
+        # a request that can't wait where it runs still counts, the next caller waits for it
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+
+    def refund(self) -> None:
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(MIN_RATE, rate)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveLimit:
+    # AIMD concurrency for one token; waiters are woken commands first, then background refreshes
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._waiters: Tuple[Deque[asyncio.Future], Deque[asyncio.Future]] = (deque(), deque())
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    async def acquire(self, interactive: bool) -> None:
+        if self.in_flight < int(self.limit) and not (self._waiters[0] or self._waiters[1]):
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._waiters[0 if interactive else 1]
+        waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as the caller went away
+                self.release()
+            elif future in waiters:
+                # release() drops cancelled waiters itself
+                waiters.remove(future)
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        for waiters in self._waiters:
+            while waiters and self.in_flight < int(self.limit):
+                future = waiters.popleft()
+                if not future.done():
+                    self.in_flight += 1
+                    future.set_result(None)
+
+    # the two below run in executor threads, from the response hook
+    def increase(self) -> None:
+        with self._lock:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def decrease(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            # a burst of 429s is one signal, not ten
+            if now - self._decreased_at < DECREASE_COOLDOWN:
+                return
+            self._decreased_at = now
+            self.limit = max(1.0, self.limit / 2)
+
+
+class TokenGovernor:
+    def __init__(self, key: str):
+        self.key = key
+        self.bucket = RateBucket(GITLAB_TOKEN_RATE / _workers, max(1.0, GITLAB_TOKEN_BURST / _workers))
+        self.limit = AdaptiveLimit(max(1, GITLAB_TOKEN_CONCURRENCY // _workers))
+        self.remaining: Optional[int] = None
+
+    def record(self, status: int, headers) -> None:
+        remaining = _header_number(headers, 'RateLimit-Remaining')
+        reset_at = _header_number(headers, 'RateLimit-Reset')
+        if remaining is not None:
+            self.remaining = int(remaining)
+            if reset_at is not None:
+                # spread what is left of the window over the time until it resets,
+                # the other workers spend the same window
+                window = max(1.0, reset_at - time.time())
+                self.bucket.set_rate(min(GITLAB_TOKEN_RATE, remaining / window) / _workers)
+                if remaining <= 0:
+                    self.bucket.pause(window)
+
+        if status == 429:
+            retry_after = _header_number(headers, 'Retry-After')
+            if retry_after is None and reset_at is not None:
+                retry_after = reset_at - time.time()
+            self.bucket.pause(max(1.0, retry_after or 1.0))
+            self.limit.decrease()
+            logger.warning(f"GitLab 429 для токена {self.key}, лимит параллельности {self.limit.limit:.1f}")
+        elif status >= 500:
+            self.limit.decrease()
+        else:
+            self.limit.increase()
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def token_key(token: str) -> str:
+    # tokens never show up in logs or metric labels
+    return hashlib.sha256(token.encode()).hexdigest()[:8]
+
+
+def _request_token(headers) -> Optional[str]:
+    return headers.get('PRIVATE-TOKEN') or headers.get('Authorization')
+
+
+_tokens: Dict[str, TokenGovernor] = {}
+_projects: Dict[str, RateBucket] = {}
+_lock = threading.Lock()
+
+
+def set_workers(count: int) -> None:
+    # GitLab limits the token, not the process: with sharded workers each one gets its part
+    # of the rate and concurrency, like sharding.send_rate does for Telegram. Runs before any call
+    global _workers
+    _workers = max(1, count)
+    with _lock:
+        _tokens.clear()
+        _projects.clear()
+
+
+def for_token(token: str) -> TokenGovernor:
+    key = token_key(token)
+    governor = _tokens.get(key)
+    if governor is None:
+        with _lock:
+            governor = _tokens.setdefault(key, TokenGovernor(key))
+    return governor
+
+
+def _project_bucket(project: str) -> RateBucket:
+    bucket = _projects.get(project)
+    if bucket is None:
+        with _lock:
+            bucket = _projects.setdefault(project, RateBucket(GITLAB_PROJECT_RATE / _workers,
+                                                              max(1.0, GITLAB_PROJECT_BURST / _workers)))
+    return bucket
+
+
+# requests of the current call already paid for by wait_turn, see gitlab_async.run_gitlab
+_prepaid: contextvars.ContextVar = contextvars.ContextVar('gitlab_prepaid', default=None)
+
+
+def _buckets(token: str, project: Optional[str]) -> List[RateBucket]:
+    buckets = [for_token(token).bucket]
+    if project is not None:
+        buckets.append(_project_bucket(project))
+    return buckets
+
+
+def _reserve(buckets: List[RateBucket], interactive: bool) -> float:
+    max_wait = GITLAB_RATE_LIMIT_MAX_WAIT if interactive else None
+
+    wait = 0.0
+    for i, bucket in enumerate(buckets):
+        floor = 0.0 if interactive else BACKGROUND_RESERVE * bucket.capacity
+        bucket_wait = bucket.reserve(floor, max_wait)
+        if max_wait is not None and bucket_wait > max_wait:
+            for taken in buckets[:i]:
+                taken.refund()
+            metrics.registry.inc('gitlab_throttled_total', (('priority', 'interactive'), ('outcome', 'rejected')),
+                                 help_text='GitLab requests held back by the rate-limit governor')
+            raise RateLimitedError(bucket_wait)
+        wait = max(wait, bucket_wait)
+    return wait
+
+
+async def wait_turn(token: str, project: Any = None) -> None:
+    # on the event loop, before the call is handed to the executor: a throttled call waits here,
+    # not in one of the pool threads that other tokens and commands need
+    interactive = metrics.in_command()
+    wait = _reserve(_buckets(token, None if project is None else str(project)), interactive)
+    if wait > 0:
+        priority = 'interactive' if interactive else 'background'
+        metrics.registry.inc('gitlab_throttled_total', (('priority', priority), ('outcome', 'delayed')),
+                             help_text='GitLab requests held back by the rate-limit governor')
+        metrics.registry.observe('gitlab_throttle_seconds', (('priority', priority),), wait,
+                                 help_text='Time GitLab requests waited for the rate-limit governor')
+        await asyncio.sleep(wait)
+
+
+def prepay() -> None:
+    # run inside the call's context: its first request was paid for by wait_turn
+    _prepaid.set([1])
+
+
+def before_request(request) -> None:
+    # runs in the executor thread right before a request leaves, see transport.GovernedAdapter.
+    # Only the first request of a call is paced (by wait_turn, on the event loop). This never
+    # sleeps: later pages of a listing go out at once, over the limit if the buckets are empty,
+    # and are paid back by the calls that come after them, which wait longer in wait_turn.
+    # A command still gives up once that debt is more than GITLAB_RATE_LIMIT_MAX_WAIT deep
+    token = _request_token(request.headers)
+    if not token:
+        return
+    prepaid = _prepaid.get()
+    if prepaid and prepaid[0] > 0:
+        prepaid[0] -= 1
+        return
+
+    match = _PROJECT_RE.search(request.path_url)
+    buckets = _buckets(token, match.group(1) if match else None)
+    if metrics.in_command():
+        _reserve(buckets, True)
+    else:
+        for bucket in buckets:
+            bucket.charge()
+
+
+def record_response(response, *args, **kwargs) -> None:
+    # requests response hook on the shared GitLab session
+    token = _request_token(response.request.headers)
+    if token:
+        for_token(token).record(response.status_code, response.headers)
+
+
+def limit_for(token: Optional[str]) -> Optional[AdaptiveLimit]:
+    return for_token(token).limit if token else None
+
+
+def _governor_metrics() -> Dict[Tuple, float]:
+    values = {}
+    for key, governor in list(_tokens.items()):
+        values[(('token', key), ('value', 'concurrency_limit'))] = governor.limit.limit
+        values[(('token', key), ('value', 'in_flight'))] = governor.limit.in_flight
+        values[(('token', key), ('value', 'rate'))] = governor.bucket.rate
+        if governor.remaining is not None:
+            values[(('token', key), ('value', 'remaining'))] = governor.remaining
+    return values
+
+
+metrics.registry.gauge('gitlab_token_governor', _governor_metrics,
+                       help_text='Per-token adaptive concurrency, request rate and GitLab RateLimit-Remaining')
@@ -0,0 +1,131 @@
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+import config
+import metrics
+
+LOG_FORMAT = getattr(config, 'LOG_FORMAT', 'json')
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+LOG_LEVELS = getattr(config, 'LOG_LEVELS', {'httpx': 'WARNING', 'apscheduler': 'WARNING'})
+LOG_QUEUE_SIZE = getattr(config, 'LOG_QUEUE_SIZE', 10000)
+LOG_MESSAGE_SAMPLE_RATE = getattr(config, 'LOG_MESSAGE_SAMPLE_RATE', 0.1)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# LogRecord attributes, everything else on a record came from extra={...}
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_FIELDS:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    # the fields passed in extra={...} (chat_id, username, ...) follow the message as key=value
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        text = super().formatMessage(record)
+        fields = ' '.join(
+            f"{name}={value}" for name, value in vars(record).items()
+            if name not in _RECORD_FIELDS and value is not None
+        )
+        return f"{text} [{fields}]" if fields else text
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    # a full queue drops the record instead of blocking the event loop
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.registry.inc('log_records_dropped_total', help_text='Log records dropped on a full queue')
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # args and tracebacks may change after the call returns, so they are rendered now;
+        # the JSON and the write are left to the listener thread
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class Sampler:
+    # lets through every n-th call, so a busy group chat costs one record per n messages
+    def __init__(self, rate: float):
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> int:
+        # returns how many calls this record stands for, 0 when it should be skipped
+        if not self.every:
+            return 0
+        with self._lock:
+            self._count += 1
+            if self._count < self.every:
+                return 0
+            self._count = 0
+        return self.every
+
+
+message_sampler = Sampler(LOG_MESSAGE_SAMPLE_RATE)
+
+
+def setup_logging(stream=None) -> None:
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+
+    # stdout writes happen on the listener thread, never in a handler
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    global _listener
+    if _listener is not None:
+        # drains what is still queued
+        _listener.stop()
+        _listener = None
@@ -1,56 +1,129 @@
+import argparse
+import asyncio
 import logging
-from datetime import datetime
+import gitlab
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
-from config import TELEGRAM_BOT_TOKEN, USER_CONFIG, get_user_config, get_all_chat_ids
-from parser import (init_gitlab_client, get_last_pipeline, format_pipeline_message, get_second_last_mr_details,
-                    test_gitlab_connection)
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+import config
+from config import TELEGRAM_BOT_TOKEN
+from chat_registry import registry, get_user_config, get_all_chat_ids, CONFIG_RELOAD_INTERVAL
+from parser import init_gitlab_client, release_chat, get_gitlab_client, format_pipeline_message, configured_project_ids
+from render import PARSE_MODE, TEMPLATES, split_message, escape, render_pipelines_overview, render_job
+import gitlab_async
+import governor
+import watcher
+import follow
+import webhook
+import sender
+import state_store
+import metrics
+import log_setup
+import sharding
+import work_queue
+from parser import note_index
+
 logger = logging.getLogger(__name__)
+# one record per incoming message/command, can be silenced with LOG_LEVELS = {'chat': 'WARNING'}
+chat_logger = logging.getLogger('chat')
+
+GITLAB_INIT_TIMEOUT = getattr(config, 'GITLAB_INIT_TIMEOUT', 15)
+GITLAB_VALIDATE_ON_FIRST_USE = getattr(config, 'GITLAB_VALIDATE_ON_FIRST_USE', False)
+JOB_MAX_SHOWN = getattr(config, 'JOB_MAX_SHOWN', 3)
+
+
+async def init_all_gitlab_clients(chats_by_token=None):
+    if chats_by_token is None:
+        chats_by_token = registry.chats_by_token()
+    chats_by_token.pop('ВАШ_GITLAB_TOKEN_ЗДЕСЬ', None)
+
+    async def init_token(gitlab_token, chat_ids):
+        try:
+            client = await asyncio.wait_for(
+                gitlab_async.init_gitlab_client(
+                    chat_ids[0],
+                    gitlab_token,
+                    validate=not GITLAB_VALIDATE_ON_FIRST_USE
+                ),
+                GITLAB_INIT_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            client = None
 
+        if not client:
+            for chat_id in chat_ids:
+                logger.error(f"Не удалось инициализировать GitLab для chat_id: {chat_id}")
+            return 0
 
-def init_all_gitlab_clients():
-    initialized = 0
-    failed = 0
+        # the rest of the chats reuse the pooled client, no extra auth round-trip
+        for chat_id in chat_ids[1:]:
+            init_gitlab_client(chat_id, gitlab_token, validate=False)
+        return len(chat_ids)
 
-    for chat_id in get_all_chat_ids():
-        user_config = get_user_config(chat_id)
-        if user_config:
-            gitlab_token = user_config.get('gitlab_token')
-            if gitlab_token and gitlab_token != 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ':
-                client = init_gitlab_client(chat_id, gitlab_token)
-                if client:
-                    initialized += 1
-                else:
-                    failed += 1
-                    logger.error(f"Не удалось инициализировать GitLab для chat_id: {chat_id}")
+    results = await asyncio.gather(*(init_token(token, chat_ids) for token, chat_ids in chats_by_token.items()))
+    initialized = sum(results)
+    failed = sum(len(chat_ids) for chat_ids in chats_by_token.values()) - initialized
 
+    logger.info(f"GitLab clients: {initialized} initialized, {failed} failed, {len(chats_by_token)} sessions")
     return initialized, failed
 
 
-def log_chat_info(update: Update, command: str = None):
-    user = update.effective_user
-    chat_id = update.effective_chat.id
+async def apply_config_changes(application: Application, diff) -> None:
+    # only chats whose entries changed are touched, the other clients and watchers keep running
+    for chat_id in diff.removed:
+        watcher.stop_watch(application, chat_id)
+        follow.stop_follow(application, chat_id)
+        release_chat(chat_id)
 
-    timestamp = datetime.now().strftime('%H:%M:%S')
+    chats_by_token = {}
+    for chat_id in diff.added + diff.changed:
+        user_config = get_user_config(chat_id)
+        gitlab_token = user_config.get('gitlab_token')
+        gl = get_gitlab_client(chat_id)
+        if gl is None or gl.private_token != gitlab_token:
+            release_chat(chat_id)
+            if gitlab_token:
+                chats_by_token.setdefault(gitlab_token, []).append(chat_id)
+        if user_config.get('watch'):
+            watcher.start_watch(application, chat_id)
+    for chat_id in diff.unwatched:
+        watcher.stop_watch(application, chat_id)
+
+    if chats_by_token:
+        await init_all_gitlab_clients(chats_by_token)
+
+
+async def config_reload_job(context: ContextTypes.DEFAULT_TYPE):
+    if not registry.changed_on_disk():
+        return
+    diff = registry.reload()
+    if diff:
+        await apply_config_changes(context.application, diff)
 
-    username = user.username or "no_username"
-    first_name = user.first_name or ""
 
-    if command:
-        print(f"{timestamp} - {username} - {first_name} - {chat_id} - {command}")
-    else:
-        print(f"{timestamp} - {username} - {first_name} - {chat_id}")
+def chat_fields(update: Update) -> dict:
+    user = update.effective_user
+    chat = update.effective_chat
+    return {
+        'chat_id': chat.id if chat else None,
+        'username': (user.username if user else None) or "no_username",
+        'first_name': (user.first_name if user else None) or "",
+    }
+
+
+def log_chat_info(update: Update, command: str = None, **fields):
+    # the record goes to the logging queue, the write happens off the event loop
+    if chat_logger.isEnabledFor(logging.INFO):
+        chat_logger.info(command or 'message', extra={**chat_fields(update), 'command': command, **fields})
 
 
 async def log_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log_chat_info(update)
+    # group chats can be busy: only a sample of plain messages is logged
+    represents = log_setup.message_sampler()
+    if represents:
+        log_chat_info(update, sampled=represents)
 
 
+@metrics.instrument_command('pipeline')
 async def pipeline_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_chat_info(update, "/pipeline")
 
@@ -62,34 +135,53 @@ async def pipeline_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     gitlab_token = user_config.get('gitlab_token')
-    project_id = user_config.get('project_id')
 
     if not gitlab_token or gitlab_token == 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ':
         await update.message.reply_text("❌ GitLab token not configured")
         return
 
-    if not project_id:
+    if not (user_config.get('project_id') or user_config.get('project_ids') or user_config.get('group_id')):
         await update.message.reply_text("❌ Project ID not configured")
         return
 
-    from parser import get_gitlab_client
     if not get_gitlab_client(chat_id):
-        client = init_gitlab_client(chat_id, gitlab_token)
+        client = await gitlab_async.init_gitlab_client(chat_id, gitlab_token)
         if not client:
             await update.message.reply_text("❌ Failed to initialize GitLab client")
             return
 
     try:
-        pipeline_info = get_last_pipeline(chat_id, project_id)
+        project_ids = await gitlab_async.get_chat_project_ids(chat_id, user_config)
+        if not project_ids:
+            await update.message.reply_text("❌ No projects found")
+            return
+
+        if len(project_ids) > 1:
+            summaries = await gitlab_async.get_latest_pipelines(chat_id, project_ids)
+            for chunk in split_message(render_pipelines_overview(summaries)):
+                await update.message.reply_text(
+                    chunk,
+                    parse_mode=PARSE_MODE,
+                    disable_web_page_preview=True
+                )
+            return
+
+        pipeline_info = await gitlab_async.get_last_pipeline(
+            chat_id,
+            project_ids[0],
+            ref=user_config.get('ref'),
+            status=user_config.get('pipeline_status')
+        )
 
         if pipeline_info:
             message = format_pipeline_message(pipeline_info)
 
-            await update.message.reply_text(
-                message,
-                parse_mode='Markdown',
-                disable_web_page_preview=False
-            )
+            for chunk in split_message(message):
+                await update.message.reply_text(
+                    chunk,
+                    parse_mode=PARSE_MODE,
+                    disable_web_page_preview=False
+                )
         else:
             await update.message.reply_text("❌ No pipeline found")
 
@@ -100,6 +192,7 @@ async def pipeline_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@metrics.instrument_command('mr')
 async def mr_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_chat_info(update, "/mr")
 
@@ -111,31 +204,52 @@ async def mr_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     gitlab_token = user_config.get('gitlab_token')
-    project_id = user_config.get('project_id')
 
     if not gitlab_token or gitlab_token == 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ':
         await update.message.reply_text("❌ GitLab token not configured")
         return
 
-    if not project_id:
+    if not (user_config.get('project_id') or user_config.get('project_ids') or user_config.get('group_id')):
         await update.message.reply_text("❌ Project ID not configured")
         return
 
-    from parser import get_gitlab_client
     if not get_gitlab_client(chat_id):
-        client = init_gitlab_client(chat_id, gitlab_token)
+        client = await gitlab_async.init_gitlab_client(chat_id, gitlab_token)
         if not client:
             await update.message.reply_text("❌ Failed to initialize GitLab client")
             return
 
     try:
-        mr_info = get_second_last_mr_details(chat_id, project_id)
+        project_ids = await gitlab_async.get_chat_project_ids(chat_id, user_config)
+        if not project_ids:
+            await update.message.reply_text("❌ No projects found")
+            return
 
-        await update.message.reply_text(
-            mr_info,
-            parse_mode='Markdown',
-            disable_web_page_preview=False
-        )
+        mr_infos = await asyncio.gather(*(
+            gitlab_async.get_second_last_mr_details(
+                chat_id,
+                project_id,
+                policy=user_config.get('mr_policy', 'latest'),
+                author=user_config.get('mr_author'),
+                target_branch=user_config.get('mr_target_branch')
+            )
+            for project_id in project_ids
+        ))
+
+        if len(mr_infos) == 1:
+            mr_info = mr_infos[0]
+            # errors come back as plain text
+            parse_mode = None if mr_info.startswith('❌') else PARSE_MODE
+        else:
+            mr_info = '\n\n'.join(escape(text) if text.startswith('❌') else text for text in mr_infos)
+            parse_mode = PARSE_MODE
+
+        for chunk in split_message(mr_info):
+            await update.message.reply_text(
+                chunk,
+                parse_mode=parse_mode,
+                disable_web_page_preview=False
+            )
 
     except Exception as e:
         logger.error(f"Error in mr_command for chat_id {chat_id}: {e}")
@@ -144,6 +258,7 @@ async def mr_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@metrics.instrument_command('chatid')
 async def chatid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_chat_info(update, "/chatid")
 
@@ -151,6 +266,7 @@ async def chatid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Chat ID: `{chat_id}`", parse_mode='Markdown')
 
 
+@metrics.instrument_command('status')
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_chat_info(update, "/status")
 
@@ -159,9 +275,10 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_config = get_user_config(chat_id)
     if user_config:
         gitlab_token = user_config.get('gitlab_token', '')
-        project_id = user_config.get('project_id', '')
+        project_id = ', '.join(str(project_id) for project_id in configured_project_ids(user_config))
+        if user_config.get('group_id'):
+            project_id += f" (group {user_config['group_id']})"
 
-        from parser import get_gitlab_client
         gitlab_client = get_gitlab_client(chat_id)
 
         status_msg = (
@@ -170,8 +287,22 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"GitLab client: {'✅ Initialized' if gitlab_client else '❌ Not initialized'}"
         )
 
+        stats = gitlab_async.cache_stats()
+        status_msg += (
+            f"\n\nCache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['coalesced']} coalesced, {stats['revalidated']} revalidated ({stats['size']} entries)"
+        )
+
+        dispatcher = sender.get_dispatcher()
+        if dispatcher:
+            latency = dispatcher.latency_stats()
+            status_msg += (
+                f"\nSend queue: {dispatcher.queue_depth()} pending, "
+                f"latency p50 {latency['p50']:.2f}s / p99 {latency['p99']:.2f}s"
+            )
+
         if gitlab_token and gitlab_token != 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ' and not gitlab_client:
-            success, message = test_gitlab_connection(chat_id, gitlab_token)
+            success, message = await gitlab_async.test_gitlab_connection(chat_id, gitlab_token)
             status_msg += f"\n\nConnection test: {message}"
     else:
         status_msg = "❌ Chat not configured"
@@ -179,6 +310,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(status_msg)
 
 
+@metrics.instrument_command('test')
 async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_chat_info(update, "/test")
 
@@ -196,72 +328,373 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("🔄 Testing GitLab connection...")
 
-    success, message = test_gitlab_connection(chat_id, gitlab_token)
+    success, message = await gitlab_async.test_gitlab_connection(chat_id, gitlab_token)
     await update.message.reply_text(message)
 
 
-async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log_chat_info(update, "UNKNOWN_CMD")
-    await update.message.reply_text("❌ Unknown command. Use /help for available commands.")
+@metrics.instrument_command('watch')
+async def watch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "/watch")
 
+    chat_id = update.effective_chat.id
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    # like /pipeline and /mr, project_ids and group_id are enough
+    if not watcher.watches_projects(get_user_config(chat_id)):
+        await update.message.reply_text("❌ Chat not configured")
+        return
 
-    if update and update.message:
-        if update.effective_user:
-            user = update.effective_user
-            timestamp = datetime.now().strftime('%H:%M:%S')
-            username = user.username or "no_username"
-            first_name = user.first_name or ""
-            chat_id = update.effective_chat.id
-            print(f"{timestamp} - {username} - {first_name} - {chat_id} - ERROR: {context.error}")
+    if watcher.start_watch(context.application, chat_id, announce=True):
+        await update.message.reply_text("👀 Watching pipeline and MR updates")
+    else:
+        await update.message.reply_text("👀 Already watching")
 
-        await update.message.reply_text("❌ Error occurred")
 
+@metrics.instrument_command('unwatch')
+async def unwatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "/unwatch")
 
-def main():
-    if TELEGRAM_BOT_TOKEN == "ВАШ_TELEGRAM_BOT_TOKEN_ЗДЕСЬ":
-        print("=" * 50)
-        print("❌ ОШИБКА: Токен Telegram бота не установлен!")
-        print("   Замените 'ВАШ_TELEGRAM_BOT_TOKEN_ЗДЕСЬ' в config.py")
-        print("   на ваш реальный токен от @BotFather")
-        print("=" * 50)
+    chat_id = update.effective_chat.id
+
+    if watcher.stop_watch(context.application, chat_id):
+        await update.message.reply_text("🔕 Watching stopped")
+    else:
+        await update.message.reply_text("❌ Not watching")
+
+
+@metrics.instrument_command('job')
+async def job_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "/job")
+
+    chat_id = update.effective_chat.id
+
+    user_config = get_user_config(chat_id)
+    if not user_config:
+        await update.message.reply_text("❌ Chat not configured")
         return
 
-    print("🔄 Инициализация GitLab клиентов...")
-    initialized, failed = init_all_gitlab_clients()
+    gitlab_token = user_config.get('gitlab_token')
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if not gitlab_token or gitlab_token == 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ':
+        await update.message.reply_text("❌ GitLab token not configured")
+        return
+
+    if not get_gitlab_client(chat_id):
+        client = await gitlab_async.init_gitlab_client(chat_id, gitlab_token)
+        if not client:
+            await update.message.reply_text("❌ Failed to initialize GitLab client")
+            return
+
+    if context.args and not context.args[0].isdigit():
+        await update.message.reply_text("❌ Usage: /job [job_id]")
+        return
+
+    try:
+        project_ids = await gitlab_async.get_chat_project_ids(chat_id, user_config)
+        if not project_ids:
+            await update.message.reply_text("❌ No projects found")
+            return
+        project_id = project_ids[0]
+
+        # /job <id> shows that job, plain /job the failed jobs of the latest pipeline
+        footer = ''
+        if context.args:
+            job_ids = [int(context.args[0])]
+        else:
+            pipeline_info = await gitlab_async.get_last_pipeline(
+                chat_id,
+                project_id,
+                ref=user_config.get('ref'),
+                status=user_config.get('pipeline_status')
+            )
+            if not pipeline_info:
+                await update.message.reply_text("❌ No pipeline found")
+                return
+
+            failed_jobs = pipeline_info.failed_jobs
+            if not failed_jobs:
+                await update.message.reply_text(
+                    TEMPLATES[PARSE_MODE]['jobs_none'].format(id=pipeline_info.id),
+                    parse_mode=PARSE_MODE
+                )
+                return
+
+            job_ids = [job.id for job in failed_jobs[:JOB_MAX_SHOWN]]
+            if len(failed_jobs) > JOB_MAX_SHOWN:
+                footer = TEMPLATES[PARSE_MODE]['jobs_more'].format(
+                    count=len(failed_jobs) - JOB_MAX_SHOWN,
+                    id=pipeline_info.id
+                )
+
+        jobs = await asyncio.gather(
+            *(gitlab_async.get_job_trace_tail(chat_id, project_id, job_id) for job_id in job_ids),
+            return_exceptions=True
+        )
+        for job_id, job in zip(job_ids, jobs):
+            if isinstance(job, gitlab.exceptions.GitlabGetError):
+                await update.message.reply_text(f"❌ Job {job_id} not found")
+                continue
+            if isinstance(job, Exception):
+                raise job
+            await update.message.reply_text(
+                render_job(job, footer=footer if job_id == job_ids[-1] else ''),
+                parse_mode=PARSE_MODE,
+                disable_web_page_preview=True
+            )
 
+    except Exception as e:
+        logger.error(f"Error in job_command for chat_id {chat_id}: {e}")
+        await update.message.reply_text(
+            f"❌ Error: {str(e)[:200]}"
+        )
+
+
+@metrics.instrument_command('follow')
+async def follow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "/follow")
+
+    chat_id = update.effective_chat.id
+
+    user_config = get_user_config(chat_id)
+    if not user_config:
+        await update.message.reply_text("❌ Chat not configured")
+        return
+
+    gitlab_token = user_config.get('gitlab_token')
+
+    if not gitlab_token or gitlab_token == 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ':
+        await update.message.reply_text("❌ GitLab token not configured")
+        return
+
+    if not get_gitlab_client(chat_id):
+        client = await gitlab_async.init_gitlab_client(chat_id, gitlab_token)
+        if not client:
+            await update.message.reply_text("❌ Failed to initialize GitLab client")
+            return
+
+    try:
+        project_ids = await gitlab_async.get_chat_project_ids(chat_id, user_config)
+        if not project_ids:
+            await update.message.reply_text("❌ No projects found")
+            return
+
+        # /follow <project_id> picks one of the chat's projects, the main one by default
+        project_id = project_ids[0]
+        if context.args:
+            if not context.args[0].isdigit() or int(context.args[0]) not in project_ids:
+                await update.message.reply_text("❌ Project is not configured for this chat")
+                return
+            project_id = int(context.args[0])
+
+        pipeline_info = await gitlab_async.get_last_pipeline(
+            chat_id,
+            project_id,
+            ref=user_config.get('ref'),
+            status=user_config.get('pipeline_status')
+        )
+        if not pipeline_info:
+            await update.message.reply_text("❌ No pipeline found")
+            return
+
+        # the live message itself goes through the dispatcher and is edited from then on
+        if not follow.start_follow(context.application, chat_id, project_id, pipeline_info):
+            await update.message.reply_text(f"👀 Already following pipeline #{pipeline_info.id}")
+
+    except Exception as e:
+        logger.error(f"Error in follow_command for chat_id {chat_id}: {e}")
+        await update.message.reply_text(
+            f"❌ Error: {str(e)[:200]}"
+        )
+
+
+@metrics.instrument_command('unfollow')
+async def unfollow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "/unfollow")
+
+    chat_id = update.effective_chat.id
+
+    if follow.stop_follow(context.application, chat_id):
+        await update.message.reply_text("🔕 Live pipeline message stopped")
+    else:
+        await update.message.reply_text("❌ Not following")
+
+
+@metrics.instrument_command('metrics')
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "/metrics")
+
+    chat_id = update.effective_chat.id
+    if not metrics.is_admin(chat_id):
+        await update.message.reply_text("❌ Not allowed")
+        return
+
+    dispatcher = sender.get_dispatcher()
+    lines = metrics.summary_lines()
+    lines.append(f"Cache hit ratio: {gitlab_async.cache_hit_ratio():.0%}")
+    if dispatcher:
+        lines.append(f"Send queue: {dispatcher.queue_depth()}")
+
+    for chunk in split_message('\n'.join(lines)):
+        await update.message.reply_text(chunk)
+
+
+async def post_init(application: Application):
+    # clients are authenticated in the background so polling starts right away
+    application.create_task(init_all_gitlab_clients())
+
+    # warm start: cached snapshots, note digests, watchers and message ids come back from disk
+    store = state_store.get_store()
+    restored = gitlab_async.snapshot_cache.attach_store(store)
+    note_index.attach_store(store)
+    logger.info(f"Восстановлено снимков из хранилища: {restored}")
+    application.job_queue.run_repeating(state_store.flush_job, state_store.STATE_FLUSH_INTERVAL)
+
+    if registry.path:
+        application.job_queue.run_repeating(config_reload_job, CONFIG_RELOAD_INTERVAL)
+
+    sender.start_dispatcher(application.bot, state=store, global_rate=sharding.send_rate())
+    await watcher.start_configured_watches(application)
+    logger.info(f"Восстановлено живых сообщений pipeline: {follow.restore_follows(application)}")
+    # workers take webhook events from the queue, the HTTP port belongs to the ingest process
+    if not sharding.is_worker():
+        await webhook.start_webhook_server(application)
+
+
+async def post_shutdown(application: Application):
+    # webhook events already acknowledged still go through the dispatcher
+    await webhook.stop_webhook_server()
+    await sender.stop_dispatcher()
+    state_store.close_store()
+
+
+async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_chat_info(update, "UNKNOWN_CMD")
+    await update.message.reply_text("❌ Unknown command. Use /help for available commands.")
+
+
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fields = chat_fields(update) if isinstance(update, Update) else {}
+    logger.error(f"Ошибка обработки update: {context.error}", exc_info=context.error, extra=fields)
+
+    if isinstance(update, Update) and update.message:
+        if isinstance(context.error, governor.RateLimitedError):
+            await update.message.reply_text(f"❌ {context.error}")
+        else:
+            await update.message.reply_text("❌ Error occurred")
+
+
+def register_handlers(application: Application):
     application.add_handler(CommandHandler("pipeline", pipeline_command))
     application.add_handler(CommandHandler("mr", mr_command))
     application.add_handler(CommandHandler("chatid", chatid_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("test", test_command))
+    application.add_handler(CommandHandler("watch", watch_command))
+    application.add_handler(CommandHandler("unwatch", unwatch_command))
+    application.add_handler(CommandHandler("job", job_command))
+    application.add_handler(CommandHandler("follow", follow_command))
+    application.add_handler(CommandHandler("unfollow", unfollow_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
 
     application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
     application.add_handler(MessageHandler(filters.ALL, log_all_messages))
     application.add_error_handler(error_handler)
 
+
+def parse_args(argv=None):
+    arg_parser = argparse.ArgumentParser(description='GitLab notifier bot')
+    arg_parser.add_argument('--role', choices=('all', 'ingest', 'worker'), default='all',
+                            help='all: one process does everything; ingest: receive updates and webhooks '
+                                 'and queue them; worker: handle the chats of one shard')
+    arg_parser.add_argument('--shard', type=sharding.parse_shard, help='i/N, the shard of a worker')
+    arg_parser.add_argument('--shards', type=int, help='number of workers the ingest process routes to')
+    args = arg_parser.parse_args(argv)
+    if args.role == 'worker' and not args.shard:
+        arg_parser.error('--role worker needs --shard i/N')
+    if args.role == 'ingest' and not (args.shards and args.shards > 0):
+        arg_parser.error('--role ingest needs --shards N')
+    return args
+
+
+def build_application(args) -> Application:
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+    if args.role == 'ingest':
+        application = (
+            builder
+            .post_init(sharding.ingest_post_init)
+            .post_shutdown(sharding.ingest_post_shutdown)
+            .build()
+        )
+        sharding.register_ingest(application, args.shards)
+        return application
+
+    if args.role == 'worker':
+        sharding.configure_worker(*args.shard)
+        # updates come from the queue, getUpdates stays with the ingest process
+        builder = builder.updater(None)
+
+    application = (
+        builder
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    register_handlers(application)
+    return application
+
+
+def main(argv=None):
+    if TELEGRAM_BOT_TOKEN == "ВАШ_TELEGRAM_BOT_TOKEN_ЗДЕСЬ":
+        print("=" * 50)
+        print("❌ ОШИБКА: Токен Telegram бота не установлен!")
+        print("   Замените 'ВАШ_TELEGRAM_BOT_TOKEN_ЗДЕСЬ' в config.py")
+        print("   на ваш реальный токен от @BotFather")
+        print("=" * 50)
+        return
+
+    args = parse_args(argv)
+    if webhook.WEBHOOK_ENABLED and not webhook.WEBHOOK_SECRET and args.role != 'worker':
+        print("❌ ОШИБКА: WEBHOOK_ENABLED включен, но WEBHOOK_SECRET в config.py пустой")
+        return
+
+    log_setup.setup_logging()
+    application = build_application(args)
+
     # Запускаем бота
     print("=" * 50)
     print("🤖 Technical GitLab Bot Started")
     print("=" * 50)
-    print(f"Configured chats: {len(USER_CONFIG)}")
-    print(f"GitLab clients: ✅ {initialized} initialized, ❌ {failed} failed")
-    print("\nLog format: [time - username - first_name - chat_id]")
+    print(f"Configured chats: {len(get_all_chat_ids())}" + (f" ({registry.path}, reloaded on change)" if registry.path else ""))
+    print("GitLab clients: 🔄 initializing in background")
+    if args.role == 'ingest':
+        print(f"Role: ingest, routing to {args.shards} workers through {work_queue.WORK_QUEUE_PATH}")
+    elif args.role == 'worker':
+        print(f"Role: worker {args.shard[0]}/{args.shard[1]}, state in {state_store.STATE_PATH}")
+    print(f"\nLog format: {log_setup.LOG_FORMAT}, chat messages sampled at {log_setup.LOG_MESSAGE_SAMPLE_RATE:.0%}")
     print("\nAvailable commands:")
     print("  /pipeline - последний pipeline")
     print("  /mr - предпоследний merge request")
     print("  /chatid - показать chat id")
     print("  /status - статус конфигурации")
     print("  /test - тест подключения к GitLab")
-    print("\n⚠️  Все сообщения логируются в терминал")
+    print("  /watch - следить за pipeline и MR")
+    print("  /unwatch - перестать следить")
+    print("  /job [id] - хвост лога упавших job")
+    print("  /follow - живое сообщение о текущем pipeline")
+    print("  /unfollow - остановить живое сообщение")
+    print("  /metrics - задержки и число запросов (только админы)")
+    print("\n⚠️  Команды логируются в терминал, обычные сообщения выборочно")
     print("=" * 50)
 
-    application.run_polling()
+    try:
+        if args.role == 'worker':
+            asyncio.run(sharding.run_worker(application))
+        else:
+            application.run_polling()
+    finally:
+        gitlab_async.shutdown()
+        log_setup.stop_logging()
 
 
 if __name__ == '__main__':
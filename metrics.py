@@ -0,0 +1,236 @@
+import contextvars
+import functools
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import config
+
+ADMIN_CHAT_IDS = getattr(config, 'ADMIN_CHAT_IDS', [])
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CALL_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+# GitLab requests made on behalf of the current command; copied into executor threads
+_command_calls: contextvars.ContextVar = contextvars.ContextVar('command_calls', default=None)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the quantile, good enough for a chat summary
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        # gauges are read at export time from callbacks returning {labels: value}
+        self._gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1, help_text: str = '') -> None:
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+            self._help.setdefault(name, help_text)
+
+    def observe(self, name: str, labels: Labels, value: float, buckets: Tuple[float, ...] = BUCKETS,
+                help_text: str = '') -> None:
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(buckets)
+            histogram.observe(value)
+            self._help.setdefault(name, help_text)
+
+    def gauge(self, name: str, callback: Callable[[], Dict[Labels, float]], help_text: str = '') -> None:
+        self._gauges[name] = callback
+        self._help[name] = help_text
+
+    def counters(self, name: str) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def histograms(self, name: str) -> Dict[Labels, Histogram]:
+        with self._lock:
+            return dict(self._histograms.get(name, {}))
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def header(name, kind):
+            if self._help.get(name):
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {labels: (h.buckets, list(h.counts), h.total, h.count) for labels, h in series.items()}
+                for name, series in self._histograms.items()
+            }
+
+        for name, series in sorted(counters.items()):
+            header(name, 'counter')
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+        for name, series in sorted(histograms.items()):
+            header(name, 'histogram')
+            for labels, (buckets, counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for name, callback in sorted(self._gauges.items()):
+            header(name, 'gauge')
+            for labels, value in callback().items():
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for key, value in labels)
+    return f"{{{pairs}}}"
+
+
+registry = Registry()
+
+
+def endpoint_name(method: str, url: str) -> str:
+    # /api/v4/projects/422/pipelines/31/jobs -> GET /projects/:id/pipelines/:id/jobs
+    path = url.split('?', 1)[0].split('://', 1)[-1]
+    path = path[path.find('/'):] if '/' in path else '/'
+    path = path.split('/api/v4', 1)[-1]
+    return f"{method.upper()} {_ID_SEGMENT.sub('/:id', path)}"
+
+
+def record_gitlab_response(response, *args, **kwargs) -> None:
+    # requests response hook on the shared GitLab session
+    endpoint = endpoint_name(response.request.method, response.request.url)
+    labels = (('endpoint', endpoint),)
+    registry.observe('gitlab_request_seconds', labels, response.elapsed.total_seconds(),
+                     help_text='GitLab API request latency')
+    registry.inc('gitlab_requests_total', labels + (('status', f"{response.status_code // 100}xx"),),
+                 help_text='GitLab API requests by endpoint and status class')
+
+    calls = _command_calls.get()
+    if calls is not None:
+        calls[0] += 1
+
+
+def in_command() -> bool:
+    # true inside a command handler and the GitLab calls it makes, false for background jobs
+    return _command_calls.get() is not None
+
+
+def timed(function_name: str) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                registry.inc('gitlab_function_errors_total', (('function', function_name),),
+                             help_text='Exceptions raised by parser functions')
+                raise
+            finally:
+                registry.observe('gitlab_function_seconds', (('function', function_name),),
+                                 time.perf_counter() - started_at, help_text='Parser function latency')
+        return wrapper
+    return decorator
+
+
+def instrument_command(command: str) -> Callable:
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            labels = (('command', command),)
+            calls = [0]
+            token = _command_calls.set(calls)
+            started_at = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception:
+                registry.inc('bot_command_errors_total', labels, help_text='Commands that raised')
+                raise
+            finally:
+                _command_calls.reset(token)
+                registry.observe('bot_command_seconds', labels, time.perf_counter() - started_at,
+                                 help_text='Command handling latency')
+                registry.observe('bot_command_gitlab_calls', labels, calls[0], buckets=CALL_BUCKETS,
+                                 help_text='GitLab requests made while handling a command')
+                registry.inc('bot_commands_total', labels, help_text='Handled commands')
+        return wrapper
+    return decorator
+
+
+def is_admin(chat_id: int) -> bool:
+    return chat_id in ADMIN_CHAT_IDS
+
+
+def summary_lines(limit: int = 10) -> List[str]:
+    lines = ['Commands:']
+    calls_by_command = registry.histograms('bot_command_gitlab_calls')
+    errors = registry.counters('bot_command_errors_total')
+    for labels, histogram in sorted(registry.histograms('bot_command_seconds').items()):
+        calls = calls_by_command.get(labels)
+        avg_calls = calls.total / calls.count if calls and calls.count else 0
+        lines.append(
+            f"  /{labels[0][1]}: {histogram.count} runs, {int(errors.get(labels, 0))} errors, "
+            f"avg {histogram.total / histogram.count * 1000:.0f} ms, p99 ≤ {histogram.quantile(0.99) * 1000:.0f} ms, "
+            f"{avg_calls:.1f} GitLab requests"
+        )
+
+    lines.append('GitLab endpoints:')
+    endpoints = sorted(registry.histograms('gitlab_request_seconds').items(), key=lambda item: -item[1].count)
+    for labels, histogram in endpoints[:limit]:
+        lines.append(
+            f"  {labels[0][1]}: {histogram.count} requests, avg {histogram.total / histogram.count * 1000:.0f} ms"
+        )
+
+    failed = sum(value for labels, value in registry.counters('gitlab_requests_total').items()
+                 if dict(labels).get('status') not in ('2xx', '3xx'))
+    lines.append(f"GitLab errors: {int(failed)}")
+    return lines
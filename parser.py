@@ -1,36 +1,105 @@
 import gitlab
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+from datetime import datetime
 import logging
+import re
+import threading
+import config
+import governor
+import metrics
+import transport
+import render
+import snapshot
+from review_notes import NoteIndex
 from config import GITLAB_URL
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 gitlab_clients = {}
+_clients_by_token: Dict[str, gitlab.Gitlab] = {}
+_unvalidated_tokens = set()
+_clients_lock = threading.Lock()
 
+GITLAB_TIMEOUT = getattr(config, 'GITLAB_TIMEOUT', 10)
 
-def init_gitlab_client(chat_id: int, gitlab_token: str) -> Optional[gitlab.Gitlab]:
+MR_NOTES_LIMIT = getattr(config, 'MR_NOTES_LIMIT', 100)
+MR_POLICIES = ('latest', 'latest_opened')
+JOB_TRACE_TAIL_BYTES = getattr(config, 'JOB_TRACE_TAIL_BYTES', 32 * 1024)
+JOB_TRACE_TAIL_LINES = getattr(config, 'JOB_TRACE_TAIL_LINES', 30)
+
+# colors, cursor moves and the erase codes runners put after section markers
+_ANSI_RE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+_SECTION_RE = re.compile(r'section_(start|end):\d+:([\w.-]+)(?:\[[^\]]*\])?')
+# runner housekeeping after the script failed, it only hides the actual error
+SKIPPED_SECTIONS = ('after_script', 'upload_artifacts_on_failure', 'archive_cache_on_failure',
+                    'cleanup_file_variables')
+
+note_index = NoteIndex(limit=MR_NOTES_LIMIT)
+
+
+def create_gitlab(gitlab_token: str) -> gitlab.Gitlab:
+    return gitlab.Gitlab(
+        url=GITLAB_URL,
+        private_token=gitlab_token,
+        timeout=GITLAB_TIMEOUT,
+        session=transport.get_session()
+    )
+
+
+def _forget_client(gl: Optional[gitlab.Gitlab]) -> None:
+    if gl is None:
+        return
+
+    with _clients_lock:
+        _clients_by_token.pop(gl.private_token, None)
+        _unvalidated_tokens.discard(gl.private_token)
+        for chat_id in [chat_id for chat_id, client in gitlab_clients.items() if client is gl]:
+            del gitlab_clients[chat_id]
+
+
+def release_chat(chat_id: int) -> None:
+    # the token's client is closed only when no other chat shares it
+    with _clients_lock:
+        gl = gitlab_clients.pop(chat_id, None)
+        if gl is None or any(client is gl for client in gitlab_clients.values()):
+            return
+        _clients_by_token.pop(gl.private_token, None)
+        _unvalidated_tokens.discard(gl.private_token)
+
+
+@metrics.timed('init_gitlab_client')
+def init_gitlab_client(chat_id: int, gitlab_token: str, validate: bool = True) -> Optional[gitlab.Gitlab]:
+    gl = None
     try:
         if not gitlab_token or gitlab_token == 'ВАШ_GITLAB_TOKEN_ЗДЕСЬ':
             logger.error(f"Невалидный GitLab токен для chat_id: {chat_id}")
             return None
 
-        gl = gitlab.Gitlab(
-            url=GITLAB_URL,
-            private_token=gitlab_token
-        )
-        gl.auth()
+        # chats with the same token share one client
+        with _clients_lock:
+            gl = _clients_by_token.get(gitlab_token)
+            if gl is None:
+                gl = create_gitlab(gitlab_token)
+                _clients_by_token[gitlab_token] = gl
+                _unvalidated_tokens.add(gitlab_token)
+
+        if validate and gitlab_token in _unvalidated_tokens:
+            gl.auth()
+            _unvalidated_tokens.discard(gitlab_token)
+
         gitlab_clients[chat_id] = gl
         logger.info(f"GitLab клиент инициализирован для chat_id: {chat_id}")
         return gl
     except gitlab.exceptions.GitlabAuthenticationError:
         logger.error(f"Ошибка аутентификации GitLab для chat_id {chat_id}")
+        _forget_client(gl)
         return None
+    except governor.RateLimitedError:
+        # the token is fine, it is just busy: keep the client
+        raise
     except Exception as e:
         logger.error(f"Ошибка инициализации GitLab для chat_id {chat_id}: {e}")
+        _forget_client(gl)
         return None
 
 
@@ -40,56 +109,229 @@ def get_gitlab_client(chat_id: int) -> Optional[gitlab.Gitlab]:
     return None
 
 
-def get_last_pipeline(chat_id: int, project_id: int) -> Optional[Dict[str, Any]]:
+def get_ready_client(chat_id: int) -> Optional[gitlab.Gitlab]:
+    # clients registered without validation authenticate on their first real use
+    gl = get_gitlab_client(chat_id)
+    if gl is None or gl.private_token not in _unvalidated_tokens:
+        return gl
+
     try:
-        gl = get_gitlab_client(chat_id)
-        if not gl:
-            logger.error(f"GitLab клиент не инициализирован для chat_id: {chat_id}")
-            return None
+        gl.auth()
+        _unvalidated_tokens.discard(gl.private_token)
+        return gl
+    except gitlab.exceptions.GitlabAuthenticationError:
+        logger.error(f"Ошибка аутентификации GitLab для chat_id {chat_id}")
+        _forget_client(gl)
+        return None
 
-        project = gl.projects.get(project_id)
-        pipelines = project.pipelines.list(get_all=True, per_page=1)
 
-        if not pipelines:
-            return None
+def list_recent_pipelines(gl: gitlab.Gitlab, project_id: int, limit: int = 1,
+                          ref: Optional[str] = None, status: Optional[str] = None) -> List[Any]:
+    filters = {}
+    if ref:
+        filters['ref'] = ref
+    if status:
+        filters['status'] = status
+
+    # one page, newest first: cost doesn't depend on how long the project history is
+    project = gl.projects.get(project_id, lazy=True)
+    return project.pipelines.list(
+        get_all=False,
+        page=1,
+        per_page=limit,
+        order_by='id',
+        sort='desc',
+        **filters
+    )
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _jobs_duration(times: List[Tuple[Optional[str], Optional[str]]]) -> int:
+    # pipeline duration as GitLab counts it: time when at least one job was running
+    intervals = []
+    for started, finished in times:
+        started_at = _parse_time(started)
+        finished_at = _parse_time(finished)
+        if started_at and finished_at:
+            intervals.append((started_at, finished_at))
+
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += (current_end - current_start).total_seconds()
+            current_start, current_end = start, end
+        elif end > current_end:
+            current_end = end
+    if current_end is not None:
+        total += (current_end - current_start).total_seconds()
+
+    return int(total)
+
+
+def configured_project_ids(user_config: Dict[str, Any]) -> List[int]:
+    # 'project_id' stays the main project, 'project_ids' adds more subscriptions
+    project_ids = []
+    for project_id in [user_config.get('project_id')] + list(user_config.get('project_ids') or []):
+        if project_id and project_id not in project_ids:
+            project_ids.append(project_id)
+    return project_ids
+
+
+@metrics.timed('list_group_project_ids')
+def list_group_project_ids(chat_id: int, group_id: int) -> List[int]:
+    gl = get_ready_client(chat_id)
+    if not gl:
+        return []
+
+    group = gl.groups.get(group_id, lazy=True)
+    projects = group.projects.list(get_all=True, per_page=100, include_subgroups=True, archived=False, simple=True)
+    return [project.id for project in projects]
+
+
+def graphql_query(gl: gitlab.Gitlab, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+    response = gl.session.post(
+        f"{gl.url}/api/graphql",
+        json={'query': query, 'variables': variables},
+        headers={**gl.headers, 'PRIVATE-TOKEN': gl.private_token},
+        timeout=gl.timeout,
+        verify=gl.ssl_verify
+    )
+    response.raise_for_status()
+    data = response.json()
+    if data.get('errors'):
+        raise gitlab.exceptions.GitlabError(str(data['errors'])[:200])
+    return data['data']
+
+
+LATEST_PIPELINES_QUERY = """
+query($ids: [ID!], $first: Int) {
+  projects(ids: $ids, first: $first) {
+    nodes {
+      id
+      fullPath
+      webUrl
+      pipelines(first: 1) {
+        nodes { id status ref sha createdAt duration path }
+      }
+    }
+  }
+}
+"""
+
+
+@metrics.timed('get_latest_pipelines')
+def get_latest_pipelines(chat_id: int, project_ids: List[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+    # one GraphQL round-trip per 100 projects instead of a REST list per project
+    gl = get_ready_client(chat_id)
+    if not gl:
+        raise gitlab.exceptions.GitlabAuthenticationError("GitLab client not initialized")
+
+    summaries = {project_id: None for project_id in project_ids}
+    for start in range(0, len(project_ids), 100):
+        batch = project_ids[start:start + 100]
+        data = graphql_query(gl, LATEST_PIPELINES_QUERY, {
+            'ids': [f"gid://gitlab/Project/{project_id}" for project_id in batch],
+            'first': len(batch),
+        })
+
+        for node in data['projects']['nodes']:
+            project_id = int(node['id'].rsplit('/', 1)[1])
+            pipelines = node['pipelines']['nodes']
+            summary = {'project_id': project_id, 'project': node['fullPath'], 'id': None, 'web_url': node['webUrl']}
+            if pipelines:
+                pipeline = pipelines[0]
+                summary.update({
+                    'id': int(pipeline['id'].rsplit('/', 1)[1]),
+                    'status': pipeline['status'].lower(),
+                    'ref': pipeline['ref'],
+                    'sha': (pipeline['sha'] or '')[:8],
+                    'created_at': pipeline['createdAt'],
+                    'duration': pipeline['duration'] or 0,
+                    'web_url': f"{gl.url}{pipeline['path']}",
+                })
+            summaries[project_id] = summary
+
+    return summaries
+
+
+@metrics.timed('get_latest_pipeline_summary')
+def get_latest_pipeline_summary(chat_id: int, project_id: int) -> Optional[Dict[str, Any]]:
+    # REST fallback for GitLab instances without the GraphQL API
+    gl = get_ready_client(chat_id)
+    if not gl:
+        return None
 
+    pipelines = list_recent_pipelines(gl, project_id)
+    summary = {'project_id': project_id, 'project': str(project_id), 'id': None, 'web_url': None}
+    if pipelines:
         pipeline = pipelines[0]
-        full_pipeline = project.pipelines.get(pipeline.id)
-        jobs = full_pipeline.jobs.list(get_all=True, per_page=100)
-
-        stages = {}
-        for job in jobs[::-1]:
-            stage = job.stage
-            if stage not in stages:
-                stages[stage] = []
-            stages[stage].append(job)
-
-        pipeline_info = {
+        summary.update({
             'id': pipeline.id,
             'status': pipeline.status,
             'ref': pipeline.ref,
+            'sha': pipeline.sha[:8] if pipeline.sha else '',
             'created_at': pipeline.created_at,
-            'duration': full_pipeline.duration or 0,
+            'duration': 0,
             'web_url': pipeline.web_url,
-            'sha': pipeline.sha[:8] if pipeline.sha else '',
-            'stages': {}
-        }
+        })
+    return summary
+
+
+def _pipeline_info(gl: gitlab.Gitlab, project_id: int, pipeline: Any) -> snapshot.PipelineSnapshot:
+    project = gl.projects.get(project_id, lazy=True)
+    # one page of RESTObjects at a time, only the fields below outlive it
+    jobs = [
+        (job.id, job.name, job.stage, job.status, getattr(job, 'started_at', None), getattr(job, 'finished_at', None))
+        for job in project.pipelines.get(pipeline.id, lazy=True).jobs.list(iterator=True, per_page=100)
+    ]
+    jobs.reverse()
+    stage_names, counts = snapshot.count_stages((stage, status) for _, _, stage, status, _, _ in jobs)
+
+    return snapshot.PipelineSnapshot(
+        id=pipeline.id,
+        status=pipeline.status,
+        ref=pipeline.ref,
+        created_at=pipeline.created_at,
+        duration=_jobs_duration([(started_at, finished_at) for *_, started_at, finished_at in jobs]),
+        web_url=pipeline.web_url,
+        sha=pipeline.sha[:8] if pipeline.sha else '',
+        stage_names=stage_names,
+        counts=counts,
+        # ids for /job, so the drill-down doesn't have to list the jobs again
+        failed_jobs=tuple(
+            snapshot.FailedJob(job_id, name, stage)
+            for job_id, name, stage, status, _, _ in jobs if status == 'failed'
+        ),
+    )
+
+
+@metrics.timed('get_last_pipeline')
+def get_last_pipeline(chat_id: int, project_id: int, ref: Optional[str] = None,
+                      status: Optional[str] = None) -> Optional[snapshot.PipelineSnapshot]:
+    try:
+        gl = get_ready_client(chat_id)
+        if not gl:
+            logger.error(f"GitLab клиент не инициализирован для chat_id: {chat_id}")
+            return None
+
+        pipelines = list_recent_pipelines(gl, project_id, ref=ref, status=status)
+
+        if not pipelines:
+            return None
 
-        for stage_name, stage_jobs in stages.items():
-            statuses = [job.status for job in stage_jobs]
-            pipeline_info['stages'][stage_name] = {
-                'summary': {
-                    'total': len(stage_jobs),
-                    'success': statuses.count('success'),
-                    'failed': statuses.count('failed'),
-                    'running': statuses.count('running'),
-                    'pending': statuses.count('pending'),
-                }
-            }
-
-        return pipeline_info
-
-    except gitlab.exceptions.GitlabGetError as e:
+        return _pipeline_info(gl, project_id, pipelines[0])
+
+    except governor.RateLimitedError:
+        # "try again in Ns" is the answer for the user, not "no pipeline"
+        raise
+    except (gitlab.exceptions.GitlabGetError, gitlab.exceptions.GitlabListError) as e:
         if "404" in str(e):
             logger.error(f"Проект {project_id} не найден для chat_id {chat_id}")
         else:
@@ -100,156 +342,184 @@ def get_last_pipeline(chat_id: int, project_id: int) -> Optional[Dict[str, Any]]
         return None
 
 
-def safe_format(text: str) -> str:
-    if not text:
-        return ""
-
-    # TODO: switch to HTML
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '=', '-', '|', '{', '}', '!']
-
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-
-    return text
-
-
-def format_pipeline_message(pipeline_info: Dict[str, Any]) -> str:
-    if not pipeline_info:
-        return "❌ Не удалось получить информацию о пайплайне"
-
-    pipeline_id = safe_format(str(pipeline_info.get('id', 'N/A')))
-    status = safe_format(pipeline_info.get('status', 'N/A'))
-    ref = safe_format(pipeline_info.get('ref', 'N/A'))
-    created_at = safe_format(pipeline_info.get('created_at', 'N/A'))
-    duration = safe_format(str(pipeline_info.get('duration', 'N/A')))
-    sha = safe_format(pipeline_info.get('sha', 'N/A'))
-    web_url = pipeline_info.get('web_url', '#')
+@metrics.timed('get_pipeline')
+def get_pipeline(chat_id: int, project_id: int, pipeline_id: int) -> Optional[snapshot.PipelineSnapshot]:
+    # a known pipeline by id, for following it after newer ones were started
+    gl = get_ready_client(chat_id)
+    if not gl:
+        logger.error(f"GitLab клиент не инициализирован для chat_id: {chat_id}")
+        return None
 
-    message = f"🚀 *Pipeline #{pipeline_id}*\n\n"
-    message += f"*Status:* {status}\n"
-    message += f"*Branch:* `{ref}`\n"
-    message += f"*Created:* {created_at}\n"
-    message += f"*Duration:* {duration} sec\n"
-    message += f"*SHA:* `{sha}`\n\n"
+    pipeline = gl.projects.get(project_id, lazy=True).pipelines.get(pipeline_id)
+    return _pipeline_info(gl, project_id, pipeline)
 
-    stages = pipeline_info.get('stages', {})
-    if stages:
-        message += "*Stages:*\n"
-        for stage_name, stage_data in stages.items():
-            safe_stage_name = safe_format(stage_name)
-            summary = stage_data.get('summary', {})
-            message += f"*{safe_stage_name.upper()}*\n"
-            message += f"  ✅ Success: {summary.get('success', 0)}\n"
-            message += f"  ❌ Failed: {summary.get('failed', 0)}\n"
-            message += f"  🔄 Running: {summary.get('running', 0)}\n"
-            message += f"  ⏳ Pending: {summary.get('pending', 0)}\n\n"
 
-    message += f"🔗 [Open pipeline]({web_url})"
-    return message
+def read_trace_tail(gl: gitlab.Gitlab, project_id: int, job_id: int,
+                    max_bytes: int = JOB_TRACE_TAIL_BYTES) -> Tuple[bytes, bool]:
+    # only the end of the log is wanted: ask for the last bytes, and if the server
+    # ignores Range, stream the body through a buffer that never grows past max_bytes
+    response = raw_get(gl, f"/projects/{project_id}/jobs/{job_id}/trace",
+                       headers={'Range': f"bytes=-{max_bytes}"}, stream=True)
+    try:
+        if response.status_code == 416:
+            return b'', False
+        response.raise_for_status()
+
+        tail = bytearray()
+        total = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            total += len(chunk)
+            tail += chunk
+            if len(tail) > max_bytes:
+                del tail[:-max_bytes]
+
+        if response.status_code == 206:
+            # Content-Range: bytes 1000-1999/2000
+            size = response.headers.get('Content-Range', '').rpartition('/')[2]
+            truncated = size.isdigit() and int(size) > len(tail)
+        else:
+            truncated = total > len(tail)
+        return bytes(tail), truncated
+    finally:
+        response.close()
+
+
+def extract_error_tail(trace: bytes, truncated: bool = False, lines: int = JOB_TRACE_TAIL_LINES) -> str:
+    text = trace.decode('utf-8', errors='replace')
+    raw_lines = text.split('\n')
+    if truncated:
+        # the first line was cut in the middle
+        raw_lines = raw_lines[1:]
+
+    kept = []
+    skipped_section = None
+    for line in raw_lines:
+        for kind, name in _SECTION_RE.findall(line):
+            if kind == 'start' and name in SKIPPED_SECTIONS:
+                skipped_section = name
+            elif kind == 'end' and name == skipped_section:
+                skipped_section = None
+        if skipped_section:
+            continue
+        # a progress bar redraws the line with \r, only its last state is visible
+        line = _SECTION_RE.sub('', line).rstrip('\r').rsplit('\r', 1)[-1]
+        line = _ANSI_RE.sub('', line).rstrip()
+        if line:
+            kept.append(line)
+
+    return '\n'.join(kept[-lines:])
+
+
+@metrics.timed('get_job_trace_tail')
+def get_job_trace_tail(chat_id: int, project_id: int, job_id: int) -> Dict[str, Any]:
+    gl = get_ready_client(chat_id)
+    if not gl:
+        raise gitlab.exceptions.GitlabAuthenticationError("GitLab client not initialized")
+
+    job = gl.projects.get(project_id, lazy=True).jobs.get(job_id)
+    trace, truncated = read_trace_tail(gl, project_id, job_id)
+    return {
+        'id': job.id,
+        'name': job.name,
+        'stage': job.stage,
+        'status': job.status,
+        'failure_reason': getattr(job, 'failure_reason', None),
+        'web_url': job.web_url,
+        'trace': extract_error_tail(trace, truncated),
+        'truncated': truncated,
+    }
 
 
-def get_second_last_mr_details(chat_id: int, project_id: int) -> str:
+def safe_format(text: str) -> str:
+    if not text:
+        return ""
+    return render.escape(text, 'MarkdownV2')
+
+
+def format_pipeline_message(pipeline_info: snapshot.PipelineSnapshot, mode: str = render.PARSE_MODE) -> str:
+    return render.render_pipeline(pipeline_info, mode)
+
+
+def resolve_mr(gl: gitlab.Gitlab, project_id: int, policy: str = 'latest', author: Optional[str] = None,
+               target_branch: Optional[str] = None, limit: int = 2) -> List[Any]:
+    if policy not in MR_POLICIES:
+        raise ValueError(f"Unknown MR policy: {policy}")
+
+    filters = {'state': 'opened' if policy == 'latest_opened' else 'all'}
+    if author:
+        filters['author_username'] = author
+    if target_branch:
+        filters['target_branch'] = target_branch
+
+    # list items already carry title, author, reviewers and labels, no need for mergerequests.get
+    project = gl.projects.get(project_id, lazy=True)
+    return project.mergerequests.list(
+        get_all=False,
+        page=1,
+        per_page=limit,
+        sort='desc',
+        order_by='created_at',
+        **filters
+    )
+
+
+def fetch_recent_notes(mr: Any, after_id: Optional[int] = None, limit: int = MR_NOTES_LIMIT) -> List[Any]:
+    # pages from the newest note and stops at the first one that was already processed
+    notes = []
+    per_page = min(limit, 100)
+    page = 1
+
+    while len(notes) < limit:
+        batch = mr.notes.list(get_all=False, page=page, per_page=per_page, sort='desc', order_by='created_at')
+        for note in batch:
+            if after_id is not None and note.id <= after_id:
+                return notes
+            notes.append(note)
+        if len(batch) < per_page:
+            break
+        page += 1
+
+    return notes[:limit]
+
+
+@metrics.timed('get_second_last_mr_details')
+def get_second_last_mr_details(chat_id: int, project_id: int, policy: str = 'latest', author: Optional[str] = None,
+                               target_branch: Optional[str] = None) -> str:
     try:
-        gl = get_gitlab_client(chat_id)
+        gl = get_ready_client(chat_id)
         if not gl:
             logger.error(f"GitLab клиент не инициализирован для chat_id: {chat_id}")
             return "❌ GitLab client not initialized"
 
-        project = gl.projects.get(project_id)
-
-        all_mrs = project.mergerequests.list(
-            state='all',
-            get_all=True,
-            sort='desc',
-            order_by='created_at',
-            per_page=50
-        )
+        mrs = resolve_mr(gl, project_id, policy=policy, author=author, target_branch=target_branch)
 
-        if len(all_mrs) < 2:
+        # the default policy keeps the old rule: the very first MR of the fork doesn't count
+        min_count = 2 if policy == 'latest' and not author and not target_branch else 1
+        if len(mrs) < min_count:
             return "❌ Not enough MRs found"
 
-        second_last_mr = all_mrs[0]
-        mr = project.mergerequests.get(second_last_mr.iid)
-
-        mr_iid = safe_format(str(mr.iid))
-        mr_title = safe_format(mr.title)
-        author = safe_format(mr.author['username'])
-        source_branch = safe_format(mr.source_branch)
-        target_branch = safe_format(mr.target_branch)
-        created_at = safe_format(mr.created_at)
-        updated_at = safe_format(mr.updated_at)
-
-        result = f"📋 *MR {mr_iid}*\n\n"
-        result += f"*Title:* {mr_title}\n"
-        result += f"*Author:* {author}\n"
-        result += f"*Status:* {get_mr_status_icon(mr.state)} {mr.state.upper()}\n"
-        result += f"*Branch:* `{source_branch}` → `{target_branch}`\n"
-        # result += f"*Created:* {created_at}\n"
-        # result += f"*Updated:* {updated_at}\n"
-
-        if hasattr(mr, 'reviewers') and mr.reviewers:
-            reviewers = [safe_format(r['username']) for r in mr.reviewers]
-            result += f"*Reviewers:* {', '.join(reviewers)}\n"
-
-        if mr.labels:
-            safe_labels = [safe_format(label) for label in mr.labels]
-            result += f"*Labels:* {', '.join(safe_labels)}\n"
-
-        notes = mr.notes.list(get_all=True)
-
-        if notes:
-            reviewer_comments = []
-            for note in notes:
-                if getattr(note, 'system', False):
-                    continue
-                if note.author['id'] == mr.author['id']:
-                    continue
-                reviewer_comments.append(note)
-
-            if reviewer_comments:
-                result += f"\n💬 *Comments:*"
-
-                comments_by_reviewer = {}
-                for note in reviewer_comments:
-                    reviewer_name = safe_format(f'{note.author['name']} - {note.author['username']}')
-                    if reviewer_name not in comments_by_reviewer:
-                        comments_by_reviewer[reviewer_name] = []
-                    comments_by_reviewer[reviewer_name].append(note)
-
-                for reviewer, comments in comments_by_reviewer.items():
-                    result += f"\n👤 *{reviewer}*:\n"
-
-                    for i, note in enumerate(comments, 1):
-                        if note.body:
-                            clean_body = safe_format(' '.join(note.body.strip().split()))
-                            if "Score for the group is:" in clean_body:
-                                score_text = clean_body[clean_body.find("Score for the group is:"):]
-                                score_text = score_text[-50:] if len(score_text) > 50 else score_text
-                                result += f"  {score_text}\n"
-                            else:
-                                if len(clean_body) > 200:
-                                    if clean_body.find('Score for all previous groups together:') \
-                                            and clean_body.find('Preliminary correctness:'):
-                                        score_all_index = clean_body.find('Score for all previous groups together:')
-                                        score_per_index = clean_body.find('Preliminary correctness:')
-                                        if clean_body[score_all_index:score_all_index + 46] not in result:
-                                            result += f"{clean_body[score_all_index:score_all_index + 46]}\n"
-                                        if clean_body[score_per_index:score_per_index + 31] not in result:
-                                            result += f"{clean_body[score_per_index:score_per_index + 31]}\n"
-                                    else:
-                                        result += f"  {clean_body[:300]}...\n"
-                                else:
-                                    result += f"  {clean_body}\n"
-            else:
-                result += "\n💬 *Reviewer comments:*\n  No comments from reviewers\n"
-        else:
-            result += "\n💬 *Reviewer comments:*\n  No comments\n"
-
-        result += f"\n🔗 [Open MR]({mr.web_url})"
+        mr = mrs[0]
+
+        mr_info = {
+            'iid': mr.iid,
+            'title': mr.title,
+            'author': mr.author['username'],
+            'state': mr.state,
+            'source_branch': mr.source_branch,
+            'target_branch': mr.target_branch,
+            'reviewers': [r['username'] for r in getattr(mr, 'reviewers', None) or []],
+            'labels': mr.labels,
+            'web_url': mr.web_url,
+        }
 
-        return result
+        digest = note_index.update(
+            (project_id, mr.iid),
+            mr.author['id'],
+            lambda after_id: fetch_recent_notes(mr, after_id)
+        )
+        return render.render_mr(mr_info, digest)
 
-    except gitlab.exceptions.GitlabGetError as e:
+    except (gitlab.exceptions.GitlabGetError, gitlab.exceptions.GitlabListError) as e:
         if "404" in str(e):
             logger.error(f"Проект {project_id} не найден для chat_id {chat_id}")
             return "❌ Project not found"
@@ -261,21 +531,60 @@ def get_second_last_mr_details(chat_id: int, project_id: int) -> str:
         return f"❌ Error: {str(e)[:200]}"
 
 
-def get_mr_status_icon(state: str) -> str:
-    icons = {
-        'opened': '🟢',
-        'merged': '🟣',
-        'closed': '🔴'
-    }
-    return icons.get(state, '⚪')
+def raw_get(gl: gitlab.Gitlab, path: str, query: Optional[Dict[str, Any]] = None,
+            headers: Optional[Dict[str, str]] = None, stream: bool = False):
+    # python-gitlab can't send extra request headers, so conditional/range requests go
+    # through the same pooled session by hand
+    return gl.session.get(
+        f"{gl.api_url}{path}",
+        params=query,
+        headers={**gl.headers, 'PRIVATE-TOKEN': gl.private_token, **(headers or {})},
+        timeout=gl.timeout,
+        verify=gl.ssl_verify,
+        stream=stream
+    )
+
+
+@metrics.timed('probe_etag')
+def probe_etag(chat_id: int, path: str, query: Dict[str, Any], etag: Optional[str] = None) -> Optional[str]:
+    gl = get_ready_client(chat_id)
+    if not gl:
+        return None
+
+    headers = {'If-None-Match': etag} if etag else {}
+    response = raw_get(gl, path, query, headers)
+    if response.status_code == 304:
+        return etag
+    response.raise_for_status()
+    return response.headers.get('ETag')
+
+
+def probe_pipelines_etag(chat_id: int, project_id: int, ref: Optional[str] = None, status: Optional[str] = None,
+                         etag: Optional[str] = None) -> Optional[str]:
+    query = {'per_page': 1, 'order_by': 'id', 'sort': 'desc'}
+    if ref:
+        query['ref'] = ref
+    if status:
+        query['status'] = status
+    return probe_etag(chat_id, f"/projects/{project_id}/pipelines", query, etag)
+
 
+def probe_jobs_etag(chat_id: int, project_id: int, pipeline_id: int, etag: Optional[str] = None) -> Optional[str]:
+    # every job transition changes this page, and the pipeline status only moves with its jobs
+    query = {'per_page': 100}
+    return probe_etag(chat_id, f"/projects/{project_id}/pipelines/{pipeline_id}/jobs", query, etag)
 
+
+def probe_mrs_etag(chat_id: int, project_id: int, etag: Optional[str] = None) -> Optional[str]:
+    # new notes bump updated_at of the MR, so this page changes on comments as well
+    query = {'per_page': 1, 'order_by': 'updated_at', 'sort': 'desc', 'state': 'all'}
+    return probe_etag(chat_id, f"/projects/{project_id}/merge_requests", query, etag)
+
+
+@metrics.timed('test_gitlab_connection')
 def test_gitlab_connection(chat_id: int, gitlab_token: str) -> tuple[bool, str]:
     try:
-        gl = gitlab.Gitlab(
-            url=GITLAB_URL,
-            private_token=gitlab_token
-        )
+        gl = _clients_by_token.get(gitlab_token) or create_gitlab(gitlab_token)
         gl.auth()
         user = gl.user
         return True, f"✅ Подключение успешно\nUser: {user.username}"
@@ -0,0 +1,356 @@
+from typing import Any, Dict, List, Optional
+
+import config
+from snapshot import PipelineSnapshot
+
+PARSE_MODE = getattr(config, 'PARSE_MODE', 'HTML')
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Chained str.replace measured faster than a single str.translate or regex pass in CPython
+# (see bench/bench_render.py): each replace is a C scan that returns early when the char is absent.
+# The backslash goes first so the escapes added later aren't escaped again
+_MARKDOWN_V2_ESCAPES = tuple((char, f'\\{char}') for char in '\\_*[]()~`>#+-=|{}.!')
+_MARKDOWN_V2_CODE_ESCAPES = (('\\', '\\\\'), ('`', '\\`'))
+_MARKDOWN_V2_URL_ESCAPES = (('\\', '\\\\'), (')', '\\)'))
+_HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'))
+
+PIPELINE_STATUS_ICONS = {
+    'success': '✅',
+    'failed': '❌',
+    'running': '🔄',
+    'pending': '⏳',
+    'canceled': '🚫',
+}
+
+MR_STATUS_ICONS = {
+    'opened': '🟢',
+    'merged': '🟣',
+    'closed': '🔴'
+}
+
+TEMPLATES = {
+    'HTML': {
+        'pipeline_header': (
+            "🚀 <b>Pipeline #{id}</b>\n\n"
+            "<b>Status:</b> {status}\n"
+            "<b>Branch:</b> <code>{ref}</code>\n"
+            "<b>Created:</b> {created_at}\n"
+            "<b>Duration:</b> {duration} sec\n"
+            "<b>SHA:</b> <code>{sha}</code>\n\n"
+        ),
+        'stages_title': "<b>Stages:</b>\n",
+        'stage': (
+            "<b>{name}</b>\n"
+            "  ✅ Success: {success}\n"
+            "  ❌ Failed: {failed}\n"
+            "  🔄 Running: {running}\n"
+            "  ⏳ Pending: {pending}\n\n"
+        ),
+        'pipeline_link': '🔗 <a href="{url}">Open pipeline</a>',
+        'mr_header': (
+            "📋 <b>MR {iid}</b>\n\n"
+            "<b>Title:</b> {title}\n"
+            "<b>Author:</b> {author}\n"
+            "<b>Status:</b> {icon} {state}\n"
+            "<b>Branch:</b> <code>{source_branch}</code> → <code>{target_branch}</code>\n"
+        ),
+        'mr_reviewers': "<b>Reviewers:</b> {reviewers}\n",
+        'mr_labels': "<b>Labels:</b> {labels}\n",
+        'mr_link': '\n🔗 <a href="{url}">Open MR</a>',
+        'no_notes': "\n💬 <b>Reviewer comments:</b>\n  No comments\n",
+        'no_reviewer_notes': "\n💬 <b>Reviewer comments:</b>\n  No comments from reviewers\n",
+        'comments_title': "\n💬 <b>Comments:</b>",
+        'reviewer': "\n👤 <b>{reviewer}</b>:\n",
+        'note_header': "💬 <b>MR {iid}</b>\n",
+        'note_link': '\n🔗 <a href="{url}">Open comment</a>',
+        'overview_title': "🚀 <b>Pipelines</b>\n\n",
+        'overview_line': '{icon} <a href="{url}">{project}</a> #{id} {status} <code>{ref}</code>\n',
+        'overview_empty': "⚪ {project}: no pipelines\n",
+        'job_header': (
+            "🧪 <b>Job #{id}</b> {name}\n"
+            "<b>Stage:</b> {stage}\n"
+            "<b>Status:</b> {icon} {status}{reason}\n"
+        ),
+        'job_reason': " ({reason})",
+        'job_trace': "\n<pre>{trace}</pre>\n",
+        'job_link': '🔗 <a href="{url}">Open job</a>',
+        'jobs_none': "✅ No failed jobs in pipeline #{id}",
+        'jobs_more': "\n…and {count} more failed jobs in pipeline #{id}",
+    },
+    'MarkdownV2': {
+        'pipeline_header': (
+            "🚀 *Pipeline \\#{id}*\n\n"
+            "*Status:* {status}\n"
+            "*Branch:* `{ref}`\n"
+            "*Created:* {created_at}\n"
+            "*Duration:* {duration} sec\n"
+            "*SHA:* `{sha}`\n\n"
+        ),
+        'stages_title': "*Stages:*\n",
+        'stage': (
+            "*{name}*\n"
+            "  ✅ Success: {success}\n"
+            "  ❌ Failed: {failed}\n"
+            "  🔄 Running: {running}\n"
+            "  ⏳ Pending: {pending}\n\n"
+        ),
+        'pipeline_link': "🔗 [Open pipeline]({url})",
+        'mr_header': (
+            "📋 *MR {iid}*\n\n"
+            "*Title:* {title}\n"
+            "*Author:* {author}\n"
+            "*Status:* {icon} {state}\n"
+            "*Branch:* `{source_branch}` → `{target_branch}`\n"
+        ),
+        'mr_reviewers': "*Reviewers:* {reviewers}\n",
+        'mr_labels': "*Labels:* {labels}\n",
+        'mr_link': "\n🔗 [Open MR]({url})",
+        'no_notes': "\n💬 *Reviewer comments:*\n  No comments\n",
+        'no_reviewer_notes': "\n💬 *Reviewer comments:*\n  No comments from reviewers\n",
+        'comments_title': "\n💬 *Comments:*",
+        'reviewer': "\n👤 *{reviewer}*:\n",
+        'note_header': "💬 *MR {iid}*\n",
+        'note_link': "\n🔗 [Open comment]({url})",
+        'overview_title': "🚀 *Pipelines*\n\n",
+        'overview_line': "{icon} [{project}]({url}) \\#{id} {status} `{ref}`\n",
+        'overview_empty': "⚪ {project}: no pipelines\n",
+        'job_header': (
+            "🧪 *Job \\#{id}* {name}\n"
+            "*Stage:* {stage}\n"
+            "*Status:* {icon} {status}{reason}\n"
+        ),
+        'job_reason': " \\({reason}\\)",
+        'job_trace': "\n```\n{trace}\n```\n",
+        'job_link': "🔗 [Open job]({url})",
+        'jobs_none': "✅ No failed jobs in pipeline \\#{id}",
+        'jobs_more': "\n…and {count} more failed jobs in pipeline \\#{id}",
+    },
+}
+
+
+def _replace_all(text: str, escapes) -> str:
+    for char, escaped in escapes:
+        text = text.replace(char, escaped)
+    return text
+
+
+def escape(text: Any, mode: str = PARSE_MODE) -> str:
+    if text is None:
+        return ""
+    if mode == 'HTML':
+        return _replace_all(str(text), _HTML_ESCAPES)
+    return _replace_all(str(text), _MARKDOWN_V2_ESCAPES)
+
+
+def escape_code(text: Any, mode: str = PARSE_MODE) -> str:
+    if mode == 'HTML':
+        return escape(text, mode)
+    return _replace_all(str(text or ''), _MARKDOWN_V2_CODE_ESCAPES)
+
+
+def escape_url(url: Optional[str], mode: str = PARSE_MODE) -> str:
+    if mode == 'HTML':
+        return _replace_all(url or '#', _HTML_ESCAPES)
+    return _replace_all(url or '#', _MARKDOWN_V2_URL_ESCAPES)
+
+
+def get_mr_status_icon(state: str) -> str:
+    return MR_STATUS_ICONS.get(state, '⚪')
+
+
+def render_pipeline(pipeline_info: Optional[PipelineSnapshot], mode: str = PARSE_MODE) -> str:
+    if not pipeline_info:
+        return "❌ Не удалось получить информацию о пайплайне"
+
+    templates = TEMPLATES[mode]
+    parts = [templates['pipeline_header'].format(
+        id=escape(pipeline_info.id, mode),
+        status=escape(pipeline_info.status, mode),
+        ref=escape_code(pipeline_info.ref, mode),
+        created_at=escape(pipeline_info.created_at, mode),
+        duration=escape(pipeline_info.duration, mode),
+        sha=escape_code(pipeline_info.sha, mode),
+    )]
+
+    if pipeline_info.stage_names:
+        parts.append(templates['stages_title'])
+        stage_template = templates['stage']
+        for stage_name, (_, success, failed, running, pending) in pipeline_info.stages():
+            parts.append(stage_template.format(
+                name=escape(stage_name.upper(), mode),
+                success=success,
+                failed=failed,
+                running=running,
+                pending=pending,
+            ))
+
+    parts.append(templates['pipeline_link'].format(url=escape_url(pipeline_info.web_url, mode)))
+    return ''.join(parts)
+
+
+def _escaped_tail(text: str, budget: int, mode: str) -> str:
+    # the end of text that still fits into budget once escaped, cut at a line start where possible;
+    # escaping grows the text unevenly, and cutting after escaping could split an entity or an escape
+    kept = []
+    size = -1
+    for line in reversed(text.split('\n')):
+        escaped = escape_code(line, mode)
+        if size + 1 + len(escaped) <= budget:
+            kept.append(escaped)
+            size += 1 + len(escaped)
+            continue
+        if not kept:
+            # a single line longer than the message: its end, one character at a time
+            chars = []
+            size = 0
+            for char in reversed(line):
+                escaped_char = escape_code(char, mode)
+                if size + len(escaped_char) > budget:
+                    break
+                chars.append(escaped_char)
+                size += len(escaped_char)
+            kept.append(''.join(reversed(chars)))
+        break
+    return '\n'.join(reversed(kept))
+
+
+def render_job(job: Dict[str, Any], mode: str = PARSE_MODE, footer: str = '') -> str:
+    templates = TEMPLATES[mode]
+    reason = job.get('failure_reason')
+    header = templates['job_header'].format(
+        id=escape(job['id'], mode),
+        name=escape(job['name'], mode),
+        stage=escape(job['stage'], mode),
+        icon=PIPELINE_STATUS_ICONS.get(job['status'], '⚪'),
+        status=escape(job['status'], mode),
+        reason=templates['job_reason'].format(reason=escape(reason, mode)) if reason else '',
+    )
+    link = templates['job_link'].format(url=escape_url(job.get('web_url'), mode))
+
+    # a code block can't be split between messages: the log tail gets whatever the rest leaves
+    trace_block = ''
+    trace = job.get('trace') or ''
+    if trace:
+        frame = len(header) + len(templates['job_trace'].format(trace='')) + len(link) + len(footer)
+        budget = TELEGRAM_MESSAGE_LIMIT - frame
+        trace = _escaped_tail(trace, budget, mode)
+        if trace:
+            trace_block = templates['job_trace'].format(trace=trace)
+
+    return header + trace_block + link + footer
+
+
+def render_pipelines_overview(summaries: List[Optional[Dict[str, Any]]], mode: str = PARSE_MODE) -> str:
+    templates = TEMPLATES[mode]
+    parts = [templates['overview_title']]
+    line_template = templates['overview_line']
+
+    for summary in summaries:
+        if not summary:
+            continue
+        if summary.get('id') is None:
+            parts.append(templates['overview_empty'].format(project=escape(summary['project'], mode)))
+            continue
+        parts.append(line_template.format(
+            icon=PIPELINE_STATUS_ICONS.get(summary['status'], '⚪'),
+            url=escape_url(summary.get('web_url'), mode),
+            project=escape(summary['project'], mode),
+            id=escape(summary['id'], mode),
+            status=escape(summary['status'], mode),
+            ref=escape_code(summary.get('ref'), mode),
+        ))
+
+    return ''.join(parts)
+
+
+def render_review_comments(digest, mode: str = PARSE_MODE) -> str:
+    templates = TEMPLATES[mode]
+    if not digest.has_notes:
+        return templates['no_notes']
+    if not digest.entries:
+        return templates['no_reviewer_notes']
+
+    comments_by_reviewer = {}
+    for entry in digest.entries:
+        comments_by_reviewer.setdefault(entry.reviewer, []).append(entry)
+
+    parts = [templates['comments_title']]
+    reviewer_template = templates['reviewer']
+    shown_scores = set()
+    for reviewer, entries in comments_by_reviewer.items():
+        parts.append(reviewer_template.format(reviewer=escape(reviewer, mode)))
+        for entry in entries:
+            if entry.kind in ('total_score', 'correctness'):
+                # every grader report repeats the totals, show each value once
+                if entry.text in shown_scores:
+                    continue
+                shown_scores.add(entry.text)
+                parts.append(f"{escape(entry.text, mode)}\n")
+            else:
+                parts.append(f"  {escape(entry.text, mode)}\n")
+
+    return ''.join(parts)
+
+
+def render_mr(mr_info: Dict[str, Any], digest=None, mode: str = PARSE_MODE) -> str:
+    templates = TEMPLATES[mode]
+    state = mr_info.get('state', '')
+    parts = [templates['mr_header'].format(
+        iid=escape(mr_info.get('iid'), mode),
+        title=escape(mr_info.get('title'), mode),
+        author=escape(mr_info.get('author'), mode),
+        icon=get_mr_status_icon(state),
+        state=escape(state.upper(), mode),
+        source_branch=escape_code(mr_info.get('source_branch'), mode),
+        target_branch=escape_code(mr_info.get('target_branch'), mode),
+    )]
+
+    if mr_info.get('reviewers'):
+        reviewers = ', '.join(escape(reviewer, mode) for reviewer in mr_info['reviewers'])
+        parts.append(templates['mr_reviewers'].format(reviewers=reviewers))
+
+    if mr_info.get('labels'):
+        labels = ', '.join(escape(label, mode) for label in mr_info['labels'])
+        parts.append(templates['mr_labels'].format(labels=labels))
+
+    if digest is not None:
+        parts.append(render_review_comments(digest, mode))
+
+    parts.append(templates['mr_link'].format(url=escape_url(mr_info.get('web_url'), mode)))
+    return ''.join(parts)
+
+
+def render_note(mr_iid: Any, reviewer: str, body: str, url: Optional[str], mode: str = PARSE_MODE) -> str:
+    templates = TEMPLATES[mode]
+    return ''.join([
+        templates['note_header'].format(iid=escape(mr_iid, mode)),
+        templates['reviewer'].format(reviewer=escape(reviewer, mode)).lstrip('\n'),
+        f"  {escape(body, mode)}\n",
+        templates['note_link'].format(url=escape_url(url, mode)),
+    ])
+
+
+def _cut_position(text: str, limit: int) -> int:
+    cut = text.rfind('\n', 0, limit)
+    if cut > 0:
+        return cut + 1
+
+    # a single huge line: don't split an HTML entity or a MarkdownV2 escape
+    cut = limit
+    ampersand = text.rfind('&', max(0, cut - 8), cut)
+    if ampersand != -1 and ';' not in text[ampersand:cut]:
+        cut = ampersand
+    while cut > 1 and text[cut - 1] == '\\':
+        cut -= 1
+    return cut
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    chunks = []
+    while len(text) > limit:
+        cut = _cut_position(text, limit)
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
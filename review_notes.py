@@ -0,0 +1,130 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+SCORE_GROUP = 'Score for the group is:'
+SCORE_TOTAL = 'Score for all previous groups together:'
+CORRECTNESS = 'Preliminary correctness:'
+
+SCORE_TOTAL_RE = re.compile(re.escape(SCORE_TOTAL) + r'\s*(\S+)')
+CORRECTNESS_RE = re.compile(re.escape(CORRECTNESS) + r'\s*(\S+)')
+
+MAX_TRACKED_MRS = 512
+STATE_NAMESPACE = 'notes'
+
+
+class ReviewEntry:
+    __slots__ = ('note_id', 'reviewer', 'kind', 'text')
+
+    # kind: 'group_score', 'total_score', 'correctness' or 'comment'
+    def __init__(self, note_id: int, reviewer: str, kind: str, text: str):
+        self.note_id = note_id
+        self.reviewer = reviewer
+        self.kind = kind
+        self.text = text
+
+
+def parse_note(note_id: int, reviewer: str, body: str) -> List[ReviewEntry]:
+    clean_body = ' '.join(body.strip().split())
+    if not clean_body:
+        return []
+
+    group_index = clean_body.find(SCORE_GROUP)
+    if group_index != -1:
+        return [ReviewEntry(note_id, reviewer, 'group_score', clean_body[group_index:][-50:])]
+
+    if len(clean_body) <= 200:
+        return [ReviewEntry(note_id, reviewer, 'comment', clean_body)]
+
+    # long grader reports: only their summary lines matter
+    total = SCORE_TOTAL_RE.search(clean_body)
+    correctness = CORRECTNESS_RE.search(clean_body)
+    if total and correctness:
+        return [
+            ReviewEntry(note_id, reviewer, 'total_score', f"{SCORE_TOTAL} {total.group(1)}"),
+            ReviewEntry(note_id, reviewer, 'correctness', f"{CORRECTNESS} {correctness.group(1)}"),
+        ]
+
+    return [ReviewEntry(note_id, reviewer, 'comment', f"{clean_body[:300]}...")]
+
+
+class ReviewDigest:
+    __slots__ = ('last_note_id', 'has_notes', 'entries')
+
+    def __init__(self):
+        self.last_note_id: Optional[int] = None
+        self.has_notes = False
+        # newest first, like the notes API returns them
+        self.entries: List[ReviewEntry] = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'last_note_id': self.last_note_id,
+            'has_notes': self.has_notes,
+            'entries': [[entry.note_id, entry.reviewer, entry.kind, entry.text] for entry in self.entries],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ReviewDigest':
+        digest = cls()
+        digest.last_note_id = data['last_note_id']
+        digest.has_notes = data['has_notes']
+        digest.entries = [ReviewEntry(*entry) for entry in data['entries']]
+        return digest
+
+
+# Remembers the newest processed note of every MR, so each refresh only parses notes added since
+class NoteIndex:
+    def __init__(self, limit: int, max_mrs: int = MAX_TRACKED_MRS):
+        self.limit = limit
+        self.max_mrs = max_mrs
+        self._digests: 'OrderedDict[Hashable, ReviewDigest]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._state = None
+
+    def attach_store(self, state) -> None:
+        # digests are loaded lazily, an MR nobody asks about again costs nothing
+        self._state = state
+
+    def update(self, key: Hashable, mr_author_id: Any,
+               fetch_notes: Callable[[Optional[int]], List[Any]]) -> ReviewDigest:
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest is None:
+                saved = self._state.get(STATE_NAMESPACE, key) if self._state else None
+                digest = ReviewDigest.from_dict(saved) if saved else ReviewDigest()
+                self._digests[key] = digest
+            self._digests.move_to_end(key)
+            while len(self._digests) > self.max_mrs:
+                self._digests.popitem(last=False)
+            last_note_id = digest.last_note_id
+
+        new_notes = fetch_notes(last_note_id)
+        if not new_notes:
+            return digest
+
+        new_entries = []
+        for note in new_notes:
+            if getattr(note, 'system', False):
+                continue
+            if note.author['id'] == mr_author_id:
+                continue
+            if note.body:
+                reviewer = f"{note.author['name']} - {note.author['username']}"
+                new_entries.extend(parse_note(note.id, reviewer, note.body))
+
+        with self._lock:
+            if digest.last_note_id != last_note_id:
+                # another thread got here first with the same notes
+                return digest
+            digest.has_notes = True
+            digest.last_note_id = max(note.id for note in new_notes)
+            digest.entries = (new_entries + digest.entries)[:self.limit]
+        if self._state:
+            self._state.set(STATE_NAMESPACE, key, digest.to_dict())
+        return digest
+
+    def forget(self, key: Hashable) -> None:
+        with self._lock:
+            self._digests.pop(key, None)
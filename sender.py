@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, List, Optional, Tuple
+
+from telegram.error import BadRequest, RetryAfter
+
+import config
+import metrics
+from render import PARSE_MODE, split_message
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second per bot and 1 per second per chat
+SEND_GLOBAL_RATE = getattr(config, 'SEND_GLOBAL_RATE', 25)
+SEND_CHAT_RATE = getattr(config, 'SEND_CHAT_RATE', 1)
+SEND_CHAT_BURST = getattr(config, 'SEND_CHAT_BURST', 3)
+SEND_WORKERS = getattr(config, 'SEND_WORKERS', 4)
+SEND_MAX_RETRIES = 3
+
+MAX_TRACKED_MESSAGES = 10000
+STATE_NAMESPACE = 'messages'
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self._refill()
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    __slots__ = ('chat_id', 'key', 'text', 'options', 'enqueued_at', 'attempts')
+
+    # text None deletes the message sent earlier under the key
+    def __init__(self, chat_id: int, key: Optional[Hashable], text: Optional[str], options: Dict[str, Any]):
+        self.chat_id = chat_id
+        self.key = key
+        self.text = text
+        self.options = options
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+# Outbound queue for pushed notifications. Messages with the same key replace each other:
+# while one is still queued its text is swapped, once it is sent later ones edit it in place
+class Dispatcher:
+    def __init__(self, bot, workers: int = SEND_WORKERS, state=None, global_rate: float = SEND_GLOBAL_RATE):
+        self.bot = bot
+        self.workers = workers
+        # sent message ids survive a restart, so keyed updates keep editing the same message
+        self.state = state
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._pending: Dict[int, Deque[OutgoingMessage]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        # chats that are queued, waiting for their bucket or being sent right now
+        self._scheduled = set()
+        self._paused_until = 0.0
+        self._tasks: List[asyncio.Task] = []
+        self.message_ids: 'OrderedDict[Tuple[int, Hashable], int]' = OrderedDict()
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        self.stats = {'sent': 0, 'edited': 0, 'deleted': 0, 'merged': 0, 'retried': 0, 'failed': 0}
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def send(self, chat_id: int, text: str, key: Optional[Hashable] = None, **options) -> None:
+        options.setdefault('parse_mode', PARSE_MODE)
+        options.setdefault('disable_web_page_preview', True)
+
+        chunks = split_message(text)
+        if key is None:
+            for chunk in chunks:
+                self._enqueue(chat_id, None, chunk, options)
+            return
+
+        # the first part keeps the key, so a message that grows or shrinks still edits it;
+        # each further part is tracked as its own message
+        for i, chunk in enumerate(chunks):
+            self._enqueue(chat_id, key if i == 0 else (key, i), chunk, options)
+        # parts the message had before and has no more
+        i = len(chunks)
+        while self._drop_part(chat_id, (key, i), options):
+            i += 1
+
+    def _drop_part(self, chat_id: int, key: Hashable, options: Dict[str, Any]) -> bool:
+        queue = self._pending.get(chat_id, ())
+        queued = [message for message in queue if message.key == key]
+        for message in queued:
+            queue.remove(message)
+        if self._message_id(chat_id, key):
+            self._enqueue(chat_id, key, None, options)
+            return True
+        return bool(queued)
+
+    def _enqueue(self, chat_id: int, key: Optional[Hashable], text: Optional[str], options: Dict[str, Any]) -> None:
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+
+        if key is not None:
+            for message in queue:
+                if message.key == key:
+                    message.text = text
+                    message.options = options
+                    self.stats['merged'] += 1
+                    return
+
+        queue.append(OutgoingMessage(chat_id, key, text, options))
+        # a chat is handled by one worker at a time, so its messages keep their order
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+
+    async def notify(self, chat_id: int, key: Optional[Hashable], text: str) -> None:
+        self.send(chat_id, text, key=key)
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._pending.values())
+
+    def latency_stats(self) -> Dict[str, float]:
+        if not self.latencies:
+            return {'p50': 0.0, 'p99': 0.0}
+        ordered = sorted(self.latencies)
+        return {
+            'p50': ordered[len(ordered) // 2],
+            'p99': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        }
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._process(chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка отправки в chat_id {chat_id}: {e}")
+
+    async def _process(self, chat_id: int) -> None:
+        queue = self._pending.get(chat_id)
+        if not queue:
+            self._pending.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+            return
+
+        chat_delay = self._chat_bucket(chat_id).delay()
+        if chat_delay > 0:
+            # this chat waits without holding a worker
+            asyncio.get_running_loop().call_later(chat_delay, self._ready.put_nowait, chat_id)
+            return
+
+        while True:
+            wait = max(self._paused_until - time.monotonic(), self._global_bucket.delay())
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        message = queue.popleft()
+        self._global_bucket.consume()
+        self._chat_bucket(chat_id).consume()
+
+        try:
+            await self._deliver(message)
+            self.latencies.append(time.monotonic() - message.enqueued_at)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            self._paused_until = time.monotonic() + float(retry_after)
+            self.stats['retried'] += 1
+            logger.warning(f"Telegram flood limit, пауза {retry_after} сек")
+
+            message.attempts += 1
+            if message.attempts <= SEND_MAX_RETRIES:
+                queue.appendleft(message)
+            else:
+                self.stats['failed'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.error(f"Не удалось отправить сообщение в chat_id {chat_id}: {e}")
+
+        if queue:
+            self._ready.put_nowait(chat_id)
+        else:
+            self._pending.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+
+    def _message_id(self, chat_id: int, key: Hashable) -> Optional[int]:
+        message_id = self.message_ids.get((chat_id, key))
+        if message_id is None and self.state:
+            message_id = self.state.get(STATE_NAMESPACE, (chat_id, key))
+        return message_id
+
+    async def _deliver(self, message: OutgoingMessage) -> None:
+        tracked_key = (message.chat_id, message.key)
+        message_id = self._message_id(*tracked_key) if message.key is not None else None
+
+        if message.text is None:
+            self.message_ids.pop(tracked_key, None)
+            if self.state:
+                self.state.delete(STATE_NAMESPACE, tracked_key)
+            if message_id:
+                try:
+                    await self.bot.delete_message(message.chat_id, message_id)
+                    self.stats['deleted'] += 1
+                except BadRequest as e:
+                    logger.warning(f"Не удалось удалить сообщение {message_id} в chat_id {message.chat_id}: {e}")
+            return
+
+        if message_id:
+            try:
+                await self.bot.edit_message_text(
+                    message.text,
+                    chat_id=message.chat_id,
+                    message_id=message_id,
+                    **message.options
+                )
+                self.stats['edited'] += 1
+                return
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    return
+                # the old message is gone, post a new one
+                logger.warning(f"Не удалось отредактировать сообщение {message_id} в chat_id {message.chat_id}: {e}")
+
+        sent = await self.bot.send_message(message.chat_id, message.text, **message.options)
+        self.stats['sent'] += 1
+
+        if message.key is not None:
+            self.message_ids[tracked_key] = sent.message_id
+            self.message_ids.move_to_end(tracked_key)
+            while len(self.message_ids) > MAX_TRACKED_MESSAGES:
+                self.message_ids.popitem(last=False)
+            if self.state:
+                self.state.set(STATE_NAMESPACE, tracked_key, sent.message_id)
+
+
+dispatcher: Optional[Dispatcher] = None
+
+
+def start_dispatcher(bot, state=None, global_rate: float = SEND_GLOBAL_RATE) -> Dispatcher:
+    global dispatcher
+    dispatcher = Dispatcher(bot, state=state, global_rate=global_rate)
+    dispatcher.start()
+    return dispatcher
+
+
+def get_dispatcher() -> Optional[Dispatcher]:
+    return dispatcher
+
+
+def _dispatcher_metrics() -> Dict[Tuple, float]:
+    if dispatcher is None:
+        return {}
+    values = {(('event', name),): value for name, value in dispatcher.stats.items()}
+    values[(('event', 'queued'),)] = dispatcher.queue_depth()
+    return values
+
+
+metrics.registry.gauge('telegram_send_events', _dispatcher_metrics,
+                       help_text='Outgoing message counters and the current queue depth')
+
+
+async def stop_dispatcher() -> None:
+    global dispatcher
+    if dispatcher is not None:
+        await dispatcher.stop()
+        dispatcher = None
@@ -0,0 +1,220 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+from typing import Any, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+import config
+import gitlab_async
+import governor
+import metrics
+import sender
+import state_store
+import webhook
+from chat_registry import registry, CONFIG_RELOAD_INTERVAL
+from work_queue import WorkQueue, ShardTakenError, WORK_QUEUE_BATCH, SHARD_LEASE_TTL
+
+logger = logging.getLogger(__name__)
+
+# how often an idle worker looks for new work (seconds)
+WORK_QUEUE_POLL_INTERVAL = getattr(config, 'WORK_QUEUE_POLL_INTERVAL', 0.05)
+
+# (index, count) in a worker process, None in the ingest and single-process modes
+shard: Optional[Tuple[int, int]] = None
+
+_queue: Optional[WorkQueue] = None
+_receiver: Optional[webhook.WebhookReceiver] = None
+_shard_count = 1
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    index, _, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}")
+    return index, count
+
+
+def is_worker() -> bool:
+    return shard is not None
+
+
+def send_rate() -> float:
+    # the Telegram limit is per bot token, every worker gets its part of it
+    return sender.SEND_GLOBAL_RATE / (shard[1] if shard else 1)
+
+
+def shard_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def event_project_id(payload: Dict[str, Any]) -> Optional[int]:
+    # Job Hooks carry project_id at the top, the other events a project object
+    return (payload.get('project') or {}).get('id', payload.get('project_id'))
+
+
+def _queue_depth() -> Dict[Tuple, float]:
+    if _queue is None:
+        return {}
+    return {(('shard', str(index)),): depth for index, depth in _queue.depth().items()}
+
+
+metrics.registry.gauge('work_queue_depth', _queue_depth, help_text='Items waiting for a shard worker')
+
+
+# ---- ingest: the only process that talks to getUpdates and receives webhooks ----
+
+async def route_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat if isinstance(update, Update) else None
+    target = registry.shard_of(chat.id, _shard_count) if chat else 0
+    await asyncio.to_thread(_queue.put, target, 'update', update.to_dict())
+
+
+class ForwardingReceiver(webhook.WebhookReceiver):
+    # the ingest process only decides which shards an event concerns, the workers render and send it
+    def __init__(self, queue: WorkQueue, shard_count: int, **kwargs):
+        super().__init__(None, **kwargs)
+        self.queue = queue
+        self.shard_count = shard_count
+
+    async def handle_event(self, payload: Dict[str, Any], event: Optional[str] = None) -> int:
+        project_id = event_project_id(payload)
+        if project_id is None:
+            return 0
+        targets = sorted({registry.shard_of(chat_id, self.shard_count)
+                          for chat_id in webhook.subscribed_chats(project_id)})
+        if targets:
+            item = {'event': event, 'payload': payload}
+            await asyncio.to_thread(self.queue.put_many, [(target, 'webhook', item) for target in targets])
+        return len(targets)
+
+
+async def _ingest_reload_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # routing only needs the chat -> shard map, clients live in the workers
+    if registry.changed_on_disk():
+        await asyncio.to_thread(registry.reload)
+
+
+def register_ingest(application: Application, shard_count: int) -> None:
+    global _shard_count
+    _shard_count = shard_count
+    application.add_handler(TypeHandler(Update, route_update))
+
+
+async def ingest_post_init(application: Application) -> None:
+    global _queue, _receiver
+    _queue = WorkQueue()
+    _queue.set_meta('shard_count', str(_shard_count))
+    logger.info(f"Очередь {_queue.path}: {_shard_count} шардов, в очереди {sum(_queue.depth().values())}")
+
+    if registry.path:
+        application.job_queue.run_repeating(_ingest_reload_job, CONFIG_RELOAD_INTERVAL)
+
+    if webhook.WEBHOOK_ENABLED or webhook.METRICS_ENABLED:
+        _receiver = ForwardingReceiver(
+            _queue, _shard_count,
+            routes={webhook.METRICS_PATH: metrics.registry.render_prometheus} if webhook.METRICS_ENABLED else None,
+            accept_events=webhook.WEBHOOK_ENABLED
+        )
+        await _receiver.start()
+
+
+async def ingest_post_shutdown(application: Application) -> None:
+    global _queue, _receiver
+    # events already acknowledged to GitLab are queued before the queue closes
+    if _receiver is not None:
+        await _receiver.stop()
+        _receiver = None
+    if _queue is not None:
+        _queue.close()
+        _queue = None
+
+
+# ---- worker: owns the chats of one shard, polls GitLab for them and sends through the Bot API ----
+
+def configure_worker(index: int, count: int) -> None:
+    # runs before anything reads the registry or opens the state store
+    global shard
+    shard = (index, count)
+    registry.set_shard(index, count)
+    governor.set_workers(count)
+    state_store.STATE_PATH = shard_path(state_store.STATE_PATH, index)
+
+
+async def _consume(application: Application, receiver: webhook.WebhookReceiver, queue: WorkQueue,
+                   owner: str, stopping: asyncio.Event) -> None:
+    index = shard[0]
+    loop = asyncio.get_running_loop()
+    renewed_at = loop.time()
+    while not stopping.is_set():
+        if loop.time() - renewed_at > SHARD_LEASE_TTL / 3:
+            if not await asyncio.to_thread(queue.renew_shard, index, owner):
+                # someone took the shard over while this process was stuck, two owners would send twice
+                logger.error(f"Шард {index} перехвачен другим процессом, остановка")
+                return
+            renewed_at = loop.time()
+
+        items = await asyncio.to_thread(queue.claim, index)
+        for kind, payload in items:
+            if kind == 'update':
+                # the updater's queue: handlers run exactly as in the single-process mode
+                await application.update_queue.put(Update.de_json(payload, application.bot))
+            elif kind == 'webhook':
+                application.create_task(receiver.handle_event(payload['payload'], payload['event']))
+            else:
+                logger.warning(f"Неизвестный тип задачи в очереди: {kind}")
+
+        if len(items) < WORK_QUEUE_BATCH:
+            try:
+                await asyncio.wait_for(stopping.wait(), WORK_QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def run_worker(application: Application) -> None:
+    index, count = shard
+    queue = WorkQueue()
+    expected = queue.get_meta('shard_count')
+    if expected and int(expected) != count:
+        queue.close()
+        raise SystemExit(f"the ingest process routes to {expected} shards, not {count}")
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        queue.acquire_shard(index, owner)
+    except ShardTakenError as e:
+        queue.close()
+        raise SystemExit(f"{e}; a crashed worker's lease expires after {SHARD_LEASE_TTL} seconds")
+    logger.info(f"Воркер шарда {index}/{count}: {len(registry.chat_ids())} чатов, состояние в {state_store.STATE_PATH}")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    try:
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            receiver = webhook.WebhookReceiver(
+                sender.get_dispatcher().notify,
+                on_project_event=gitlab_async.snapshot_cache.invalidate_project
+            )
+            try:
+                await _consume(application, receiver, queue, owner, stopping)
+            finally:
+                await application.stop()
+                if application.post_shutdown:
+                    await application.post_shutdown(application)
+    finally:
+        queue.release_shard(index, owner)
+        queue.close()
@@ -0,0 +1,207 @@
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import state_store
+
+# a pipeline in one of these can still change without a new pipeline appearing in the list
+ACTIVE_STATUSES = ('created', 'waiting_for_resource', 'preparing', 'pending', 'running')
+
+# counters kept per stage: every job, then the statuses the message shows
+COUNTERS = ('total', 'success', 'failed', 'running', 'pending')
+_WIDTH = len(COUNTERS)
+_SLOTS = {status: i for i, status in enumerate(COUNTERS) if i}
+
+# distinct stage lists seen so far; most pipelines of a project share one tuple
+MAX_SHARED_STAGE_LISTS = 4096
+_stage_lists: Dict[Tuple, Tuple] = {}
+
+
+def intern(value: Any) -> Any:
+    # statuses, refs and stage names repeat across thousands of pipelines
+    return sys.intern(value) if type(value) is str else value
+
+
+def _shared(stage_names: Tuple) -> Tuple:
+    shared = _stage_lists.get(stage_names)
+    if shared is None:
+        shared = tuple(intern(name) for name in stage_names)
+        if len(_stage_lists) < MAX_SHARED_STAGE_LISTS:
+            _stage_lists[shared] = shared
+    return shared
+
+
+def count_stages(jobs: Iterable[Tuple[str, str]]) -> Tuple[Tuple, Tuple[int, ...]]:
+    # (stage, status) in pipeline order -> stage names in the order they first appear,
+    # and one flat tuple with len(COUNTERS) counters per stage
+    index: Dict[str, int] = {}
+    counts: List[int] = []
+    for stage, status in jobs:
+        i = index.get(stage)
+        if i is None:
+            i = index[stage] = len(index)
+            counts.extend((0,) * _WIDTH)
+        base = i * _WIDTH
+        counts[base] += 1
+        slot = _SLOTS.get(status)
+        if slot:
+            counts[base + slot] += 1
+    return _shared(tuple(index)), tuple(counts)
+
+
+class FailedJob(NamedTuple):
+    id: int
+    name: str
+    stage: str
+
+
+class PipelineSnapshot:
+    # immutable once built: replace() makes a changed copy, so a snapshot can be shared
+    # between the cache, watchers, follows and webhook renders
+    __slots__ = ('id', 'status', 'ref', 'created_at', 'duration', 'web_url', 'sha',
+                 'stage_names', 'counts', 'failed_jobs')
+
+    STATE_TAG = 'pipeline'
+
+    def __init__(self, id: int, status: str, ref: Optional[str] = None, created_at: Optional[str] = None,
+                 duration: int = 0, web_url: Optional[str] = None, sha: str = '', stage_names: Tuple = (),
+                 counts: Tuple[int, ...] = (), failed_jobs: Tuple[FailedJob, ...] = ()):
+        self.id = id
+        self.status = intern(status)
+        self.ref = intern(ref)
+        self.created_at = created_at
+        self.duration = duration
+        self.web_url = web_url
+        self.sha = sha
+        self.stage_names = _shared(stage_names)
+        self.counts = counts
+        self.failed_jobs = failed_jobs
+
+    def _fields(self) -> Tuple:
+        return (self.id, self.status, self.counts, self.stage_names, self.duration, self.ref, self.created_at,
+                self.web_url, self.sha, self.failed_jobs)
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, PipelineSnapshot):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self) -> int:
+        return hash((self.id, self.status, self.counts))
+
+    def __repr__(self) -> str:
+        return f"PipelineSnapshot(id={self.id}, status={self.status!r}, stages={len(self.stage_names)})"
+
+    def replace(self, **changes) -> 'PipelineSnapshot':
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return PipelineSnapshot(**fields)
+
+    def stages(self) -> Iterator[Tuple[str, Tuple[int, ...]]]:
+        # (name, (total, success, failed, running, pending))
+        counts = self.counts
+        for i, name in enumerate(self.stage_names):
+            yield name, counts[i * _WIDTH:(i + 1) * _WIDTH]
+
+    # the stored form is the dict pipeline_info used to be, so state saved by older versions still loads
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'ref': self.ref,
+            'created_at': self.created_at,
+            'duration': self.duration,
+            'web_url': self.web_url,
+            'sha': self.sha,
+            'stages': {name: {'summary': dict(zip(COUNTERS, counts))} for name, counts in self.stages()},
+            'failed_jobs': [job._asdict() for job in self.failed_jobs],
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'PipelineSnapshot':
+        stages = state.get('stages') or {}
+        counts = []
+        for stage in stages.values():
+            summary = stage.get('summary', {})
+            counts.extend(summary.get(name, 0) for name in COUNTERS)
+        return cls(
+            id=state['id'],
+            status=state['status'],
+            ref=state.get('ref'),
+            created_at=state.get('created_at'),
+            duration=state.get('duration') or 0,
+            web_url=state.get('web_url'),
+            sha=state.get('sha') or '',
+            stage_names=tuple(stages),
+            counts=tuple(counts),
+            failed_jobs=tuple(FailedJob(job['id'], job['name'], job['stage']) for job in state.get('failed_jobs', ())),
+        )
+
+
+state_store.register_type(PipelineSnapshot)
+
+
+def load_pipeline(value: Any) -> Optional[PipelineSnapshot]:
+    if value is None or isinstance(value, PipelineSnapshot):
+        return value
+    return PipelineSnapshot.from_state(value)
+
+
+class PipelineDiff:
+    __slots__ = ('new_pipeline', 'status', 'stages', 'failed_jobs', 'details')
+
+    def __init__(self, new_pipeline: bool = False, status: Optional[Tuple[Optional[str], str]] = None,
+                 stages: Tuple = (), failed_jobs: Tuple[FailedJob, ...] = (), details: bool = False):
+        self.new_pipeline = new_pipeline
+        # (old, new) when the pipeline status changed
+        self.status = status
+        # stages whose counters changed, appeared or disappeared
+        self.stages = stages
+        self.failed_jobs = failed_jobs
+        # duration, ref, sha, urls: shown in the message, not worth an edit on their own
+        self.details = details
+
+    @property
+    def progress(self) -> bool:
+        return bool(self.new_pipeline or self.status or self.stages)
+
+    def __bool__(self) -> bool:
+        return self.progress or bool(self.failed_jobs or self.details)
+
+    def __repr__(self) -> str:
+        return (f"PipelineDiff(new_pipeline={self.new_pipeline}, status={self.status}, stages={self.stages}, "
+                f"failed_jobs={len(self.failed_jobs)}, details={self.details})")
+
+
+NO_CHANGES = PipelineDiff()
+
+
+def diff(old: Optional[PipelineSnapshot], new: PipelineSnapshot) -> PipelineDiff:
+    if old is new:
+        return NO_CHANGES
+    if old is None or old.id != new.id:
+        return PipelineDiff(new_pipeline=True, status=(old.status if old else None, new.status),
+                            stages=new.stage_names, failed_jobs=new.failed_jobs, details=True)
+
+    status = (old.status, new.status) if old.status != new.status else None
+
+    # shared stage lists make the common "nothing moved" case two identity checks and one tuple compare
+    if old.stage_names is new.stage_names and old.counts == new.counts:
+        stages = ()
+    else:
+        before = dict(old.stages())
+        stages = tuple(name for name, counts in new.stages() if before.pop(name, None) != counts) + tuple(before)
+
+    if old.failed_jobs == new.failed_jobs:
+        failed_jobs = ()
+    else:
+        known = {job.id for job in old.failed_jobs}
+        failed_jobs = tuple(job for job in new.failed_jobs if job.id not in known)
+
+    details = (old.duration, old.ref, old.sha, old.web_url, old.created_at) != \
+              (new.duration, new.ref, new.sha, new.web_url, new.created_at)
+
+    if not (status or stages or failed_jobs or details):
+        return NO_CHANGES
+    return PipelineDiff(status=status, stages=stages, failed_jobs=failed_jobs, details=details)
@@ -0,0 +1,252 @@
+import abc
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = getattr(config, 'STATE_BACKEND', 'sqlite')
+STATE_PATH = getattr(config, 'STATE_PATH', 'bot_state.sqlite3')
+STATE_BATCH_SIZE = getattr(config, 'STATE_BATCH_SIZE', 100)
+STATE_FLUSH_INTERVAL = getattr(config, 'STATE_FLUSH_INTERVAL', 5)
+
+_DELETED = object()
+
+
+def encode_key(key: Any) -> str:
+    return json.dumps(key, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_key(raw: str) -> Any:
+    # tuples come back from JSON as lists
+    def to_tuple(value):
+        if isinstance(value, list):
+            return tuple(to_tuple(item) for item in value)
+        return value
+    return to_tuple(json.loads(raw))
+
+
+# classes stored as {'__type__': STATE_TAG, ...to_state()} and rebuilt with from_state()
+_types: Dict[str, Any] = {}
+
+
+def register_type(cls) -> None:
+    _types[cls.STATE_TAG] = cls
+
+
+def _encode_object(value: Any) -> Dict[str, Any]:
+    tag = getattr(value, 'STATE_TAG', None)
+    if tag not in _types:
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+    return dict(value.to_state(), __type__=tag)
+
+
+def _decode_object(value: Dict[str, Any]) -> Any:
+    cls = _types.get(value.get('__type__'))
+    return cls.from_state(value) if cls else value
+
+
+def encode_value(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=_encode_object)
+
+
+def decode_value(raw: str) -> Any:
+    return json.loads(raw, object_hook=_decode_object)
+
+
+# Namespaced key/value store for state that must survive a restart
+# (last seen ids, cached snapshots, sent message ids). Keys and values must be JSON-serializable
+# or of a class passed to register_type. Values are encoded by set(), so a bad value fails there,
+# and get()/items() always return a decoded copy, never the object that was stored
+class StateStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        pass
+
+    @abc.abstractmethod
+    def set(self, namespace: str, key: Any, value: Any) -> None:
+        pass
+
+    @abc.abstractmethod
+    def delete(self, namespace: str, key: Any) -> None:
+        pass
+
+    @abc.abstractmethod
+    def items(self, namespace: str) -> Iterator[Tuple[Any, Any]]:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self):
+        self._data: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            raw_value = self._data.get(namespace, {}).get(encode_key(key))
+        return decode_value(raw_value) if raw_value is not None else default
+
+    def set(self, namespace: str, key: Any, value: Any) -> None:
+        raw_value = encode_value(value)
+        with self._lock:
+            self._data.setdefault(namespace, {})[encode_key(key)] = raw_value
+
+    def delete(self, namespace: str, key: Any) -> None:
+        with self._lock:
+            self._data.get(namespace, {}).pop(encode_key(key), None)
+
+    def items(self, namespace: str) -> Iterator[Tuple[Any, Any]]:
+        with self._lock:
+            rows = list(self._data.get(namespace, {}).items())
+        for raw_key, raw_value in rows:
+            yield decode_key(raw_key), decode_value(raw_value)
+
+
+class SQLiteStateStore(StateStore):
+    def __init__(self, path: str = STATE_PATH, batch_size: int = STATE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        # encoded writes are buffered and flushed in one transaction; reads look at the buffer first
+        self._pending: Dict[Tuple[str, str], Any] = {}
+        self._flushing = False
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            ' namespace TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, key)'
+            ') WITHOUT ROWID'
+        )
+        self._connection.commit()
+
+    def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        raw_key = encode_key(key)
+        with self._lock:
+            raw_value = self._pending.get((namespace, raw_key))
+            if raw_value is _DELETED:
+                return default
+            if raw_value is None:
+                row = self._connection.execute(
+                    'SELECT value FROM state WHERE namespace = ? AND key = ?',
+                    (namespace, raw_key)
+                ).fetchone()
+                raw_value = row[0] if row else None
+        return decode_value(raw_value) if raw_value is not None else default
+
+    def set(self, namespace: str, key: Any, value: Any) -> None:
+        self._write(namespace, key, encode_value(value))
+
+    def delete(self, namespace: str, key: Any) -> None:
+        self._write(namespace, key, _DELETED)
+
+    def _write(self, namespace: str, key: Any, raw_value: Any) -> None:
+        with self._lock:
+            self._pending[(namespace, encode_key(key))] = raw_value
+            full = len(self._pending) >= self.batch_size and not self._flushing
+            if full:
+                self._flushing = True
+        if full:
+            self._flush_full_batch()
+
+    def _flush_full_batch(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not on the event loop: this thread can wait for the disk
+            self._flush_batch()
+            return
+        # set() is called from handlers: the transaction runs in a thread, not on the event loop
+        loop.run_in_executor(None, self._flush_batch).add_done_callback(_log_flush_error)
+
+    def _flush_batch(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._flushing = False
+
+    def items(self, namespace: str) -> Iterator[Tuple[Any, Any]]:
+        self.flush()
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT key, value FROM state WHERE namespace = ?',
+                (namespace,)
+            ).fetchall()
+        for raw_key, raw_value in rows:
+            yield decode_key(raw_key), decode_value(raw_value)
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            now = time.time()
+            upserts = [
+                (namespace, raw_key, raw_value, now)
+                for (namespace, raw_key), raw_value in self._pending.items() if raw_value is not _DELETED
+            ]
+            deletes = [
+                (namespace, raw_key)
+                for (namespace, raw_key), raw_value in self._pending.items() if raw_value is _DELETED
+            ]
+            # the buffer is dropped only once the transaction is committed, a failed one is retried
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)',
+                    upserts
+                )
+                self._connection.executemany('DELETE FROM state WHERE namespace = ? AND key = ?', deletes)
+            self._pending = {}
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+
+_store: Optional[StateStore] = None
+
+
+def get_store() -> StateStore:
+    global _store
+    if _store is None:
+        if STATE_BACKEND == 'sqlite':
+            _store = SQLiteStateStore(STATE_PATH)
+        else:
+            _store = MemoryStateStore()
+        logger.info(f"Хранилище состояния: {type(_store).__name__}")
+    return _store
+
+
+def _log_flush_error(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception():
+        logger.error(f"Не удалось сохранить состояние: {future.exception()}")
+
+
+async def flush_job(context) -> None:
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, get_store().flush)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить состояние: {e}")
+
+
+def close_store() -> None:
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
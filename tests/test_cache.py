@@ -0,0 +1,107 @@
+import asyncio
+
+from cache import SnapshotCache
+
+
+def run_lookups(cache, values, probe_etag='E', count=3, **kwargs):
+    calls = []
+
+    async def fetch():
+        calls.append('fetch')
+        return values.pop(0)
+
+    async def revalidate(etag, value):
+        calls.append(('probe', etag))
+        # a hook that can't vouch for the value asks for a refetch
+        return None if value == 'running' else probe_etag
+
+    async def run():
+        results = [await cache.get('key', fetch, revalidate=revalidate, **kwargs) for _ in range(count)]
+        await asyncio.gather(*cache._probes)
+        return results
+    return asyncio.run(run()), calls
+
+
+def test_fresh_entry_is_a_hit():
+    results, calls = run_lookups(SnapshotCache(ttl=60), ['a'])
+    assert results == ['a'] * 3
+    assert calls == ['fetch', ('probe', None)]
+
+
+def test_cold_miss_learns_the_etag_after_the_fetch():
+    cache = SnapshotCache(ttl=0)
+    results, calls = run_lookups(cache, ['a', 'b'], count=3)
+    # cold: fetch first, the ETag comes from a probe after it; every expiry is then a 304
+    assert calls == ['fetch', ('probe', None), ('probe', 'E'), ('probe', 'E')]
+    assert results == ['a'] * 3
+    assert cache.stats['revalidated'] == 2
+
+
+class MemoryState:
+    def __init__(self):
+        self.values = {}
+
+    def set(self, namespace, key, value):
+        self.values[(namespace, key)] = value
+
+    def delete(self, namespace, key):
+        self.values.pop((namespace, key), None)
+
+    def items(self, namespace):
+        return [(key, value) for (space, key), value in self.values.items() if space == namespace]
+
+
+def test_cold_entry_is_persisted_once_it_has_an_etag():
+    state = MemoryState()
+    cache = SnapshotCache(ttl=60)
+    cache.attach_store(state)
+    run_lookups(cache, ['a'], count=1)
+    assert list(state.values.values()) == [{'value': 'a', 'etag': 'E'}]
+
+
+def test_failed_etag_probe_keeps_the_entry():
+    cache = SnapshotCache(ttl=60)
+
+    async def fetch():
+        return 'a'
+
+    async def revalidate(etag, value):
+        raise ConnectionError('down')
+
+    async def run():
+        value = await cache.get('key', fetch, revalidate=revalidate)
+        await asyncio.gather(*cache._probes)
+        return value, await cache.get('key', fetch, revalidate=revalidate)
+    assert asyncio.run(run()) == ('a', 'a')
+    assert cache.stats['hits'] == 1
+
+
+def test_revalidation_can_ask_for_a_refetch():
+    results, calls = run_lookups(SnapshotCache(ttl=0), ['running', 'running', 'success'])
+    assert calls == ['fetch', ('probe', None), ('probe', None), 'fetch', ('probe', None), ('probe', None), 'fetch',
+                     ('probe', None)]
+    assert results == ['running', 'running', 'success']
+
+
+def test_max_age_revalidates_a_fresh_entry():
+    cache = SnapshotCache(ttl=60)
+    results, calls = run_lookups(cache, ['a'], count=2, max_age=0)
+    assert calls == ['fetch', ('probe', None), ('probe', 'E')]
+    assert results == ['a', 'a']
+    assert cache.stats['revalidated'] == 1
+
+
+def test_concurrent_lookups_share_one_fetch():
+    cache = SnapshotCache(ttl=60)
+    calls = []
+
+    async def fetch():
+        calls.append('fetch')
+        await asyncio.sleep(0.01)
+        return 'a'
+
+    async def run():
+        return await asyncio.gather(*(cache.get('key', fetch) for _ in range(5)))
+    assert asyncio.run(run()) == ['a'] * 5
+    assert calls == ['fetch']
+    assert cache.stats['coalesced'] == 4
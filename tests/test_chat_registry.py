@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from chat_registry import ChatRegistry, ConfigError, ConfigSnapshot, validate, validate_entry
+
+
+def test_valid_entry_is_cleaned():
+    chat_id, entry = validate_entry('100', {'gitlab_token': 't', 'project_id': 5, 'watch': True, 'color': 'red'})
+    assert chat_id == 100
+    # unknown keys are reported and dropped
+    assert entry == {'gitlab_token': 't', 'project_id': 5, 'watch': True}
+
+
+@pytest.mark.parametrize('chat_id, entry, message', [
+    ('abc', {'gitlab_token': 't', 'project_id': 5}, 'not a number'),
+    ('1', ['gitlab_token'], 'must be an object'),
+    ('1', {'gitlab_token': 't', 'project_id': '5'}, 'project_id must be int'),
+    ('1', {'gitlab_token': 't', 'project_id': True}, 'project_id must be int'),
+    ('1', {'gitlab_token': 't', 'project_ids': [5, 'x']}, 'project_ids must be numbers'),
+    ('1', {'gitlab_token': 't'}, 'project_id, project_ids or group_id is required'),
+    ('1', {'gitlab_token': 't', 'group_id': 3, 'mr_policy': 'oldest'}, 'mr_policy must be one of'),
+])
+def test_invalid_entries_are_rejected(chat_id, entry, message):
+    with pytest.raises(ConfigError, match=message):
+        validate_entry(chat_id, entry)
+
+
+def test_broken_entry_does_not_take_the_others_down():
+    chats = validate({'1': {'gitlab_token': 't', 'project_id': 5}, '2': {'gitlab_token': 't'}}, 'test.json')
+    assert list(chats) == [1]
+
+
+def test_entry_without_a_token_is_kept_with_a_warning(caplog):
+    chats = validate({'1': {'project_id': 5}}, 'config.py')
+    assert chats == {1: {'project_id': 5}}
+    assert 'chat 1' in caplog.text and 'gitlab_token' in caplog.text
+    assert ConfigSnapshot(chats).by_token == {}
+
+
+def test_reload_reports_chats_that_stopped_watching(tmp_path):
+    path = tmp_path / 'chats.json'
+    path.write_text(json.dumps({'1': {'gitlab_token': 't', 'project_id': 5, 'watch': True},
+                                '2': {'gitlab_token': 't', 'project_id': 6, 'watch': True}}))
+    registry = ChatRegistry(str(path))
+    registry.reload()
+
+    path.write_text(json.dumps({'1': {'gitlab_token': 't', 'project_id': 5},
+                                '2': {'gitlab_token': 't', 'project_id': 7, 'watch': True}}))
+    diff = registry.reload()
+    assert sorted(diff.changed) == [1, 2]
+    assert diff.unwatched == [1]
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+
+import follow
+import state_store
+from snapshot import PipelineSnapshot
+
+PROJECT_ID = 7
+
+
+def pipeline(status, counts):
+    return PipelineSnapshot(id=31, status=status, ref='main', created_at='2024-03-01T12:30:00Z',
+                            stage_names=('test',), counts=counts)
+
+
+class JobQueue:
+    def run_repeating(self, callback, interval, first=None, data=None, name=None):
+        pass
+
+    def get_jobs_by_name(self, name):
+        return []
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+    monkeypatch.setattr(follow, 'follows', {})
+    monkeypatch.setattr(follow, 'following', {})
+    store = state_store.MemoryStateStore()
+    monkeypatch.setattr(follow, 'get_store', lambda: store)
+    monkeypatch.setattr(follow, 'format_pipeline_message', lambda info: f"{info.status} {info.counts}")
+    monkeypatch.setattr(follow, 'get_dispatcher', lambda: SimpleNamespace(
+        send=lambda chat_id, text, key=None: sent.append((chat_id, text))))
+    return sent
+
+
+def test_cached_snapshot_does_not_roll_the_poller_back(sent):
+    application = SimpleNamespace(job_queue=JobQueue())
+    stale = pipeline('running', (2, 0, 0, 1, 1))
+    follow.start_follow(application, 1, PROJECT_ID, stale)
+
+    # the poller has seen a job finish since the snapshot was cached
+    poller = follow.follows[(PROJECT_ID, 31)]
+    assert follow._update(poller, pipeline('running', (2, 1, 0, 1, 0)))
+
+    follow.start_follow(application, 2, PROJECT_ID, stale)
+    assert poller.pipeline_info.counts == (2, 1, 0, 1, 0)
+    assert sent[-1] == (2, 'running (2, 1, 0, 1, 0)')
+
+
+def test_finished_pipeline_is_not_polled(sent):
+    application = SimpleNamespace(job_queue=JobQueue())
+    follow.start_follow(application, 1, PROJECT_ID, pipeline('success', (1, 1, 0, 0, 0)))
+    assert follow.follows == {} and follow.following == {}
+    assert sent == [(1, 'success (1, 1, 0, 0, 0)')]
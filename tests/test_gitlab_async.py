@@ -0,0 +1,87 @@
+import asyncio
+
+import gitlab_async
+import parser
+from cache import SnapshotCache
+from snapshot import PipelineSnapshot
+
+
+def pipeline(status):
+    return PipelineSnapshot(id=31, status=status, ref='hw-2', created_at='2024-03-01T12:30:00Z', duration=0,
+                            web_url='https://gitlab.example/-/pipelines/31', sha='bcbb5ec3')
+
+
+def fake_gitlab(monkeypatch, status='running'):
+    monkeypatch.setattr(gitlab_async, 'snapshot_cache', SnapshotCache(ttl=60))
+    gitlab = {'status': status, 'jobs_etag': 'J1', 'calls': []}
+
+    async def run_gitlab(func, chat_id, *args, project_id=None, **kwargs):
+        gitlab['calls'].append(func.__name__)
+        if func is parser.get_last_pipeline:
+            return pipeline(gitlab['status'])
+        if func is parser.probe_pipelines_etag:
+            return 'L1'
+        if func is parser.probe_jobs_etag:
+            return gitlab['jobs_etag']
+        raise AssertionError(func)
+    monkeypatch.setattr(gitlab_async, 'run_gitlab', run_gitlab)
+    return gitlab
+
+
+def watch_ticks(gitlab, count, on_tick=lambda tick: None):
+    async def run():
+        for tick in range(count):
+            on_tick(tick)
+            await gitlab_async.get_last_pipeline(1, 7, max_age=0)
+            await asyncio.gather(*gitlab_async.snapshot_cache._probes)
+    asyncio.run(run())
+    return gitlab['calls']
+
+
+def test_running_pipeline_is_revalidated_by_its_jobs_page(monkeypatch):
+    gitlab = fake_gitlab(monkeypatch)
+    calls = watch_ticks(gitlab, 4)
+    # one fetch, then only jobs page probes: the list ETag is checked once per TTL
+    assert calls.count('get_last_pipeline') == 1
+    assert calls.count('probe_pipelines_etag') == 1
+    assert calls.count('probe_jobs_etag') == 4
+
+
+def test_moved_jobs_refetch_the_pipeline(monkeypatch):
+    gitlab = fake_gitlab(monkeypatch)
+    calls = watch_ticks(gitlab, 4, on_tick=lambda tick: gitlab.update(jobs_etag=f"J{tick // 2}"))
+    assert calls.count('get_last_pipeline') == 2
+
+
+def test_finished_pipeline_only_probes_the_list(monkeypatch):
+    gitlab = fake_gitlab(monkeypatch, status='success')
+    calls = watch_ticks(gitlab, 3)
+    assert calls == ['get_last_pipeline'] + ['probe_pipelines_etag'] * 3
+
+
+def test_call_queued_behind_its_project_leaves_the_token_slot_free(monkeypatch):
+    class Client:
+        private_token = 'shared-token'
+    monkeypatch.setattr(parser, 'get_gitlab_client', lambda chat_id: Client())
+    monkeypatch.setattr(gitlab_async, '_project_semaphores', {})
+    monkeypatch.setattr(gitlab_async, 'GITLAB_MAX_CONCURRENCY_PER_PROJECT', 1)
+    limit = gitlab_async.governor.limit_for('shared-token')
+    monkeypatch.setattr(limit, 'limit', 2.0)
+
+    async def run():
+        release = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def slow(chat_id):
+            asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+            return 'slow'
+
+        busy = [asyncio.ensure_future(gitlab_async.run_gitlab(slow, 1, project_id=7)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        # the second project 7 call waits for its project, not with one of the token's two slots
+        other = await asyncio.wait_for(gitlab_async.run_gitlab(lambda chat_id: 'other', 1, project_id=8), 1)
+        release.set()
+        return other, await asyncio.gather(*busy)
+
+    assert asyncio.run(run()) == ('other', ['slow', 'slow'])
+    assert limit.in_flight == 0
@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+
+import pytest
+
+import governor
+
+
+def test_cancelled_waiters_give_their_turn_away():
+    async def run():
+        limit = governor.AdaptiveLimit(1)
+        await limit.acquire(False)
+        waiting = [asyncio.ensure_future(limit.acquire(False)) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        # cancelled before and after release() looked at the queue
+        waiting[0].cancel()
+        limit.release()
+        waiting[1].cancel()
+        results = await asyncio.gather(*waiting, return_exceptions=True)
+
+        assert [type(result) for result in results[:2]] == [asyncio.CancelledError] * 2
+        assert results[2] is None
+        assert limit.in_flight == 1
+        assert not any(limit._waiters)
+    asyncio.run(run())
+
+
+def test_commands_are_woken_before_background_refreshes():
+    async def run():
+        limit = governor.AdaptiveLimit(1)
+        await limit.acquire(True)
+        order = []
+
+        async def wait(name, interactive):
+            await limit.acquire(interactive)
+            order.append(name)
+            limit.release()
+
+        tasks = [asyncio.ensure_future(wait('background', False)), asyncio.ensure_future(wait('command', True))]
+        await asyncio.sleep(0)
+        limit.release()
+        await asyncio.gather(*tasks)
+        assert order == ['command', 'background']
+    asyncio.run(run())
+
+
+def request(token, path='/api/v4/projects/7/pipelines'):
+    class Request:
+        headers = {'PRIVATE-TOKEN': token}
+        path_url = path
+    return Request()
+
+
+def test_background_requests_never_sleep_in_the_pool_thread(monkeypatch):
+    monkeypatch.setattr(governor.time, 'sleep', lambda seconds: pytest.fail('slept in an executor thread'))
+    bucket = governor.for_token('bg-token').bucket
+    bucket.tokens = -100
+
+    governor.before_request(request('bg-token'))
+    assert bucket.tokens < -100
+
+
+def test_wait_turn_prepays_the_first_request_of_a_call():
+    async def run():
+        bucket = governor.for_token('paid-token').bucket
+        await governor.wait_turn('paid-token', 7)
+        after_turn = bucket.tokens
+        context = contextvars.copy_context()
+        context.run(governor.prepay)
+        context.run(governor.before_request, request('paid-token'))
+        assert bucket.tokens >= after_turn
+        context.run(governor.before_request, request('paid-token'))
+        assert bucket.tokens < after_turn
+    asyncio.run(run())
+
+
+def test_commands_are_refused_instead_of_waiting_too_long(monkeypatch):
+    monkeypatch.setattr(governor.metrics, 'in_command', lambda: True)
+    bucket = governor.for_token('busy-token').bucket
+    bucket.tokens = -bucket.rate * (governor.GITLAB_RATE_LIMIT_MAX_WAIT + 5)
+    with pytest.raises(governor.RateLimitedError, match='try again in'):
+        asyncio.run(governor.wait_turn('busy-token'))
+
+
+def test_workers_split_the_token_budget():
+    governor.set_workers(4)
+    try:
+        token = governor.for_token('sharded-token')
+        assert token.bucket.rate == governor.GITLAB_TOKEN_RATE / 4
+        assert token.bucket.capacity == governor.GITLAB_TOKEN_BURST / 4
+        assert token.limit.limit == max(1, governor.GITLAB_TOKEN_CONCURRENCY // 4)
+        assert governor._project_bucket('7').rate == governor.GITLAB_PROJECT_RATE / 4
+
+        # what GitLab says is left of the window is shared as well
+        token.record(200, {'RateLimit-Remaining': '100', 'RateLimit-Reset': str(governor.time.time() + 100)})
+        assert token.bucket.rate == pytest.approx(1 / 4, rel=0.05)
+    finally:
+        governor.set_workers(1)
+    assert governor.for_token('sharded-token').bucket.rate == governor.GITLAB_TOKEN_RATE
@@ -0,0 +1,19 @@
+import logging
+
+import log_setup
+
+
+def record(**extra):
+    record = logging.LogRecord('chat', logging.INFO, __file__, 1, '/pipeline', (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_text_format_keeps_the_chat_fields():
+    text = log_setup.TextFormatter().format(record(chat_id=1001, username='student', command=None))
+    assert text.endswith(' - chat - INFO - /pipeline [chat_id=1001 username=student]')
+
+
+def test_text_format_without_extras_is_unchanged():
+    text = log_setup.TextFormatter().format(record())
+    assert text.endswith(' - chat - INFO - /pipeline')
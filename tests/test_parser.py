@@ -0,0 +1,46 @@
+from parser import extract_error_tail
+
+
+def trace(*lines):
+    return '\n'.join(lines).encode()
+
+
+def test_tail_keeps_the_last_lines():
+    text = trace(*(f"step {i}" for i in range(100)))
+    assert extract_error_tail(text, lines=3) == 'step 97\nstep 98\nstep 99'
+
+
+def test_truncated_trace_drops_the_cut_first_line():
+    assert extract_error_tail(trace('ep 41', 'step 42', 'step 43'), truncated=True) == 'step 42\nstep 43'
+
+
+def test_colors_progress_bars_and_blank_lines_are_removed():
+    text = trace(
+        '\x1b[0K\x1b[32;1m$ pytest\x1b[0;m',
+        'Downloading 10%\rDownloading 50%\rDownloading 100%\r',
+        '   ',
+        '\x1b[31mE   assert 1 == 2\x1b[0m',
+    )
+    assert extract_error_tail(text) == '$ pytest\nDownloading 100%\nE   assert 1 == 2'
+
+
+def test_runner_housekeeping_after_the_failure_is_skipped():
+    text = trace(
+        'section_start:1700000000:step_script\r\x1b[0KExecuting "step_script"',
+        'E   AssertionError: boom',
+        'section_end:1700000001:step_script\r\x1b[0K',
+        'section_start:1700000001:after_script\r\x1b[0KRunning after_script',
+        'cleanup output',
+        'section_end:1700000002:after_script\r\x1b[0K',
+        'section_start:1700000002:upload_artifacts_on_failure[collapsed=true]\r\x1b[0KUploading artifacts',
+        'report.xml: found 1 matching artifact files',
+        'section_end:1700000003:upload_artifacts_on_failure\r\x1b[0K',
+        'ERROR: Job failed: exit code 1',
+    )
+    assert extract_error_tail(text) == ('Executing "step_script"\nE   AssertionError: boom\n'
+                                        'ERROR: Job failed: exit code 1')
+
+
+def test_invalid_utf8_does_not_break_the_tail():
+    assert extract_error_tail(b'ok\n\xff\xfe broken\nend') == 'ok\n�� broken\nend'
+
@@ -0,0 +1,91 @@
+import pytest
+
+import render
+from render import TELEGRAM_MESSAGE_LIMIT
+
+MODES = ('HTML', 'MarkdownV2')
+
+
+def failed_job(trace):
+    return {
+        'id': 381,
+        'name': 'unit <tests>',
+        'stage': 'test',
+        'status': 'failed',
+        'failure_reason': 'script_failure',
+        'web_url': 'https://gitlab.example/group/project/-/jobs/381',
+        'trace': trace,
+    }
+
+
+def code_block(text, mode):
+    if mode == 'HTML':
+        return text.split('<pre>', 1)[1].rsplit('</pre>', 1)[0]
+    return text.split('```\n', 1)[1].rsplit('\n```', 1)[0]
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('trace', [
+    '\n'.join(['E   assert a <= b && c >= d <module>'] * 400),
+    'x' * 10000,
+    '&<>' * 3000,
+    '`\\' * 3000,
+])
+def test_job_message_fits_one_telegram_message(mode, trace):
+    footer = '\n…and 2 more failed jobs in pipeline #31'
+    text = render.render_job(failed_job(trace), mode, footer=footer)
+    assert len(text) <= TELEGRAM_MESSAGE_LIMIT
+    assert text.endswith(footer)
+    assert code_block(text, mode)
+
+
+def test_job_trace_keeps_whole_lines_from_the_end():
+    lines = [f"E line {i} <fail>" for i in range(1000)]
+    block = code_block(render.render_job(failed_job('\n'.join(lines)), 'HTML'), 'HTML')
+    kept = block.split('\n')
+    assert kept[-1] == 'E line 999 &lt;fail&gt;'
+    assert kept[0] == render.escape(lines[-len(kept)], 'HTML')
+
+
+@pytest.mark.parametrize('mode, trace, unit', [
+    ('HTML', '&' * 5000, '&amp;'),
+    ('MarkdownV2', '`' * 5000, '\\`'),
+    ('MarkdownV2', '\\' * 5000, '\\\\'),
+])
+def test_job_trace_cut_never_splits_an_escape(mode, trace, unit):
+    block = code_block(render.render_job(failed_job(trace), mode), mode)
+    assert block == unit * (len(block) // len(unit))
+
+
+def test_short_trace_is_shown_whole():
+    text = render.render_job(failed_job('npm ERR! code 1\nnpm ERR! <missing>'), 'HTML')
+    assert '<pre>npm ERR! code 1\nnpm ERR! &lt;missing&gt;</pre>' in text
+
+
+def test_short_message_is_one_chunk():
+    assert render.split_message('hello') == ['hello']
+    assert render.split_message('') == ['']
+
+
+def test_split_prefers_line_boundaries():
+    lines = [f"line {i:04d}" for i in range(1000)]
+    text = '\n'.join(lines)
+    chunks = render.split_message(text, limit=100)
+    assert ''.join(chunks) == text
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert all(chunk.endswith('\n') for chunk in chunks[:-1])
+
+
+@pytest.mark.parametrize('text, unit', [('&amp;' * 100, '&amp;'), ('\\.' * 100, '\\.')])
+def test_split_of_one_long_line_keeps_escapes_whole(text, unit):
+    chunks = render.split_message(text, limit=37)
+    assert ''.join(chunks) == text
+    assert all(len(chunk) <= 37 and chunk == unit * (len(chunk) // len(unit)) for chunk in chunks)
+
+
+@pytest.mark.parametrize('mode, expected', [
+    ('HTML', 'a &lt;b&gt; &amp; &quot;c&quot; _*[]'),
+    ('MarkdownV2', 'a <b\\> & "c" \\_\\*\\[\\]'),
+])
+def test_escape(mode, expected):
+    assert render.escape('a <b> & "c" _*[]', mode) == expected
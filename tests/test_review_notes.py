@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+from review_notes import NoteIndex, parse_note
+
+REVIEWER = 'Teacher - teacher'
+
+
+def kinds(entries):
+    return [(entry.kind, entry.text) for entry in entries]
+
+
+def test_blank_note_gives_nothing():
+    assert parse_note(1, REVIEWER, '  \n\t ') == []
+
+
+def test_short_note_is_a_comment_with_whitespace_collapsed():
+    assert kinds(parse_note(1, REVIEWER, '  Please   add\n tests ')) == [('comment', 'Please add tests')]
+
+
+def test_group_score_keeps_the_score_line():
+    entries = parse_note(1, REVIEWER, 'Checked everything.\nScore for the group is: 8/10')
+    assert kinds(entries) == [('group_score', 'Score for the group is: 8/10')]
+    assert entries[0].note_id == 1 and entries[0].reviewer == REVIEWER
+
+
+def test_long_grader_report_is_reduced_to_its_summary():
+    body = ('test_case ok\n' * 30 + 'Score for all previous groups together: 42\n'
+            'Preliminary correctness: 0.95\n')
+    assert kinds(parse_note(1, REVIEWER, body)) == [
+        ('total_score', 'Score for all previous groups together: 42'),
+        ('correctness', 'Preliminary correctness: 0.95'),
+    ]
+
+
+def test_long_note_without_summary_is_truncated():
+    (entry,) = parse_note(1, REVIEWER, 'word ' * 100)
+    assert entry.kind == 'comment'
+    assert entry.text == ('word ' * 100)[:300] + '...'
+
+
+def note(note_id, body, author_id=2, system=False):
+    return SimpleNamespace(id=note_id, body=body, system=system,
+                           author={'id': author_id, 'name': 'Teacher', 'username': 'teacher'})
+
+
+def test_index_parses_only_notes_added_since_the_last_update():
+    index = NoteIndex(limit=10)
+    asked = []
+
+    def fetch(notes):
+        def fetch_notes(after_id):
+            asked.append(after_id)
+            return notes
+        return fetch_notes
+
+    digest = index.update('mr', 1, fetch([note(11, 'second'), note(10, 'first'), note(9, 'mine', author_id=1),
+                                          note(8, 'merged', system=True)]))
+    assert [entry.text for entry in digest.entries] == ['second', 'first']
+
+    digest = index.update('mr', 1, fetch([note(12, 'third')]))
+    assert asked == [None, 11]
+    assert [entry.text for entry in digest.entries] == ['third', 'second', 'first']
+    assert digest.last_note_id == 12
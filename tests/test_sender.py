@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import sender
+import state_store
+
+CHAT_ID = 1001
+
+
+class Bot:
+    def __init__(self):
+        self.calls = []
+        self.next_id = 1
+
+    async def send_message(self, chat_id, text, **options):
+        self.calls.append(('send', self.next_id, text))
+        self.next_id += 1
+        return SimpleNamespace(message_id=self.next_id - 1)
+
+    async def edit_message_text(self, text, chat_id, message_id, **options):
+        self.calls.append(('edit', message_id, text))
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(('delete', message_id, None))
+
+
+@pytest.fixture
+def dispatch(monkeypatch):
+    monkeypatch.setattr(sender, 'split_message', lambda text: text.split('|'))
+    monkeypatch.setattr(sender, 'SEND_CHAT_RATE', 1000)
+    monkeypatch.setattr(sender, 'SEND_CHAT_BURST', 1000)
+    bot = Bot()
+    state = state_store.MemoryStateStore()
+
+    def run(*texts, key='live'):
+        async def main():
+            dispatcher = sender.Dispatcher(bot, workers=1, state=state, global_rate=1000)
+            dispatcher.start()
+            for text in texts:
+                dispatcher.send(CHAT_ID, text, key=key)
+            while dispatcher.queue_depth() or dispatcher._scheduled:
+                await asyncio.sleep(0.001)
+            await dispatcher.stop()
+        bot.calls.clear()
+        asyncio.run(main())
+        return bot.calls
+    return run
+
+
+def test_first_part_keeps_the_key(dispatch):
+    assert dispatch('short') == [('send', 1, 'short')]
+    # the message grew: its first part is edited in place, the new part is sent
+    assert dispatch('long|er') == [('edit', 1, 'long'), ('send', 2, 'er')]
+
+
+def test_parts_a_message_lost_are_deleted(dispatch):
+    dispatch('a|b|c')
+    assert dispatch('a2') == [('edit', 1, 'a2'), ('delete', 2, None), ('delete', 3, None)]
+    # the deleted parts are forgotten, even after a restart
+    assert dispatch('a3|b3') == [('edit', 1, 'a3'), ('send', 4, 'b3')]
+
+
+def test_queued_parts_are_dropped_instead_of_sent(dispatch):
+    assert dispatch('a|b|c', 'a2') == [('send', 1, 'a2')]
@@ -0,0 +1,78 @@
+import json
+
+import state_store
+from snapshot import FailedJob, PipelineSnapshot, count_stages, diff, load_pipeline
+
+JOBS = [('build', 'success'), ('test', 'failed'), ('test', 'running'), ('test', 'pending'), ('grade', 'created')]
+
+
+def pipeline(jobs=JOBS, **fields):
+    stage_names, counts = count_stages(jobs)
+    values = dict(id=31, status='running', ref='hw-2', created_at='2024-03-01T12:30:00Z', duration=12,
+                  web_url='https://gitlab.example/-/pipelines/31', sha='bcbb5ec3', stage_names=stage_names,
+                  counts=counts, failed_jobs=(FailedJob(381, 'unit', 'test'),))
+    values.update(fields)
+    return PipelineSnapshot(**values)
+
+
+def test_count_stages_keeps_stage_order_and_counts():
+    stage_names, counts = count_stages(JOBS)
+    assert stage_names == ('build', 'test', 'grade')
+    # total, success, failed, running, pending per stage
+    assert counts == (1, 1, 0, 0, 0, 3, 0, 1, 1, 1, 1, 0, 0, 0, 0)
+    assert list(pipeline().stages()) == [('build', (1, 1, 0, 0, 0)), ('test', (3, 0, 1, 1, 1)),
+                                        ('grade', (1, 0, 0, 0, 0))]
+
+
+def test_stage_lists_are_shared():
+    assert pipeline().stage_names is pipeline(id=32).stage_names
+
+
+def test_unchanged_pipeline_has_no_diff():
+    changes = diff(pipeline(), pipeline())
+    assert not changes and not changes.progress
+
+
+def test_first_and_new_pipeline():
+    changes = diff(None, pipeline())
+    assert changes.new_pipeline and changes.status == (None, 'running')
+    changes = diff(pipeline(), pipeline(id=32, status='pending'))
+    assert changes.new_pipeline and changes.status == ('running', 'pending')
+
+
+def test_stage_progress_names_the_stages():
+    moved = [('build', 'success'), ('test', 'failed'), ('test', 'success'), ('test', 'running'), ('grade', 'created')]
+    changes = diff(pipeline(), pipeline(jobs=moved))
+    assert changes.progress and changes.stages == ('test',) and changes.status is None
+
+
+def test_added_and_removed_stages():
+    changes = diff(pipeline(), pipeline(jobs=JOBS[:4] + [('deploy', 'created')]))
+    assert set(changes.stages) == {'deploy', 'grade'}
+
+
+def test_new_failed_jobs():
+    failed = (FailedJob(381, 'unit', 'test'), FailedJob(382, 'lint', 'test'))
+    changes = diff(pipeline(), pipeline(failed_jobs=failed))
+    assert changes.failed_jobs == (FailedJob(382, 'lint', 'test'),)
+    assert changes and not changes.progress
+
+
+def test_duration_alone_is_a_detail_not_progress():
+    changes = diff(pipeline(), pipeline(duration=13))
+    assert changes.details and not changes.progress
+
+
+def test_state_round_trip_keeps_the_legacy_dict_shape():
+    original = pipeline()
+    state = original.to_state()
+    assert state['stages']['test']['summary'] == {'total': 3, 'success': 0, 'failed': 1, 'running': 1, 'pending': 1}
+    assert state['failed_jobs'] == [{'id': 381, 'name': 'unit', 'stage': 'test'}]
+    assert load_pipeline(json.loads(json.dumps(state))) == original
+
+
+def test_state_store_encoding_restores_snapshots():
+    value = {'pipeline_info': pipeline(), 'mr_text': 'x'}
+    restored = state_store.decode_value(state_store.encode_value(value))
+    assert isinstance(restored['pipeline_info'], PipelineSnapshot)
+    assert restored == value
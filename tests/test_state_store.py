@@ -0,0 +1,81 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import state_store
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        store = state_store.MemoryStateStore()
+    else:
+        store = state_store.SQLiteStateStore(str(tmp_path / 'state.sqlite3'), batch_size=3)
+    yield store
+    store.close()
+
+
+def test_reads_are_copies_before_and_after_a_flush(store):
+    value = {'ids': [1, 2]}
+    store.set('ns', ('chat', 1), value)
+    value['ids'].append(3)
+
+    assert store.get('ns', ('chat', 1)) == {'ids': [1, 2]}
+    store.get('ns', ('chat', 1))['ids'].append(4)
+    store.flush()
+    assert store.get('ns', ('chat', 1)) == {'ids': [1, 2]}
+    assert list(store.items('ns')) == [(('chat', 1), {'ids': [1, 2]})]
+
+
+def test_unserializable_value_fails_in_set(store):
+    store.set('ns', 1, 'kept')
+    with pytest.raises(TypeError):
+        store.set('ns', 2, object())
+    store.flush()
+    assert list(store.items('ns')) == [(1, 'kept')]
+
+
+def test_store_needs_every_method():
+    class Partial(state_store.StateStore):
+        def get(self, namespace, key, default=None):
+            return default
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_failed_flush_keeps_the_batch(tmp_path):
+    store = state_store.SQLiteStateStore(str(tmp_path / 'state.sqlite3'))
+    store.set('ns', 1, 'a')
+    connection = store._connection
+    store._connection = sqlite3.connect(':memory:', check_same_thread=False)
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+    assert store.get('ns', 1) == 'a'
+
+    store._connection = connection
+    store.close()
+    reopened = state_store.SQLiteStateStore(str(tmp_path / 'state.sqlite3'))
+    assert reopened.get('ns', 1) == 'a'
+    reopened.close()
+
+
+def test_full_batch_is_written_off_the_event_loop(tmp_path, monkeypatch):
+    store = state_store.SQLiteStateStore(str(tmp_path / 'state.sqlite3'), batch_size=2)
+
+    async def run():
+        loop_thread = threading.get_ident()
+        flushed_in = []
+        flush = store.flush
+        monkeypatch.setattr(store, 'flush', lambda: flushed_in.append(threading.get_ident()) or flush())
+
+        store.set('ns', 1, 'a')
+        store.set('ns', 2, 'b')
+        while store._flushing:
+            await asyncio.sleep(0.01)
+        assert flushed_in and loop_thread not in flushed_in
+        assert not store._pending
+    asyncio.run(run())
+    store.close()
@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import state_store
+import watcher
+from snapshot import PipelineSnapshot
+
+CHAT_ID = 1001
+
+
+def pipeline(project_id, status='success'):
+    return PipelineSnapshot(id=project_id * 100, status=status, ref='main', created_at='2024-03-01T12:30:00Z',
+                            duration=0, web_url=f"https://gitlab.example/{project_id}/-/pipelines/1", sha='bcbb5ec3')
+
+
+class JobQueue:
+    def __init__(self):
+        self.scheduled = []
+
+    def run_once(self, callback, when, chat_id=None, name=None):
+        self.scheduled.append((chat_id, when))
+
+    def get_jobs_by_name(self, name):
+        return []
+
+
+@pytest.fixture
+def chats(monkeypatch):
+    store = state_store.MemoryStateStore()
+    configs = {}
+    monkeypatch.setattr(watcher, 'get_store', lambda: store)
+    monkeypatch.setattr(watcher, 'get_user_config', configs.get)
+    monkeypatch.setattr(watcher, 'get_all_chat_ids', lambda: list(configs))
+    monkeypatch.setattr(watcher, 'get_gitlab_client', lambda chat_id: object())
+    monkeypatch.setattr(watcher, 'watch_states', {})
+
+    async def get_chat_project_ids(chat_id, user_config):
+        return list(user_config.get('project_ids', []))
+
+    async def get_last_pipeline(chat_id, project_id, **kwargs):
+        return pipeline(project_id)
+
+    async def get_second_last_mr_details(chat_id, project_id, **kwargs):
+        return f"MR of {project_id}"
+
+    monkeypatch.setattr(watcher.gitlab_async, 'get_chat_project_ids', get_chat_project_ids)
+    monkeypatch.setattr(watcher.gitlab_async, 'get_last_pipeline', get_last_pipeline)
+    monkeypatch.setattr(watcher.gitlab_async, 'get_second_last_mr_details', get_second_last_mr_details)
+    application = SimpleNamespace(job_queue=JobQueue())
+    return SimpleNamespace(store=store, configs=configs, application=application)
+
+
+def tick(chats):
+    context = SimpleNamespace(job=SimpleNamespace(chat_id=CHAT_ID), application=chats.application)
+    asyncio.run(watcher.watch_tick(context))
+
+
+def test_every_subscribed_project_is_watched(chats):
+    chats.configs[CHAT_ID] = {'project_ids': [7, 8]}
+    assert watcher.watches_projects(chats.configs[CHAT_ID])
+    watcher.start_watch(chats.application, CHAT_ID)
+    tick(chats)
+
+    state = watcher.watch_states[CHAT_ID]
+    assert state.pipelines == {7: pipeline(7), 8: pipeline(8)}
+    assert state.mr_texts == {7: 'MR of 7', 8: 'MR of 8'}
+
+    saved = state_store.decode_value(state_store.encode_value(chats.store.get(watcher.STATE_NAMESPACE, CHAT_ID)))
+    restored = watcher.WatchState(CHAT_ID)
+    watcher._load(restored, saved)
+    assert restored.pipelines == state.pipelines and restored.mr_texts == state.mr_texts
+
+
+def test_unsubscribed_projects_are_forgotten(chats):
+    chats.configs[CHAT_ID] = {'project_ids': [7, 8]}
+    watcher.start_watch(chats.application, CHAT_ID)
+    tick(chats)
+    chats.configs[CHAT_ID] = {'project_ids': [8]}
+    tick(chats)
+    assert set(watcher.watch_states[CHAT_ID].pipelines) == {8}
+
+
+def test_state_saved_before_multi_project_watches_belongs_to_the_main_project(chats):
+    chats.configs[CHAT_ID] = {'project_id': 7}
+    state = watcher.WatchState(CHAT_ID)
+    watcher._load(state, {'pipeline_info': pipeline(7).to_state(), 'mr_text': 'MR of 7'})
+    assert state.pipelines == {7: pipeline(7)}
+    assert state.mr_texts == {7: 'MR of 7'}
+
+
+def test_removed_chat_loses_its_saved_watch(chats):
+    chats.configs[CHAT_ID] = {'project_ids': [7]}
+    watcher.start_watch(chats.application, CHAT_ID)
+    del chats.configs[CHAT_ID]
+    tick(chats)
+    assert CHAT_ID not in watcher.watch_states
+    assert chats.store.get(watcher.STATE_NAMESPACE, CHAT_ID) is None
+
+
+def test_restart_drops_saved_watches_of_unknown_chats(chats):
+    chats.store.set(watcher.STATE_NAMESPACE, CHAT_ID, {'pipelines': [], 'mr_texts': []})
+    asyncio.run(watcher.start_configured_watches(chats.application))
+    assert list(chats.store.items(watcher.STATE_NAMESPACE)) == []
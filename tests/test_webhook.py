@@ -0,0 +1,193 @@
+import asyncio
+import glob
+import json
+import os
+
+import pytest
+
+import webhook
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'webhook_samples')
+CHAT_ID = 1001
+PROJECT_ID = 422
+
+
+def load_samples():
+    # every recorded payload in the order the numbered files say GitLab sends them
+    payloads = []
+    for file_name in sorted(glob.glob(os.path.join(SAMPLES, '*.json'))):
+        with open(file_name, encoding='utf-8') as f:
+            data = json.load(f)
+        payloads += data if isinstance(data, list) else [data]
+    return payloads
+
+
+def event_of(payload):
+    return {kind: event for event, kind in webhook.EVENTS.items()}[payload['object_kind']]
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    monkeypatch.setattr(webhook, 'subscribed_chats', lambda project_id: [CHAT_ID] if project_id == PROJECT_ID else [])
+    sent = []
+
+    async def notify(chat_id, key, text):
+        sent.append((chat_id, key, text))
+
+    receiver = webhook.WebhookReceiver(notify, secret='test-secret')
+    receiver.sent = sent
+    return receiver
+
+
+def replay(receiver, payloads):
+    async def run():
+        return [await receiver.handle_event(payload, event_of(payload)) for payload in payloads]
+    return asyncio.run(run())
+
+
+def test_samples_fan_out_to_subscribed_chats(receiver):
+    payloads = load_samples()
+    assert [payload['object_kind'] for payload in payloads] == ['pipeline', 'build', 'build', 'merge_request', 'note']
+
+    assert replay(receiver, payloads) == [1] * len(payloads)
+    assert [key for _, key, _ in receiver.sent] == [
+        ('pipeline', PROJECT_ID, 31),
+        ('pipeline', PROJECT_ID, 31),
+        ('pipeline', PROJECT_ID, 31),
+        ('mr', PROJECT_ID, 7),
+        ('note', PROJECT_ID, 1244),
+    ]
+    assert {chat_id for chat_id, _, _ in receiver.sent} == {CHAT_ID}
+
+
+def test_job_events_update_stage_counters(receiver):
+    replay(receiver, load_samples()[:3])
+    first, _, last = (text for _, _, text in receiver.sent)
+
+    assert '<b>Pipeline #31</b>' in first
+    assert '<b>Status:</b> running' in first
+    assert '<code>hw-2</code>' in first
+    assert '<code>bcbb5ec3</code>' in first
+
+    def stage(text, name):
+        block = text.split(f"<b>{name}</b>\n", 1)[1].split('\n\n', 1)[0]
+        return [int(line.rsplit(': ', 1)[1]) for line in block.split('\n')]
+
+    # success, failed, running, pending
+    assert stage(first, 'BUILD') == [1, 0, 0, 0]
+    assert stage(first, 'TEST') == [0, 0, 1, 1]
+    assert stage(last, 'TEST') == [1, 1, 0, 0]
+    assert stage(last, 'GRADE') == [0, 0, 0, 0]
+
+
+def test_mr_and_note_messages(receiver):
+    replay(receiver, load_samples()[3:])
+    (_, _, mr_text), (_, _, note_text) = receiver.sent
+
+    assert '<b>MR 7</b>' in mr_text
+    assert '<b>Title:</b> HW-2: linked list' in mr_text
+    assert '<code>hw-2</code> → <code>main</code>' in mr_text
+    assert '<b>Reviewers:</b> teacher' in mr_text
+    assert 'Score for the group is: 8/10' in note_text
+    assert 'merge_requests/7#note_1244' in note_text
+
+
+def test_mr_author_is_not_the_user_acting_on_it(receiver):
+    mr = load_samples()[3]
+    approved = dict(mr, user={'id': 2, 'name': 'Teacher', 'username': 'teacher'})
+
+    # nobody seen yet has the author's id
+    replay(receiver, [approved])
+    assert '<b>Author:</b> \n' in receiver.sent[-1][2]
+
+    replay(receiver, [mr, approved])
+    assert '<b>Author:</b> student' in receiver.sent[-1][2]
+
+
+def test_job_event_without_a_build_id_is_skipped(receiver):
+    pipeline, job = load_samples()[:2]
+    job = {key: value for key, value in job.items() if key != 'build_id'}
+    assert replay(receiver, [pipeline, job]) == [1, 0]
+
+
+def test_job_event_before_its_pipeline_is_dropped(receiver):
+    jobs = [payload for payload in load_samples() if payload['object_kind'] == 'build']
+    assert replay(receiver, jobs) == [0, 0]
+    assert receiver.sent == []
+
+
+def test_repeated_job_state_is_not_rendered_again(receiver):
+    payloads = load_samples()
+    replay(receiver, payloads[:2] + payloads[1:2])
+    assert len(receiver.sent) == 2
+
+
+def test_unsubscribed_project_sends_nothing(receiver):
+    payload = dict(load_samples()[0], project={'id': 1, 'web_url': 'https://gitlab.example/other'})
+    assert replay(receiver, [payload]) == [0]
+    assert receiver.sent == []
+
+
+def post(receiver, body, token='test-secret', event='Pipeline Hook', length=None):
+    async def run():
+        server = await receiver.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            headers = f"X-Gitlab-Event: {event}\r\n"
+            if token is not None:
+                headers += f"X-Gitlab-Token: {token}\r\n"
+            writer.write(f"POST {receiver.path} HTTP/1.1\r\nHost: localhost\r\n{headers}"
+                         f"Content-Length: {len(body) if length is None else length}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            writer.close()
+            return status
+        finally:
+            # the fan-out runs after the reply, stop() waits for it
+            await receiver.stop()
+    return asyncio.run(run())
+
+
+def test_http_accepts_signed_events(receiver):
+    assert post(receiver, json.dumps(load_samples()[0]).encode()) == 200
+    assert len(receiver.sent) == 1
+
+
+@pytest.mark.parametrize('token', [None, '', 'wrong'])
+def test_http_rejects_bad_token(receiver, token):
+    assert post(receiver, json.dumps(load_samples()[0]).encode(), token=token) == 401
+    assert receiver.sent == []
+
+
+@pytest.mark.parametrize('body', [b'[{"object_kind": "pipeline"}]', b'"pipeline"', b'{not json'])
+def test_http_rejects_bodies_that_are_not_objects(receiver, body):
+    assert post(receiver, body) == 400
+
+
+@pytest.mark.parametrize('length', ['abc', '-1'])
+def test_http_rejects_a_bad_content_length(receiver, length):
+    assert post(receiver, b'{}', length=length) == 400
+
+
+def test_http_times_out_a_silent_client(receiver, monkeypatch):
+    monkeypatch.setattr(webhook, 'WEBHOOK_READ_TIMEOUT', 0.05)
+    # the head arrives, the promised body never does
+    assert post(receiver, b'', length=100) == 408
+
+
+def test_failed_fan_out_is_logged_and_forgotten(receiver, caplog):
+    async def notify(chat_id, key, text):
+        raise RuntimeError('telegram is down')
+    receiver.notify = notify
+
+    assert post(receiver, json.dumps(load_samples()[0]).encode()) == 200
+    assert not receiver._tasks
+    assert 'telegram is down' in caplog.text
+
+
+def test_receiver_needs_a_secret():
+    receiver = webhook.WebhookReceiver(None, secret='')
+    assert not receiver.verify('')
+    with pytest.raises(ValueError):
+        asyncio.run(receiver.start('127.0.0.1', 0))
@@ -0,0 +1,68 @@
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+import governor
+import metrics
+
+GITLAB_POOL_SIZE = getattr(config, 'GITLAB_POOL_SIZE', getattr(config, 'GITLAB_MAX_CONCURRENCY', 8))
+GITLAB_RETRIES = getattr(config, 'GITLAB_RETRIES', 3)
+GITLAB_RETRY_BACKOFF = getattr(config, 'GITLAB_RETRY_BACKOFF', 0.5)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+class GovernedAdapter(HTTPAdapter):
+    # every request, including each page of a listing, is counted against its token and project buckets
+    def send(self, request, *args, **kwargs):
+        governor.before_request(request)
+        return super().send(request, *args, **kwargs)
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=GITLAB_RETRIES,
+        backoff_factor=GITLAB_RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        # the last response goes back to python-gitlab, which turns it into its own exception
+        raise_on_status=False
+    )
+    adapter = GovernedAdapter(
+        pool_connections=4,
+        pool_maxsize=GITLAB_POOL_SIZE,
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(metrics.record_gitlab_response)
+    session.hooks['response'].append(governor.record_response)
+    return session
+
+
+def get_session() -> requests.Session:
+    # one keep-alive pool for every GitLab client: tokens differ only in request headers
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def close_session() -> None:
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
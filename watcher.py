@@ -0,0 +1,216 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from telegram.ext import Application, ContextTypes
+
+import config
+import gitlab_async
+import snapshot
+from chat_registry import get_user_config, get_all_chat_ids
+from parser import get_gitlab_client, format_pipeline_message
+from sender import get_dispatcher
+from state_store import get_store
+
+logger = logging.getLogger(__name__)
+
+WATCH_INTERVAL_ACTIVE = getattr(config, 'WATCH_INTERVAL_ACTIVE', 15)
+WATCH_INTERVAL_IDLE = getattr(config, 'WATCH_INTERVAL_IDLE', 60)
+WATCH_INTERVAL_MAX = getattr(config, 'WATCH_INTERVAL_MAX', 600)
+
+STATE_NAMESPACE = 'watch'
+
+ACTIVE_STATUSES = snapshot.ACTIVE_STATUSES
+
+
+class WatchState:
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        # project id -> last seen pipeline and MR message, for every project the chat subscribes to
+        self.pipelines: Dict[int, snapshot.PipelineSnapshot] = {}
+        self.mr_texts: Dict[int, str] = {}
+        self.interval = WATCH_INTERVAL_IDLE
+        # without announce the first tick only remembers the current state as a baseline
+        self.announce = False
+
+
+watch_states: Dict[int, WatchState] = {}
+
+
+def _job_name(chat_id: int) -> str:
+    return f"watch:{chat_id}"
+
+
+def _schedule(application: Application, state: WatchState, delay: float) -> None:
+    application.job_queue.run_once(watch_tick, delay, chat_id=state.chat_id, name=_job_name(state.chat_id))
+
+
+def _save(state: WatchState) -> None:
+    # pairs rather than dicts: JSON object keys would come back as strings
+    get_store().set(STATE_NAMESPACE, state.chat_id, {
+        'pipelines': list(state.pipelines.items()),
+        'mr_texts': list(state.mr_texts.items()),
+    })
+
+
+def _load(state: WatchState, saved: Dict[str, Any]) -> None:
+    if 'pipelines' in saved:
+        state.pipelines = {project_id: snapshot.load_pipeline(value) for project_id, value in saved['pipelines']}
+        state.mr_texts = dict(saved.get('mr_texts') or [])
+        return
+
+    # saved before chats could watch several projects: it was about the main project
+    project_id = (get_user_config(state.chat_id) or {}).get('project_id')
+    if project_id is None:
+        return
+    if saved.get('pipeline_info'):
+        state.pipelines[project_id] = snapshot.load_pipeline(saved['pipeline_info'])
+    if saved.get('mr_text'):
+        state.mr_texts[project_id] = saved['mr_text']
+
+
+def watches_projects(user_config: Optional[Dict[str, Any]]) -> bool:
+    return bool(user_config) and bool(
+        user_config.get('project_id') or user_config.get('project_ids') or user_config.get('group_id')
+    )
+
+
+def start_watch(application: Application, chat_id: int, announce: bool = False,
+                saved: Optional[Dict[str, Any]] = None) -> bool:
+    if chat_id in watch_states:
+        return False
+
+    state = WatchState(chat_id)
+    state.announce = announce
+    if saved:
+        # resumed after a restart: the saved state is the baseline, only real changes are sent
+        _load(state, saved)
+        state.announce = True
+    watch_states[chat_id] = state
+    _save(state)
+    _schedule(application, state, 0)
+    return True
+
+
+def stop_watch(application: Application, chat_id: int) -> bool:
+    state = watch_states.pop(chat_id, None)
+    get_store().delete(STATE_NAMESPACE, chat_id)
+    for job in application.job_queue.get_jobs_by_name(_job_name(chat_id)):
+        job.schedule_removal()
+    return state is not None
+
+
+async def start_configured_watches(application: Application) -> None:
+    saved_states = dict(get_store().items(STATE_NAMESPACE))
+
+    for chat_id in get_all_chat_ids():
+        user_config = get_user_config(chat_id)
+        if not watches_projects(user_config):
+            continue
+        # chats that ran /watch before the restart keep watching as well
+        if user_config.get('watch') or chat_id in saved_states:
+            start_watch(application, chat_id, saved=saved_states.get(chat_id))
+
+    # the chat was removed from the config while the bot was down
+    for chat_id in saved_states:
+        if chat_id not in watch_states:
+            get_store().delete(STATE_NAMESPACE, chat_id)
+
+
+async def _check_pipeline(context: ContextTypes.DEFAULT_TYPE, state: WatchState, user_config: Dict[str, Any],
+                          project_id: int, announce: bool) -> bool:
+    current = state.pipelines.get(project_id)
+    # a snapshot cached before this tick could hide a running pipeline's progress: the cache
+    # revalidates it through the pipelines list and jobs page ETags instead
+    active = current is not None and current.status in ACTIVE_STATUSES
+    pipeline_info = await gitlab_async.get_last_pipeline(
+        state.chat_id,
+        project_id,
+        ref=user_config.get('ref'),
+        status=user_config.get('pipeline_status'),
+        max_age=WATCH_INTERVAL_ACTIVE / 2 if active else None
+    )
+    if not pipeline_info or not snapshot.diff(current, pipeline_info):
+        return False
+
+    state.pipelines[project_id] = pipeline_info
+    if announce:
+        # progress of the same pipeline edits its message, a new pipeline or a new status is a new message
+        get_dispatcher().send(
+            state.chat_id,
+            format_pipeline_message(pipeline_info),
+            key=('pipeline', pipeline_info.id, pipeline_info.status)
+        )
+    return True
+
+
+async def _check_mr(context: ContextTypes.DEFAULT_TYPE, state: WatchState, user_config: Dict[str, Any],
+                    project_id: int, announce: bool) -> bool:
+    mr_text = await gitlab_async.get_second_last_mr_details(
+        state.chat_id,
+        project_id,
+        policy=user_config.get('mr_policy', 'latest'),
+        author=user_config.get('mr_author'),
+        target_branch=user_config.get('mr_target_branch')
+    )
+    if not mr_text or mr_text.startswith('❌') or mr_text == state.mr_texts.get(project_id):
+        return False
+
+    state.mr_texts[project_id] = mr_text
+    if announce:
+        get_dispatcher().send(state.chat_id, mr_text)
+    return True
+
+
+async def watch_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = context.job.chat_id
+    state = watch_states.get(chat_id)
+    if not state:
+        return
+
+    user_config = get_user_config(chat_id)
+    if not watches_projects(user_config):
+        # the chat left the config: its saved state goes too, or a restart would bring the watch back
+        stop_watch(context.application, chat_id)
+        return
+
+    announce = state.announce
+    state.announce = True
+    changed = False
+    try:
+        if not get_gitlab_client(chat_id):
+            await gitlab_async.init_gitlab_client(chat_id, user_config.get('gitlab_token'))
+
+        # the same projects as /pipeline and /mr: project_id, project_ids and the group's projects
+        project_ids = await gitlab_async.get_chat_project_ids(chat_id, user_config)
+        for project_id in set(state.pipelines) | set(state.mr_texts):
+            if project_id not in project_ids:
+                state.pipelines.pop(project_id, None)
+                state.mr_texts.pop(project_id, None)
+                changed = True
+
+        results = await asyncio.gather(
+            *(_check_pipeline(context, state, user_config, project_id, announce) for project_id in project_ids),
+            *(_check_mr(context, state, user_config, project_id, announce) for project_id in project_ids),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error(f"Ошибка наблюдения для chat_id {chat_id}: {result}")
+        changed = any(result is True for result in results) or changed
+    except Exception as e:
+        logger.error(f"Ошибка наблюдения для chat_id {chat_id}: {e}")
+
+    if changed and chat_id in watch_states:
+        _save(state)
+
+    # poll tightly while a pipeline runs, back off exponentially while nothing happens
+    if any(pipeline_info.status in ACTIVE_STATUSES for pipeline_info in state.pipelines.values()):
+        state.interval = WATCH_INTERVAL_ACTIVE
+    elif changed:
+        state.interval = WATCH_INTERVAL_IDLE
+    else:
+        state.interval = min(state.interval * 2, WATCH_INTERVAL_MAX)
+
+    if chat_id in watch_states:
+        _schedule(context.application, state, state.interval)
@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import sys
+import urllib.request
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import config
+from chat_registry import registry
+import log_setup
+import render
+import snapshot
+from parser import format_pipeline_message
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_ENABLED = getattr(config, 'WEBHOOK_ENABLED', False)
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/gitlab')
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', '')
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', False)
+METRICS_PATH = getattr(config, 'METRICS_PATH', '/metrics')
+# seconds a client gets to send the request head, and then the body
+WEBHOOK_READ_TIMEOUT = getattr(config, 'WEBHOOK_READ_TIMEOUT', 10)
+# seconds acknowledged events get to reach the chats on shutdown
+WEBHOOK_DRAIN_TIMEOUT = 5
+
+MAX_BODY_SIZE = 4 * 1024 * 1024
+MAX_TRACKED_PIPELINES = 1024
+MAX_TRACKED_AUTHORS = 4096
+
+# X-Gitlab-Event header -> object_kind of the payload
+EVENTS = {
+    'Pipeline Hook': 'pipeline',
+    'Job Hook': 'build',
+    'Merge Request Hook': 'merge_request',
+    'Note Hook': 'note',
+}
+
+# notify(chat_id, key, text): messages with the same key replace each other in the chat
+Notify = Callable[[int, Tuple, str], Awaitable[None]]
+
+
+def subscribed_chats(project_id: int) -> List[int]:
+    return registry.chats_for_project(project_id)
+
+
+class WebhookReceiver:
+    def __init__(self, notify: Notify, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH,
+                 on_project_event: Optional[Callable[[int], None]] = None,
+                 routes: Optional[Dict[str, Callable[[], str]]] = None, accept_events: bool = True):
+        self.notify = notify
+        self.secret = secret
+        self.path = path
+        self.on_project_event = on_project_event
+        # GET path -> text body, e.g. the Prometheus metrics
+        self.routes = routes or {}
+        self.accept_events = accept_events
+        # (project_id, pipeline_id) -> pipeline snapshot plus the known jobs, updated from Job Hooks
+        self.pipelines: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        # user id -> username, learned from events: MR hooks only carry the author's id
+        self.usernames: Dict[int, str] = {}
+        # fan-out of acknowledged events still running
+        self._tasks: Set[asyncio.Task] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def verify(self, token: Optional[str]) -> bool:
+        # without a secret anyone who reaches the port could post events to the chats
+        if not self.secret:
+            return False
+        return hmac.compare_digest((token or '').encode(), self.secret.encode())
+
+    async def handle_event(self, payload: Dict[str, Any], event: Optional[str] = None) -> int:
+        kind = EVENTS.get(event) if event else None
+        kind = kind or payload.get('object_kind')
+
+        if kind == 'pipeline':
+            project_id, text, key = self._pipeline_event(payload)
+        elif kind == 'build':
+            project_id, text, key = self._job_event(payload)
+        elif kind == 'merge_request':
+            project_id, text, key = self._mr_event(payload)
+        elif kind == 'note':
+            project_id, text, key = self._note_event(payload)
+        else:
+            logger.warning(f"Неизвестное событие webhook: {event or kind}")
+            return 0
+
+        if project_id is None:
+            return 0
+
+        if self.on_project_event:
+            self.on_project_event(project_id)
+
+        if not text:
+            return 0
+
+        chat_ids = subscribed_chats(project_id)
+        await asyncio.gather(*(self.notify(chat_id, key, text) for chat_id in chat_ids))
+        return len(chat_ids)
+
+    def _render_pipeline(self, project_id: int, pipeline_id: int) -> Tuple[int, Optional[str], Tuple]:
+        tracked = self.pipelines[(project_id, pipeline_id)]
+        stage_order = {stage: i for i, stage in enumerate(tracked['stage_order'])}
+        jobs = sorted(tracked['jobs'].items(), key=lambda item: (stage_order.get(item[1][0], len(stage_order)), item[0]))
+        stage_names, counts = snapshot.count_stages(stage_status for _, stage_status in jobs)
+        info = tracked['info'].replace(stage_names=stage_names, counts=counts)
+
+        if tracked['rendered'] and not snapshot.diff(tracked['info'], info).stages:
+            return project_id, None, ()
+
+        tracked['info'] = info
+        tracked['rendered'] = True
+        return project_id, format_pipeline_message(info), ('pipeline', project_id, pipeline_id)
+
+    def _pipeline_event(self, payload: Dict[str, Any]) -> Tuple[Optional[int], Optional[str], Tuple]:
+        attributes = payload.get('object_attributes', {})
+        project = payload.get('project', {})
+        project_id = project.get('id')
+        pipeline_id = attributes.get('id')
+        if project_id is None or pipeline_id is None:
+            return None, None, ()
+
+        previous = self.pipelines.pop((project_id, pipeline_id), None)
+        sha = attributes.get('sha') or ''
+        info = snapshot.PipelineSnapshot(
+            id=pipeline_id,
+            status=attributes.get('status'),
+            ref=attributes.get('ref'),
+            created_at=attributes.get('created_at'),
+            duration=attributes.get('duration') or 0,
+            web_url=attributes.get('url') or f"{project.get('web_url', '')}/-/pipelines/{pipeline_id}",
+            sha=sha[:8],
+            stage_names=previous['info'].stage_names if previous else (),
+            counts=previous['info'].counts if previous else (),
+        )
+
+        while len(self.pipelines) >= MAX_TRACKED_PIPELINES:
+            self.pipelines.pop(next(iter(self.pipelines)))
+
+        self.pipelines[(project_id, pipeline_id)] = {
+            'info': info,
+            'stage_order': attributes.get('stages') or [],
+            'jobs': {build['id']: (snapshot.intern(build['stage']), snapshot.intern(build['status']))
+                     for build in payload.get('builds', [])},
+            'rendered': bool(previous) and previous['info'].status == info.status,
+        }
+        return self._render_pipeline(project_id, pipeline_id)
+
+    def _job_event(self, payload: Dict[str, Any]) -> Tuple[Optional[int], Optional[str], Tuple]:
+        project_id = payload.get('project_id')
+        pipeline_id = payload.get('pipeline_id')
+        build_id = payload.get('build_id')
+        if build_id is None:
+            logger.warning(f"Job Hook без build_id для pipeline {pipeline_id}, пропущен")
+            return project_id, None, ()
+
+        tracked = self.pipelines.get((project_id, pipeline_id))
+        if not tracked:
+            # the Pipeline Hook carries the full picture, a lone job can't be summarized
+            logger.debug(f"Job Hook {build_id} до Pipeline Hook {pipeline_id}, пропущен")
+            return project_id, None, ()
+
+        tracked['jobs'][build_id] = (snapshot.intern(payload.get('build_stage')),
+                                     snapshot.intern(payload.get('build_status')))
+        return self._render_pipeline(project_id, pipeline_id)
+
+    def _mr_event(self, payload: Dict[str, Any]) -> Tuple[Optional[int], Optional[str], Tuple]:
+        attributes = payload.get('object_attributes', {})
+        project_id = payload.get('project', {}).get('id', attributes.get('target_project_id'))
+        mr_info = {
+            'iid': attributes.get('iid'),
+            'title': attributes.get('title', ''),
+            'author': self._username(payload, attributes.get('author_id')),
+            'state': attributes.get('state', ''),
+            'source_branch': attributes.get('source_branch', ''),
+            'target_branch': attributes.get('target_branch', ''),
+            'reviewers': [r['username'] for r in payload.get('reviewers', [])],
+            'labels': [label['title'] for label in payload.get('labels', [])],
+            'web_url': attributes.get('url'),
+        }
+        message = render.render_mr(mr_info)
+        return project_id, message, ('mr', project_id, attributes.get('iid'))
+
+    def _username(self, payload: Dict[str, Any], user_id: Optional[int]) -> str:
+        # the event's user is whoever acted on the MR, not necessarily its author
+        for user in [payload.get('user') or {}] + payload.get('assignees', []) + payload.get('reviewers', []):
+            if user.get('id') is not None and user.get('username'):
+                self.usernames[user['id']] = user['username']
+        while len(self.usernames) > MAX_TRACKED_AUTHORS:
+            self.usernames.pop(next(iter(self.usernames)))
+        return self.usernames.get(user_id, '')
+
+    def _note_event(self, payload: Dict[str, Any]) -> Tuple[Optional[int], Optional[str], Tuple]:
+        attributes = payload.get('object_attributes', {})
+        project_id = payload.get('project', {}).get('id', attributes.get('project_id'))
+        if attributes.get('noteable_type') != 'MergeRequest' or attributes.get('system'):
+            return project_id, None, ()
+
+        mr = payload.get('merge_request', {})
+        user = payload.get('user', {})
+        # the author answering reviewers isn't news for the author
+        if user.get('id') is not None and user.get('id') == mr.get('author_id'):
+            return project_id, None, ()
+
+        body = ' '.join((attributes.get('note') or '').split())
+        if len(body) > 300:
+            body = f"{body[:300]}..."
+
+        message = render.render_note(
+            mr.get('iid'),
+            f"{user.get('name', '')} - {user.get('username', '')}",
+            body,
+            attributes.get('url')
+        )
+        return project_id, message, ('note', project_id, attributes.get('id'))
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        status, body = 500, ''
+        try:
+            status, body = await self._handle_request(reader)
+        except Exception as e:
+            logger.error(f"Ошибка обработки webhook: {e}")
+        finally:
+            reason = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+                      405: 'Method Not Allowed', 408: 'Request Timeout',
+                      413: 'Payload Too Large'}.get(status, 'Internal Server Error')
+            content = body.encode()
+            content_type = 'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n' if content else ''
+            writer.write(f"HTTP/1.1 {status} {reason}\r\n{content_type}Content-Length: {len(content)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + content)
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+
+    async def _read_head(self, reader: asyncio.StreamReader) -> Tuple[List[str], Dict[str, str]]:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return request_line, headers
+
+    async def _handle_request(self, reader: asyncio.StreamReader) -> Tuple[int, str]:
+        # a client that connects and goes quiet must not hold the connection open
+        try:
+            request_line, headers = await asyncio.wait_for(self._read_head(reader), WEBHOOK_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            return 408, ''
+
+        if len(request_line) < 2:
+            return 400, ''
+        method, path = request_line[0], request_line[1].split('?')[0]
+        if path in self.routes:
+            if method != 'GET':
+                return 405, ''
+            return 200, self.routes[path]()
+        if path != self.path or not self.accept_events:
+            return 404, ''
+        if method != 'POST':
+            return 405, ''
+        if not self.verify(headers.get('x-gitlab-token')):
+            return 401, ''
+
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            return 400, ''
+        if length < 0:
+            return 400, ''
+        if length > MAX_BODY_SIZE:
+            return 413, ''
+
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length), WEBHOOK_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            return 408, ''
+        except asyncio.IncompleteReadError:
+            return 400, ''
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, ''
+        if not isinstance(payload, dict):
+            return 400, ''
+
+        # GitLab only waits a few seconds: the fan-out goes on after the reply
+        task = asyncio.ensure_future(self.handle_event(payload, headers.get('x-gitlab-event')))
+        self._tasks.add(task)
+        task.add_done_callback(self._event_done)
+        return 200, ''
+
+    def _event_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Ошибка обработки события webhook: {task.exception()}")
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> asyncio.AbstractServer:
+        if self.accept_events and not self.secret:
+            raise ValueError('WEBHOOK_SECRET is required to accept GitLab events')
+        server = self.server = await asyncio.start_server(self.handle_connection, host, port)
+        paths = ([self.path] if self.accept_events else []) + list(self.routes)
+        logger.info(f"HTTP сервер запущен на {host}:{port} ({', '.join(paths)})")
+        return server
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        # GitLab already got its 200 for these, give them a moment to reach the chats
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+
+receiver: Optional[WebhookReceiver] = None
+
+
+async def start_webhook_server(application) -> Optional[asyncio.AbstractServer]:
+    global receiver
+    if not WEBHOOK_ENABLED and not METRICS_ENABLED:
+        return None
+
+    import gitlab_async
+    import metrics
+    from sender import get_dispatcher
+
+    receiver = WebhookReceiver(
+        get_dispatcher().notify,
+        on_project_event=gitlab_async.snapshot_cache.invalidate_project,
+        routes={METRICS_PATH: metrics.registry.render_prometheus} if METRICS_ENABLED else None,
+        accept_events=WEBHOOK_ENABLED
+    )
+    return await receiver.start()
+
+
+async def stop_webhook_server() -> None:
+    global receiver
+    if receiver is not None:
+        await receiver.stop()
+        receiver = None
+
+
+async def _print_notify(chat_id: int, key: Tuple, text: str) -> None:
+    print(f"--- chat_id {chat_id} {key}\n{text}\n")
+
+
+async def _serve(host: str, port: int, secret: str) -> None:
+    server = await WebhookReceiver(_print_notify, secret=secret).start(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def replay(files: List[str], url: str, secret: str = WEBHOOK_SECRET) -> None:
+    # a recorded file holds one payload or a list of them, the event is taken from object_kind.
+    # Files go out in the given order: job events only update a pipeline whose Pipeline Hook came first
+    kinds = {kind: event for event, kind in EVENTS.items()}
+    for file_name in files:
+        with open(file_name, encoding='utf-8') as f:
+            payloads = json.load(f)
+        if isinstance(payloads, dict):
+            payloads = [payloads]
+
+        for payload in payloads:
+            request = urllib.request.Request(
+                url,
+                data=json.dumps(payload).encode(),
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-Gitlab-Event': kinds.get(payload.get('object_kind'), ''),
+                    'X-Gitlab-Token': secret,
+                },
+                method='POST'
+            )
+            with urllib.request.urlopen(request) as response:
+                print(f"{file_name}: {payload.get('object_kind')} -> {response.status}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    arg_parser = argparse.ArgumentParser(description='GitLab webhook receiver')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='run a local receiver that prints messages instead of sending them')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    serve.add_argument('--secret', default=WEBHOOK_SECRET)
+
+    replay_parser = commands.add_parser('replay', help='post recorded webhook payloads to a receiver')
+    replay_parser.add_argument('files', nargs='+')
+    replay_parser.add_argument('--url', default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    replay_parser.add_argument('--secret', default=WEBHOOK_SECRET)
+
+    args = arg_parser.parse_args(argv)
+    if not args.secret:
+        arg_parser.error('set WEBHOOK_SECRET in config.py or pass --secret')
+    if args.command == 'serve':
+        asyncio.run(_serve(args.host, args.port, args.secret))
+    else:
+        replay(args.files, args.url, args.secret)
+
+
+if __name__ == '__main__':
+    log_setup.setup_logging()
+    try:
+        main(sys.argv[1:])
+    finally:
+        log_setup.stop_logging()
@@ -0,0 +1,130 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+WORK_QUEUE_PATH = getattr(config, 'WORK_QUEUE_PATH', 'bot_queue.sqlite3')
+WORK_QUEUE_BATCH = 100
+# a worker that has not renewed its shard lease for this long is considered gone (seconds)
+SHARD_LEASE_TTL = 30
+
+
+class ShardTakenError(RuntimeError):
+    pass
+
+
+# Updates and webhook events handed from the ingest process to the shard workers.
+# Several processes share the file: every statement is its own transaction and waits for the lock
+class WorkQueue:
+    def __init__(self, path: str = WORK_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS work ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' shard INTEGER NOT NULL,'
+            ' kind TEXT NOT NULL,'
+            ' payload TEXT NOT NULL,'
+            ' created_at REAL NOT NULL'
+            ')'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS work_shard ON work (shard, id)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS shards ('
+            ' shard INTEGER PRIMARY KEY,'
+            ' owner TEXT NOT NULL,'
+            ' renewed_at REAL NOT NULL'
+            ')'
+        )
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+
+    def put(self, shard: int, kind: str, payload: Any) -> None:
+        with self._lock:
+            self._connection.execute(
+                'INSERT INTO work (shard, kind, payload, created_at) VALUES (?, ?, ?, ?)',
+                (shard, kind, json.dumps(payload, ensure_ascii=False), time.time())
+            )
+
+    def put_many(self, items: List[Tuple[int, str, Any]]) -> None:
+        created_at = time.time()
+        rows = [(shard, kind, json.dumps(payload, ensure_ascii=False), created_at) for shard, kind, payload in items]
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.executemany(
+                    'INSERT INTO work (shard, kind, payload, created_at) VALUES (?, ?, ?, ?)', rows
+                )
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def claim(self, shard: int, limit: int = WORK_QUEUE_BATCH) -> List[Tuple[str, Any]]:
+        # rows are deleted as they are handed out, so no row is ever given to two workers;
+        # a worker that dies holding a batch loses it instead of sending it twice
+        with self._lock:
+            rows = self._connection.execute(
+                'DELETE FROM work WHERE id IN (SELECT id FROM work WHERE shard = ? ORDER BY id LIMIT ?)'
+                ' RETURNING id, kind, payload',
+                (shard, limit)
+            ).fetchall()
+        rows.sort()
+        return [(kind, json.loads(payload)) for _, kind, payload in rows]
+
+    def depth(self) -> Dict[int, int]:
+        with self._lock:
+            return dict(self._connection.execute('SELECT shard, COUNT(*) FROM work GROUP BY shard').fetchall())
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def acquire_shard(self, shard: int, owner: str, ttl: float = SHARD_LEASE_TTL) -> None:
+        # two workers on one shard would both poll GitLab and both notify the same chats
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute(
+                    'SELECT owner, renewed_at FROM shards WHERE shard = ?', (shard,)
+                ).fetchone()
+                if row and row[0] != owner and now - row[1] < ttl:
+                    raise ShardTakenError(f"shard {shard} is held by {row[0]}")
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO shards (shard, owner, renewed_at) VALUES (?, ?, ?)', (shard, owner, now)
+                )
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def renew_shard(self, shard: int, owner: str) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                'UPDATE shards SET renewed_at = ? WHERE shard = ? AND owner = ?', (time.time(), shard, owner)
+            )
+        return cursor.rowcount == 1
+
+    def release_shard(self, shard: int, owner: str) -> None:
+        with self._lock:
+            self._connection.execute('DELETE FROM shards WHERE shard = ? AND owner = ?', (shard, owner))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()